@@ -4,46 +4,53 @@ Author:
     Weichen Shen,wcshen1994@163.com
 """
 
-from collections import OrderedDict, namedtuple, defaultdict
-from itertools import chain
+import os
+from collections import OrderedDict, namedtuple
 
 import torch
 import torch.nn as nn
 import numpy as np
 
-from .layers.sequence import SequencePoolingLayer
-from .layers.utils import concat_fun
+from .layers.embedding import SparseUpdateEmbedding, EmbeddingArena, DynamicEmbedding, AdmissionEmbedding, \
+    QREmbedding, CachedEmbedding, MmapEmbedding, FusedEmbedding
+from .layers.sequence import bag_sizes, pool_bags, pad_bags
+from .layers.utils import concat_fun, Hash
 
 DEFAULT_GROUP_NAME = "default_group"
 
 
 class SparseFeat(namedtuple('SparseFeat',
                             ['name', 'vocabulary_size', 'embedding_dim', 'use_hash', 'dtype', 'embedding_name',
-                             'group_name'])):
+                             'group_name', 'dynamic', 'admission', 'compositional', 'cache',
+                             'mmap'])):
     __slots__ = ()
 
     def __new__(cls, name, vocabulary_size, embedding_dim=4, use_hash=False, dtype="int32", embedding_name=None,
-                group_name=DEFAULT_GROUP_NAME):
+                group_name=DEFAULT_GROUP_NAME, dynamic=False, admission=None, compositional=None, cache=None,
+                mmap=None):
         if embedding_name is None:
             embedding_name = name
         if embedding_dim == "auto":
             embedding_dim = 6 * int(pow(vocabulary_size, 0.25))
-        if use_hash:
-            print(
-                "Notice! Feature Hashing on the fly currently is not supported in torch version,you can use tensorflow version!")
         return super(SparseFeat, cls).__new__(cls, name, vocabulary_size, embedding_dim, use_hash, dtype,
-                                              embedding_name, group_name)
+                                              embedding_name, group_name, dynamic, admission, compositional, cache,
+                                              mmap)
 
     def __hash__(self):
         return self.name.__hash__()
 
 
 class VarLenSparseFeat(namedtuple('VarLenSparseFeat',
-                                  ['sparsefeat', 'maxlen', 'combiner', 'length_name'])):
+                                  ['sparsefeat', 'maxlen', 'combiner', 'length_name', 'weight_name', 'jagged'])):
     __slots__ = ()
 
-    def __new__(cls, sparsefeat, maxlen, combiner="mean", length_name=None):
-        return super(VarLenSparseFeat, cls).__new__(cls, sparsefeat, maxlen, combiner, length_name)
+    def __new__(cls, sparsefeat, maxlen, combiner="mean", length_name=None, weight_name=None, jagged=False):
+        if jagged and length_name is not None:
+            # the offsets of a jagged feature hold its lengths, no column is built for them
+            raise ValueError("a jagged VarLenSparseFeat has no length_name, got %s for %s"
+                             % (length_name, sparsefeat.name))
+        return super(VarLenSparseFeat, cls).__new__(cls, sparsefeat, maxlen, combiner, length_name, weight_name,
+                                                    jagged)
 
     @property
     def name(self):
@@ -57,6 +64,30 @@ class VarLenSparseFeat(namedtuple('VarLenSparseFeat',
     def embedding_dim(self):
         return self.sparsefeat.embedding_dim
 
+    @property
+    def use_hash(self):
+        return self.sparsefeat.use_hash
+
+    @property
+    def dynamic(self):
+        return self.sparsefeat.dynamic
+
+    @property
+    def admission(self):
+        return self.sparsefeat.admission
+
+    @property
+    def compositional(self):
+        return self.sparsefeat.compositional
+
+    @property
+    def cache(self):
+        return self.sparsefeat.cache
+
+    @property
+    def mmap(self):
+        return self.sparsefeat.mmap
+
     @property
     def dtype(self):
         return self.sparsefeat.dtype
@@ -94,6 +125,10 @@ def get_feature_names(feature_columns):
 
 def build_input_features(feature_columns):
     # Return OrderedDict: {feature_name:(start, start+dimension)}
+    # The ids of sparse and var-length features and the lengths of the latter come first, they are the columns of
+    # the id matrix of a FeatureBatch; the dense features and the weights of the ids of var-length features with
+    # a weight_name follow, their columns are those of its float matrix. Var-length features with jagged=True,
+    # and their weights, have no columns: (start, start), their ids are in the jagged dict of a FeatureBatch.
 
     features = OrderedDict()
 
@@ -105,20 +140,183 @@ def build_input_features(feature_columns):
         if isinstance(feat, SparseFeat):
             features[feat_name] = (start, start + 1)
             start += 1
-        elif isinstance(feat, DenseFeat):
-            features[feat_name] = (start, start + feat.dimension)
-            start += feat.dimension
+        elif isinstance(feat, VarLenSparseFeat) and feat.jagged:
+            features[feat_name] = (start, start)
+            if feat.weight_name is not None and feat.weight_name not in features:
+                features[feat.weight_name] = (start, start)
         elif isinstance(feat, VarLenSparseFeat):
             features[feat_name] = (start, start + feat.maxlen)
             start += feat.maxlen
             if feat.length_name is not None and feat.length_name not in features:
                 features[feat.length_name] = (start, start + 1)
                 start += 1
-        else:
+        elif not isinstance(feat, DenseFeat):
             raise TypeError("Invalid feature column type,got", type(feat))
+    for feat in feature_columns:
+        if isinstance(feat, DenseFeat) and feat.name not in features:
+            features[feat.name] = (start, start + feat.dimension)
+            start += feat.dimension
+        elif isinstance(feat, VarLenSparseFeat) and feat.weight_name is not None and feat.weight_name not in features \
+                and not feat.jagged:
+            features[feat.weight_name] = (start, start + feat.maxlen)
+            start += feat.maxlen
     return features
 
 
+def count_id_columns(feature_columns):
+    # Return the number of columns of the id matrix of a FeatureBatch, see build_input_features
+    features = build_input_features([feat if isinstance(feat, SparseFeat) else feat._replace(weight_name=None)
+                                     for feat in feature_columns if not isinstance(feat, DenseFeat)])
+    return max([end for _, end in features.values()] + [0])
+
+
+class JaggedArray(object):
+    """Rows of different lengths, e.g. the ids of a var-length feature, stored without padding.
+
+    The rows are concatenated in ``values`` and row ``i`` is ``values[offsets[i]:offsets[i + 1]]``, so
+    ``offsets`` has one more entry than there are rows (CSR layout). It is the input of a ``VarLenSparseFeat``
+    with ``jagged=True``, and of its ``weight_name``. Indexing with a slice or with an array of row indices
+    returns a ``JaggedArray`` of those rows, gathered without a Python loop over them.
+    """
+    __slots__ = ('values', 'offsets')
+
+    def __init__(self, values, offsets):
+        self.values = np.asarray(values)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_lists(cls, rows, dtype=np.int64):
+        """Builds a jagged array from a list of sequences."""
+        lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.fromiter((value for row in rows for value in row), dtype=dtype, count=int(offsets[-1]))
+        return cls(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) and index.step in (None, 1):
+            start, stop, _ = index.indices(len(self))
+            stop = max(start, stop)
+            return JaggedArray(self.values[self.offsets[start]:self.offsets[stop]],
+                               self.offsets[start:stop + 1] - self.offsets[start])
+        if isinstance(index, slice):
+            index = np.arange(len(self))[index]
+        index = np.asarray(index, dtype=np.int64)
+        starts = self.offsets[index]
+        lengths = self.offsets[index + 1] - starts
+        offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # the j-th value of output row r is values[starts[r] + j - offsets[r]]
+        positions = np.arange(offsets[-1], dtype=np.int64) + np.repeat(starts - offsets[:-1], lengths)
+        return JaggedArray(self.values[positions], offsets)
+
+    def pad(self, maxlen=None, value=0):
+        """Returns the ``[len(self), maxlen]`` matrix of the rows padded with ``value``, or truncated to
+        ``maxlen``; ``maxlen`` defaults to the longest row."""
+        lengths = self.lengths()
+        if maxlen is None:
+            maxlen = int(lengths.max()) if len(lengths) else 0
+        padded = np.full((len(self), maxlen), value, dtype=self.values.dtype)
+        rows = np.repeat(np.arange(len(self)), lengths)
+        positions = np.arange(len(self.values)) - np.repeat(self.offsets[:-1], lengths)
+        kept = positions < maxlen
+        padded[rows[kept], positions[kept]] = self.values[kept]
+        return padded
+
+
+class FeatureBatch(object):
+    """Input of a model for one batch, stored by type.
+
+    ``ids`` is an int64 matrix with the ids of the sparse features and the ids and lengths of the var-length
+    ones, ``dense`` a float matrix with the dense features. ``build_input_features`` numbers the columns of
+    ``ids`` first and those of ``dense`` after them, so ``X[:, start:end]`` selects a feature from its own
+    matrix, as it would from one matrix of all columns, without any id being stored as a float or converted
+    back per feature. ``jagged`` maps the names of the var-length features with ``jagged=True`` (and of their
+    weights) to the ``(values, offsets)`` tensors of their ``JaggedArray``, ``offsets`` having
+    ``batch_size + 1`` entries.
+    """
+    __slots__ = ('ids', 'dense', 'jagged')
+
+    def __init__(self, ids, dense, jagged=None):
+        self.ids = ids
+        self.dense = dense
+        self.jagged = jagged if jagged is not None else {}
+
+    @classmethod
+    def from_arrays(cls, x, num_id_columns):
+        """Builds a batch from the 2-dimensional arrays of the features, in ``feature_index`` order."""
+        ids, dense = split_feature_arrays(x, num_id_columns)
+        return cls(torch.from_numpy(ids), torch.from_numpy(dense))
+
+    @property
+    def shape(self):
+        return torch.Size([self.ids.size(0), self.ids.size(1) + self.dense.size(1)])
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def to(self, device):
+        return FeatureBatch(self.ids.to(device), self.dense.to(device),
+                            {name: (values.to(device), offsets.to(device))
+                             for name, (values, offsets) in self.jagged.items()})
+
+    def __getitem__(self, key):
+        rows, columns = key
+        num_ids = self.ids.size(1)
+        if isinstance(columns, slice):
+            start = columns.start or 0
+            stop = columns.stop if columns.stop is not None else num_ids + self.dense.size(1)
+            if stop <= num_ids:
+                return self.ids[rows, start:stop]
+            if start >= num_ids:
+                return self.dense[rows, start - num_ids:stop - num_ids]
+        elif all(column < num_ids for column in columns):
+            return self.ids[rows, columns]
+        elif all(column >= num_ids for column in columns):
+            return self.dense[rows, [column - num_ids for column in columns]]
+        raise IndexError("the columns of a FeatureBatch must all be id or all be dense columns")
+
+
+def split_feature_arrays(x, num_id_columns, num_rows=None):
+    # Return the int64 id matrix and the float32 dense matrix of the arrays x, in feature_index order
+    ids, dense = [], []
+    width = 0
+    for array in x:
+        # e.g. the [N, maxlen, 1] weights of a var-length feature
+        array = array.reshape(len(array), -1)
+        if width < num_id_columns:
+            ids.append(array)
+            width += array.shape[1]
+        else:
+            dense.append(array)
+    if num_rows is None:
+        num_rows = len(x[0]) if len(x) else 0
+    ids = np.concatenate(ids, axis=-1).astype(np.int64, copy=False) if ids else np.zeros((num_rows, 0), np.int64)
+    dense = np.concatenate(dense, axis=-1).astype(np.float32, copy=False) if dense else \
+        np.zeros((num_rows, 0), np.float32)
+    return ids, dense
+
+
+def build_input_hashes(feature_columns):
+    # Return OrderedDict: {feature_name:Hash} of the features with use_hash=True, whose raw values are
+    # hashed into vocabulary_size buckets when they are batched. Like the tensorflow version, sequences
+    # keep 0 for padding, and so do the features sharing their embedding (e.g. the query of DIN), so that
+    # equal raw values get equal ids.
+
+    masked = set(feat.embedding_name for feat in feature_columns if isinstance(feat, VarLenSparseFeat))
+    hashes = OrderedDict()
+    for feat in feature_columns:
+        if isinstance(feat, (SparseFeat, VarLenSparseFeat)) and feat.use_hash and feat.name not in hashes:
+            hashes[feat.name] = Hash(feat.vocabulary_size, mask_zero=feat.embedding_name in masked)
+    return hashes
+
+
 def combined_dnn_input(sparse_embedding_list, dense_value_list):
     if len(sparse_embedding_list) > 0 and len(dense_value_list) > 0:
         sparse_dnn_input = torch.flatten(
@@ -134,138 +332,290 @@ def combined_dnn_input(sparse_embedding_list, dense_value_list):
         raise NotImplementedError
 
 
-def get_varlen_pooling_list(embedding_dict, features, feature_index, varlen_sparse_feature_columns, device):
-    varlen_sparse_embedding_list = []
-
-    for feat in varlen_sparse_feature_columns:
-        seq_emb = embedding_dict[feat.embedding_name](
-            features[:, feature_index[feat.name][0]:feature_index[feat.name][1]].long())
-        if feat.length_name is None:
-            seq_mask = features[:, feature_index[feat.name][0]:feature_index[feat.name][1]].long() != 0
+class _Columns(object):
+    # Columns of the id or of the dense matrix of a FeatureBatch, given by their (start, end) in feature_index.
+    # They are gathered with a slice, i.e. a view, when they are contiguous and with one index_select otherwise,
+    # whose index is built on the first batch of every device.
+
+    def __init__(self, ranges, dense=False):
+        self.ranges = list(ranges)
+        self.dense = dense
+        self.index = {}
+
+    def __call__(self, X):
+        matrix = X.dense if self.dense else X.ids
+        key = (matrix.device, X.ids.size(1))
+        index = self.index.get(key)
+        if index is None:
+            offset = X.ids.size(1) if self.dense else 0
+            columns = [column - offset for start, end in self.ranges for column in range(start, end)]
+            if columns == list(range(columns[0], columns[0] + len(columns))):
+                index = slice(columns[0], columns[0] + len(columns))
+            else:
+                index = torch.tensor(columns, dtype=torch.long, device=matrix.device)
+            self.index[key] = index
+        if isinstance(index, slice):
+            return matrix[:, index]
+        return matrix.index_select(1, index)
+
+
+class _EmbeddingLookup(object):
+    # Looks up a list of sparse or var-length features table by table: the columns of all the features of a
+    # table are gathered together and embedded with one call, whose output is split back into one
+    # [B, width, embedding_dim] tensor per feature. An EmbeddingArena looks up features of width 1 all at once.
+
+    def __init__(self, feature_columns, feature_index):
+        self.names = [feat.embedding_name for feat in feature_columns]
+        widths = [feature_index[feat.name][1] - feature_index[feat.name][0] for feat in feature_columns]
+        self.columns = _Columns([feature_index[feat.name] for feat in feature_columns]) if feature_columns else None
+        self.single_columns = all(width == 1 for width in widths)
+        positions = OrderedDict()
+        for i, name in enumerate(self.names):
+            positions.setdefault(name, []).append(i)
+        # embedding_name -> (columns of its features, their positions in feature_columns, their widths)
+        self.tables = OrderedDict(
+            (name, (_Columns([feature_index[feature_columns[i].name] for i in table_positions]), table_positions,
+                    [widths[i] for i in table_positions]))
+            for name, table_positions in positions.items())
+
+    def __call__(self, X, embedding_dict):
+        if not self.names:
+            return []
+        if isinstance(embedding_dict, EmbeddingArena) and self.single_columns:
+            return embedding_dict(self.columns(X), self.names)
+        outputs = [None] * len(self.names)
+        for name, (columns, positions, widths) in self.tables.items():
+            embeddings = embedding_dict[name](columns(X))
+            if len(positions) == 1:
+                outputs[positions[0]] = embeddings
+            else:
+                for position, embedding in zip(positions, embeddings.split(widths, dim=1)):
+                    outputs[position] = embedding
+        return outputs
+
+
+# A var-length feature in a FeatureBatch: its table, whether it is jagged, its id columns (its name if jagged), its
+# length column (None when 0 ids are padding), its weight columns (their name if jagged, None without weights),
+# its combiner and its maxlen
+_Bag = namedtuple('_Bag', ['embedding_name', 'jagged', 'columns', 'length_columns', 'weight_columns', 'combiner',
+                           'maxlen'])
+
+
+class InputPlan(object):
+    """Where the inputs of some feature columns are in a ``FeatureBatch``, worked out once per model.
+
+    The feature columns are split by type when the plan is built. Per batch, the ids of the features of every
+    embedding table are then gathered with one slice or ``index_select`` and looked up with one call, and the
+    dense features with one gather, so the Python work of a step grows with the number of tables instead of
+    the number of fields; with an ``EmbeddingArena`` all the sparse features are one lookup.
+
+    Tables are taken from the ``embedding_dict`` given to every call rather than kept by the plan, so that
+    replacing them, e.g. by ``quantize_embeddings`` or ``Linear.compact``, needs no new plan.
+    """
 
-            emb = SequencePoolingLayer(mode=feat.combiner, supports_masking=True, device=device)(
-                [seq_emb, seq_mask])
+    def __init__(self, feature_columns, feature_index):
+        self.sparse_feature_columns = [feat for feat in feature_columns if isinstance(feat, SparseFeat)]
+        self.dense_feature_columns = [feat for feat in feature_columns if isinstance(feat, DenseFeat)]
+        self.varlen_sparse_feature_columns = [feat for feat in feature_columns if isinstance(feat, VarLenSparseFeat)]
+
+        self.sparse_lookup = _EmbeddingLookup(self.sparse_feature_columns, feature_index)
+        # padded var-length features are looked up like the sparse ones, jagged ones from their values
+        padded_feature_columns = [feat for feat in self.varlen_sparse_feature_columns if not feat.jagged]
+        self.varlen_lookup = _EmbeddingLookup(padded_feature_columns, feature_index)
+        self.padded_positions = [i for i, feat in enumerate(self.varlen_sparse_feature_columns) if not feat.jagged]
+        self.dense_columns = _Columns([feature_index[feat.name] for feat in self.dense_feature_columns], dense=True) \
+            if self.dense_feature_columns else None
+        self.dense_dims = [feat.dimension for feat in self.dense_feature_columns]
+        self.bags = []
+        for feat in self.varlen_sparse_feature_columns:
+            if feat.jagged:
+                self.bags.append(_Bag(feat.embedding_name, True, feat.name, None, feat.weight_name, feat.combiner,
+                                      feat.maxlen))
+                continue
+            self.bags.append(_Bag(feat.embedding_name, False, slice(*feature_index[feat.name]),
+                                  slice(*feature_index[feat.length_name]) if feat.length_name is not None else None,
+                                  feature_index[feat.weight_name] if feat.weight_name is not None else None,
+                                  feat.combiner, feat.maxlen))
+
+    def sparse_embeddings(self, X, embedding_dict):
+        """Returns the ``[batch_size, 1, embedding_dim]`` embeddings of the sparse features, in order."""
+        return self.sparse_lookup(X, embedding_dict)
+
+    def sequence_embeddings(self, X, embedding_dict):
+        """Returns the ``[batch_size, maxlen, embedding_dim]`` embeddings of the var-length features, in order.
+
+        Only the values of jagged features are looked up, and then padded, by ``pad_bags``, with zero rows.
+        """
+        if len(self.padded_positions) == len(self.bags):
+            return self.varlen_lookup(X, embedding_dict)
+        sequences = [None] * len(self.bags)
+        for position, embedding in zip(self.padded_positions, self.varlen_lookup(X, embedding_dict)):
+            sequences[position] = embedding
+        for position, bag in enumerate(self.bags):
+            if bag.jagged:
+                ids, offsets, _ = self._bag(X, bag)
+                sequences[position] = pad_bags(embedding_dict[bag.embedding_name](ids), offsets, bag.maxlen)
+        return sequences
+
+    def sequence_lengths(self, X):
+        """Returns the ``[batch_size]`` lengths of the sequences of the var-length features, in order; those of
+        jagged features are cut at ``maxlen`` like their ``sequence_embeddings``."""
+        lengths = []
+        for bag in self.bags:
+            ids, offsets, _ = self._bag(X, bag)
+            length = bag_sizes(offsets, ids.size(0))
+            lengths.append(length.clamp(max=bag.maxlen) if bag.jagged else length)
+        return lengths
+
+    def pooled_embeddings(self, X, embedding_dict):
+        """Returns the ``[batch_size, 1, embedding_dim]`` pooled embeddings of the var-length features, in order.
+
+        The ids of every sequence, without padding, are pooled as one bag with their weights, if any, by the
+        ``bag`` method of the table, in one ``F.embedding_bag`` call when the table allows it, or else looked
+        up and pooled by ``pool_bags``; no ``[batch_size, maxlen, embedding_dim]`` tensor is built. The bags of
+        jagged features are their values and offsets as batched, those of padded ones are built from the
+        padded ids.
+        """
+        pooled = []
+        for bag in self.bags:
+            ids, offsets, weights = self._bag(X, bag)
+            table = embedding_dict[bag.embedding_name]
+            if hasattr(table, 'bag'):
+                embedding = table.bag(ids, offsets, bag.combiner, weights)
+            else:
+                embedding = pool_bags(table(ids), offsets, bag.combiner, weights)
+            pooled.append(embedding.unsqueeze(1))
+        return pooled
+
+    @staticmethod
+    def _bag(X, bag):
+        # Return the ids of a var-length feature in the batch X as one bag per sample: the 1-D ids, where each
+        # bag starts and the weights of the ids or None
+        if bag.jagged:
+            ids, offsets = X.jagged[bag.columns]
+            weights = X.jagged[bag.weight_columns][0] if bag.weight_columns is not None else None
+            return ids, offsets[:-1], weights
+        seq_input = X.ids[:, bag.columns]
+        if bag.length_columns is None:
+            mask = seq_input != 0
         else:
-            seq_length = features[:,
-                         feature_index[feat.length_name][0]:feature_index[feat.length_name][1]].long()
-            emb = SequencePoolingLayer(mode=feat.combiner, supports_masking=False, device=device)(
-                [seq_emb, seq_length])
-        varlen_sparse_embedding_list.append(emb)
-    return varlen_sparse_embedding_list
-
-
-def create_embedding_matrix(feature_columns, init_std=0.0001, linear=False, sparse=False, device='cpu'):
-    # Return nn.ModuleDict: for sparse features, {embedding_name: nn.Embedding}
-    # for varlen sparse features, {embedding_name: nn.EmbeddingBag}
+            mask = torch.arange(seq_input.size(1), device=seq_input.device) < X.ids[:, bag.length_columns]
+        lengths = mask.sum(dim=1)
+        weights = None
+        if bag.weight_columns is not None:
+            start, end = bag.weight_columns
+            weights = X.dense[:, start - X.ids.size(1):end - X.ids.size(1)][mask]
+        return seq_input[mask], lengths.cumsum(dim=0) - lengths, weights
+
+    def dense_values(self, X):
+        """Returns the ``[batch_size, dimension]`` values of the dense features, in order."""
+        if self.dense_columns is None:
+            return []
+        values = self.dense_columns(X)
+        if len(self.dense_dims) == 1:
+            return [values]
+        return list(values.split(self.dense_dims, dim=1))
+
+
+def create_embedding_matrix(feature_columns, init_std=0.0001, linear=False, sparse=False, device='cpu', arena=False,
+                            fused=()):
+    # Return nn.ModuleDict: for sparse and varlen sparse features, {embedding_name: SparseUpdateEmbedding}, the
+    # sequences of the latter being pooled by SparseUpdateEmbedding.bag, see InputPlan.pooled_embeddings
+    # or, if arena is True, an EmbeddingArena holding all tables of one embedding_dim in one tensor.
+    # A feature with dynamic=True (or a dict of DynamicEmbedding arguments, e.g. {'expire_steps': 10000})
+    # gets a DynamicEmbedding of vocabulary_size rows taking raw ids. A feature with admission=N (or a dict
+    # of AdmissionEmbedding arguments, e.g. {'min_count': 3, 'width': 2 ** 22}) is looked up through an
+    # AdmissionEmbedding, which keeps ids seen fewer than N times on a shared default row. A feature with
+    # compositional=C (or a dict of QREmbedding arguments, e.g. {'num_collisions': C, 'operation': 'concat'})
+    # gets a QREmbedding of a quotient and a remainder table of about vocabulary_size / C + C rows. A feature
+    # with cache=N (or a dict of CachedEmbedding arguments, e.g. {'cache_size': N, 'storage': 'mmap',
+    # 'storage_dir': ...}) gets a CachedEmbedding keeping N rows on device and the others in host memory. A
+    # feature with mmap=path (or a dict of MmapEmbedding arguments) gets an MmapEmbedding stored in files under
+    # path/<embedding_name>, or path/linear/<embedding_name> for the linear part. The tables of the embedding
+    # names in fused get an extra column for the weight of the linear part and are wrapped in a FusedEmbedding.
     sparse_feature_columns = list(
         filter(lambda x: isinstance(x, SparseFeat), feature_columns)) if len(feature_columns) else []
 
     varlen_sparse_feature_columns = list(
         filter(lambda x: isinstance(x, VarLenSparseFeat), feature_columns)) if len(feature_columns) else []
 
+    if arena:
+        if fused:
+            raise ValueError("fused embeddings cannot be stored in an EmbeddingArena")
+        if any(feat.dynamic or feat.admission or feat.compositional or feat.cache or feat.mmap
+               for feat in sparse_feature_columns + varlen_sparse_feature_columns):
+            raise ValueError("dynamic, admission, compositional, cached or memory-mapped embeddings cannot be "
+                             "stored in an EmbeddingArena")
+        tables = OrderedDict(
+            (feat.embedding_name, (feat.embedding_name, feat.vocabulary_size, feat.embedding_dim if not linear else 1))
+            for feat in sparse_feature_columns + varlen_sparse_feature_columns)
+        embedding_arena = EmbeddingArena(list(tables.values()), sparse=sparse)
+        for weight in embedding_arena.weight.values():
+            nn.init.normal_(weight, mean=0, std=init_std)
+        return embedding_arena.to(device)
+
+    def embedding(feat):
+        embedding_dim = feat.embedding_dim if not linear else 1
+        if feat.embedding_name in fused:
+            embedding_dim += 1
+        if feat.dynamic:
+            kwargs = feat.dynamic if isinstance(feat.dynamic, dict) else {}
+            table = DynamicEmbedding(feat.vocabulary_size, embedding_dim, init_std=init_std, sparse=sparse, **kwargs)
+        elif feat.compositional:
+            kwargs = dict(feat.compositional) if isinstance(feat.compositional, dict) else {
+                'num_collisions': feat.compositional}
+            if linear:
+                # the 1-dim weights of the linear part cannot be split between the two tables
+                kwargs['operation'] = 'add' if kwargs.get('operation') == 'concat' else kwargs.get('operation', 'mult')
+            table = QREmbedding(feat.vocabulary_size, embedding_dim, init_std=init_std, sparse=sparse, **kwargs)
+        elif feat.cache:
+            kwargs = dict(feat.cache) if isinstance(feat.cache, dict) else {'cache_size': feat.cache}
+            if linear and kwargs.get('storage_dir') is not None:
+                # the linear part has tables of the same names
+                kwargs['storage_dir'] = os.path.join(kwargs['storage_dir'], 'linear')
+            if kwargs.get('storage_dir') is not None:
+                kwargs['storage_dir'] = os.path.join(kwargs['storage_dir'], feat.embedding_name)
+            table = CachedEmbedding(feat.vocabulary_size, embedding_dim, init_std=init_std, sparse=sparse, **kwargs)
+        elif feat.mmap:
+            kwargs = dict(feat.mmap) if isinstance(feat.mmap, dict) else {'path': feat.mmap}
+            kwargs['path'] = os.path.join(kwargs['path'], 'linear', feat.embedding_name) if linear else \
+                os.path.join(kwargs['path'], feat.embedding_name)
+            table = MmapEmbedding(feat.vocabulary_size, embedding_dim, init_std=init_std, sparse=sparse, **kwargs)
+        else:
+            table = SparseUpdateEmbedding(feat.vocabulary_size, embedding_dim, sparse=sparse)
+        if feat.admission:
+            kwargs = feat.admission if isinstance(feat.admission, dict) else {'min_count': feat.admission}
+            table = AdmissionEmbedding(table, **kwargs)
+        if feat.embedding_name in fused:
+            table = FusedEmbedding(table)
+        return table
+
     embedding_dict = nn.ModuleDict(
-        {feat.embedding_name: nn.Embedding(feat.vocabulary_size, feat.embedding_dim if not linear else 1, sparse=sparse)
+        {feat.embedding_name: embedding(feat)
          for feat in
          sparse_feature_columns + varlen_sparse_feature_columns}
     )
 
-    # for feat in varlen_sparse_feature_columns:
-    #     embedding_dict[feat.embedding_name] = nn.EmbeddingBag(
-    #         feat.dimension, embedding_size, sparse=sparse, mode=feat.combiner)
-
-    for tensor in embedding_dict.values():
-        nn.init.normal_(tensor.weight, mean=0, std=init_std)
+    init_embedding_weights(embedding_dict, init_std)
 
     return embedding_dict.to(device)
 
 
-def input_from_feature_columns(self, X, feature_columns, embedding_dict, support_dense=True):
-    sparse_feature_columns = list(
-        filter(lambda x: isinstance(x, SparseFeat), feature_columns)) if len(feature_columns) else []
-    dense_feature_columns = list(
-        filter(lambda x: isinstance(x, DenseFeat), feature_columns)) if len(feature_columns) else []
-
-    varlen_sparse_feature_columns = list(
-        filter(lambda x: isinstance(x, VarLenSparseFeat), feature_columns)) if feature_columns else []
-
-    if not support_dense and len(dense_feature_columns) > 0:
-        raise ValueError(
-            "DenseFeat is not supported in dnn_feature_columns")
-
-    sparse_embedding_list = [embedding_dict[feat.embedding_name](
-        X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]].long()) for
-        feat in sparse_feature_columns]
-
-    varlen_sparse_embedding_list = get_varlen_pooling_list(self.embedding_dict, X, self.feature_index,
-                                                           varlen_sparse_feature_columns, self.device)
-
-    dense_value_list = [X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]] for feat in
-                        dense_feature_columns]
-
-    return sparse_embedding_list + varlen_sparse_embedding_list, dense_value_list
-
-
-
-def embedding_lookup(X, sparse_embedding_dict, sparse_input_dict, sparse_feature_columns, return_feat_list=(),
-                     mask_feat_list=(), to_list=False):
-    """
-        Args:
-            X: input Tensor [batch_size x hidden_dim]
-            sparse_embedding_dict: nn.ModuleDict, {embedding_name: nn.Embedding}
-            sparse_input_dict: OrderedDict, {feature_name:(start, start+dimension)}
-            sparse_feature_columns: list, sparse features
-            return_feat_list: list, names of feature to be returned, defualt () -> return all features
-            mask_feat_list, list, names of feature to be masked in hash transform
-        Return:
-            group_embedding_dict: defaultdict(list)
-    """
-    group_embedding_dict = defaultdict(list)
-    for fc in sparse_feature_columns:
-        feature_name = fc.name
-        embedding_name = fc.embedding_name
-        if (len(return_feat_list) == 0 or feature_name in return_feat_list):
-            # TODO: add hash function
-            # if fc.use_hash:
-            #     raise NotImplementedError("hash function is not implemented in this version!")
-            lookup_idx = np.array(sparse_input_dict[feature_name])
-            input_tensor = X[:, lookup_idx[0]:lookup_idx[1]].long()
-            emb = sparse_embedding_dict[embedding_name](input_tensor)
-            group_embedding_dict[fc.group_name].append(emb)
-    if to_list:
-        return list(chain.from_iterable(group_embedding_dict.values()))
-    return group_embedding_dict
-
-
-def varlen_embedding_lookup(X, embedding_dict, sequence_input_dict, varlen_sparse_feature_columns):
-    varlen_embedding_vec_dict = {}
-    for fc in varlen_sparse_feature_columns:
-        feature_name = fc.name
-        embedding_name = fc.embedding_name
-        if fc.use_hash:
-            # lookup_idx = Hash(fc.vocabulary_size, mask_zero=True)(sequence_input_dict[feature_name])
-            # TODO: add hash function
-            lookup_idx = sequence_input_dict[feature_name]
-        else:
-            lookup_idx = sequence_input_dict[feature_name]
-        varlen_embedding_vec_dict[feature_name] = embedding_dict[embedding_name](
-            X[:, lookup_idx[0]:lookup_idx[1]].long())  # (lookup_idx)
-
-    return varlen_embedding_vec_dict
-
-
-def get_dense_input(X, features, feature_columns):
-    dense_feature_columns = list(filter(lambda x: isinstance(
-        x, DenseFeat), feature_columns)) if feature_columns else []
-    dense_input_list = []
-    for fc in dense_feature_columns:
-        lookup_idx = np.array(features[fc.name])
-        input_tensor = X[:, lookup_idx[0]:lookup_idx[1]].float()
-        dense_input_list.append(input_tensor)
-    return dense_input_list
+def init_embedding_weights(embedding_dict, init_std=0.0001):
+    for table in embedding_dict.values():
+        # tables without a single weight, e.g. a QREmbedding, initialize their own, and so do MmapEmbedding
+        # tables, whose files may hold a trained table
+        inner = table
+        while isinstance(inner, (FusedEmbedding, AdmissionEmbedding)):
+            inner = inner.embedding
+        if isinstance(inner, MmapEmbedding):
+            continue
+        if hasattr(table, 'weight'):
+            nn.init.normal_(table.weight, mean=0, std=init_std)
 
 
 def maxlen_lookup(X, sparse_input_dict, maxlen_column):
     if maxlen_column is None or len(maxlen_column)==0:
         raise ValueError('please add max length column for VarLenSparseFeat of DIEN input')
-    lookup_idx = np.array(sparse_input_dict[maxlen_column[0]])
-    return X[:, lookup_idx[0]:lookup_idx[1]].long()
+    start, end = sparse_input_dict[maxlen_column[0]]
+    return X[:, start:end]
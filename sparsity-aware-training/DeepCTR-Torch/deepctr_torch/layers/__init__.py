@@ -1,4 +1,5 @@
 from .interaction import *
 from .core import *
-from .utils import concat_fun
+from .utils import concat_fun, Hash, CategoryEncoder
 from .sequence import *
+from .embedding import *
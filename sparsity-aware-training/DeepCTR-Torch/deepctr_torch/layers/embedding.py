@@ -0,0 +1,1102 @@
+# -*- coding:utf-8 -*-
+"""
+
+Embedding tables used by ``create_embedding_matrix``.
+
+"""
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .sequence import bag_sizes, pool_bags
+
+
+class _EmbeddingInBackward(torch.autograd.Function):
+    # Embedding lookup whose backward hands the output gradient to a sparse optimizer
+    # instead of accumulating a gradient for the table, see _queue_sparse_step.
+
+    @staticmethod
+    def forward(ctx, input, weight, padding_idx, optimizer):
+        if _sparse_steps_queued[0]:
+            # a backward pass failed after queuing steps, its callback was dropped with it: its gradients
+            # are discarded so that they are not mixed into the next step
+            _pending_sparse_steps.clear()
+            _sparse_steps_queued[0] = False
+        ctx.save_for_backward(input)
+        ctx.weight = weight
+        ctx.padding_idx = padding_idx
+        ctx.optimizer = optimizer
+        return F.embedding(input, weight, padding_idx)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, = ctx.saved_tensors
+        indices = input.reshape(-1)
+        values = grad_output.reshape(-1, ctx.weight.size(1))
+        if ctx.padding_idx is not None:
+            mask = indices != ctx.padding_idx
+            indices = indices[mask]
+            values = values[mask]
+        _queue_sparse_step(ctx.optimizer, ctx.weight, indices, values)
+        return None, None, None, None
+
+
+# id(weight) -> (optimizer, weight, [(indices, values)]) of the lookups whose backward has run in the current
+# backward pass
+_pending_sparse_steps = OrderedDict()
+# whether _apply_sparse_steps is queued to run at the end of the current backward pass
+_sparse_steps_queued = [False]
+
+
+def _queue_sparse_step(optimizer, weight, indices, values):
+    # The gradients of all lookups of a weight in one backward pass (e.g. features sharing an embedding_name,
+    # or the deep and linear parts of a FusedEmbedding) are gathered and applied in one sparse_step once the
+    # pass is over, so the optimizer sees the summed gradient of the step, as it would in optimizer.step(),
+    # and no weight changes while the backward pass may still need it.
+    if not _sparse_steps_queued[0]:
+        torch.autograd.Variable._execution_engine.queue_callback(_apply_sparse_steps)
+        _sparse_steps_queued[0] = True
+    key = id(weight)
+    if key not in _pending_sparse_steps:
+        _pending_sparse_steps[key] = (optimizer, weight, [])
+    _pending_sparse_steps[key][2].append((indices, values))
+
+
+def _apply_sparse_steps():
+    try:
+        for optimizer, weight, grads in _pending_sparse_steps.values():
+            indices = torch.cat([indices for indices, _ in grads])
+            values = torch.cat([values for _, values in grads])
+            optimizer.sparse_step(weight, indices, values)
+    finally:
+        _pending_sparse_steps.clear()
+        _sparse_steps_queued[0] = False
+
+
+class SparseUpdateEmbedding(nn.Embedding):
+    """``nn.Embedding`` that can apply its sparse optimizer update inside the backward pass.
+
+    Once ``optimizer`` is set (see ``BaseModel.compile(optimizer_sparse_in_backward=True)``), the backward
+    pass calls ``optimizer.sparse_step`` with the looked-up indices and the output gradient, so no gradient
+    is allocated for the table and ``optimizer.step()``/``zero_grad()`` skip it. Without an optimizer it
+    behaves exactly like ``nn.Embedding``.
+
+      Input shape
+        - LongTensor of arbitrary shape containing the indices to extract.
+
+      Output shape
+        - ``(*, embedding_dim)``, where ``*`` is the input shape.
+
+      Arguments
+        - Same as ``nn.Embedding``.
+
+      Notes
+        - If a table is looked up several times in one forward pass (e.g. a shared ``embedding_name``),
+          the gradients of all lookups are applied together in one step at the end of the backward pass.
+        - The rows returned by ``seen_embeddings`` (the batch regularization penalty) are looked up the same
+          way, so their gradient is part of that one step. Gradients reaching the table through other paths
+          are still accumulated in ``weight.grad`` and applied by ``optimizer.step()``.
+        - While ``seen_ids`` is a list, every input is appended to it, see ``seen_embeddings``.
+        - ``bag`` pools the rows of bags of ids in one ``F.embedding_bag`` call, like ``nn.EmbeddingBag``.
+    """
+    # whether the ids are rows of weight, so that bag can pool them in F.embedding_bag
+    _rows_are_ids = True
+
+    def __init__(self, *args, **kwargs):
+        super(SparseUpdateEmbedding, self).__init__(*args, **kwargs)
+        self.optimizer = None
+        self.seen_ids = None
+
+    def seen_embeddings(self):
+        """Returns ``[(weight, rows)]``, ``rows`` holding every row looked up since ``seen_ids`` was set to a
+        list once, and stops recording."""
+        seen_ids, self.seen_ids = self.seen_ids, None
+        if not seen_ids:
+            return []
+        ids = torch.cat([ids.reshape(-1) for ids in seen_ids]).unique()
+        # the recorded ids are rows of weight: looked up as such, and with an optimizer applied in backward,
+        # their gradient joins the sparse step of the batch
+        return [(self.weight, SparseUpdateEmbedding.forward(self, ids))]
+
+    def forward(self, input):
+        if self.seen_ids is not None:
+            self.seen_ids.append(input)
+        if self.optimizer is None or not (self.training and torch.is_grad_enabled() and self.weight.requires_grad):
+            return super(SparseUpdateEmbedding, self).forward(input)
+        return _EmbeddingInBackward.apply(input, self.weight, self.padding_idx, self.optimizer)
+
+    def bag(self, input, offsets, mode='mean', per_sample_weights=None):
+        """Pools the rows of the 1-D ids ``input`` bag by bag, ``offsets`` holding where every bag starts.
+
+        Returns ``(len(offsets), embedding_dim)``, see ``pool_bags``. The rows are gathered and reduced in one
+        ``F.embedding_bag`` call unless the lookup has to go through ``forward``, i.e. for ids that are not
+        rows, an optimizer applied in backward, a ``padding_idx``, or a max that ``F.embedding_bag`` cannot
+        compute (weighted or with sparse gradients).
+        """
+        in_backward = self.optimizer is not None and self.training and torch.is_grad_enabled() and \
+            self.weight.requires_grad
+        if not self._rows_are_ids or in_backward or self.padding_idx is not None or \
+                (mode == 'max' and (self.sparse or per_sample_weights is not None)):
+            return pool_bags(self(input), offsets, mode, per_sample_weights)
+        if self.seen_ids is not None:
+            self.seen_ids.append(input)
+        if per_sample_weights is None or mode == 'sum':
+            return F.embedding_bag(input, self.weight, offsets, mode=mode, sparse=self.sparse,
+                                   per_sample_weights=per_sample_weights)
+        pooled = F.embedding_bag(input, self.weight, offsets, mode='sum', sparse=self.sparse,
+                                 per_sample_weights=per_sample_weights.to(self.weight.dtype))
+        return pooled / bag_sizes(offsets, input.size(0)).clamp(min=1).unsqueeze(1).to(pooled.dtype)
+
+    def __getstate__(self):
+        # the optimizer is attached by compile() and is not part of the saved model
+        state = self.__dict__.copy()
+        state['optimizer'] = None
+        state['seen_ids'] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('seen_ids', None)
+        super(SparseUpdateEmbedding, self).__setstate__(state)
+
+
+class DynamicEmbedding(SparseUpdateEmbedding):
+    """Embedding table of raw 64-bit ids that are given rows on first sight and lose them when they expire.
+
+    A hash index maps every id to one of ``num_embeddings`` rows. In training, an id without a row is given
+    a free one, freshly initialized; when no row is free, the rows not looked up for ``expire_steps`` steps
+    (or ``expire_seconds`` seconds) are evicted first, then the least recently used ones, so memory stays
+    bounded however many ids the stream brings. The optimizer state of a reassigned row is reset along
+    with it, see ``optimizers``. Out of training, ids without a row are looked up as zero vectors.
+
+      Input shape
+        - LongTensor of arbitrary shape containing the raw ids to look up.
+
+      Output shape
+        - ``(*, embedding_dim)``, where ``*`` is the input shape.
+
+      Arguments
+        - **num_embeddings**: int. Number of rows, i.e. the most ids held at once.
+
+        - **embedding_dim**: int. Size of each embedding vector.
+
+        - **expire_steps**: int or None. Rows not looked up for more training steps are expired. Steps are
+          counted by ``next_step()``, which ``BaseModel.fit`` calls once per batch, however many features
+          look the table up.
+
+        - **expire_seconds**: float or None. Rows not looked up for more seconds are expired.
+
+        - **init_std**: float. Standard deviation of the initial value of a row.
+
+        - **sparse**: bool. Whether gradients w.r.t. the weight are sparse tensors.
+    """
+
+    # raw ids are mapped to rows first
+    _rows_are_ids = False
+
+    def __init__(self, num_embeddings, embedding_dim, expire_steps=None, expire_seconds=None, init_std=0.0001,
+                 sparse=False):
+        super(DynamicEmbedding, self).__init__(num_embeddings, embedding_dim, sparse=sparse)
+        self.expire_steps = expire_steps
+        self.expire_seconds = expire_seconds
+        self.init_std = init_std
+        # optimizers of weight, whose state is reset for reassigned rows; set by BaseModel.compile
+        self.optimizers = []
+        # raw id of every row and when it was last looked up, last_step is -1 for free rows
+        self.register_buffer('ids', torch.zeros(num_embeddings, dtype=torch.long))
+        self.register_buffer('last_step', torch.full((num_embeddings,), -1, dtype=torch.long))
+        self.register_buffer('last_time', torch.zeros(num_embeddings, dtype=torch.float64))
+        self._reset_index()
+
+    def _reset_index(self):
+        # raw id -> row
+        used = (self.last_step >= 0).nonzero().view(-1).tolist()
+        self.index = dict(zip(self.ids[used].tolist(), used))
+        self.step = int(self.last_step.max()) if len(used) else 0
+        # rows below num_used have been given out once, free_rows lists those given back since
+        self.num_used = used[-1] + 1 if len(used) else 0
+        self.free_rows = (self.last_step[:self.num_used] < 0).nonzero().view(-1).tolist()
+
+    def rows(self, input):
+        """Returns the rows of the raw ids ``input``, -1 for ids without a row, allocating rows in training."""
+        ids, inverse = torch.unique(input.reshape(-1), return_inverse=True)
+        keys = ids.tolist()
+        rows = [self.index.get(key, -1) for key in keys]
+        if self.training and torch.is_grad_enabled():
+            found = torch.tensor([row for row in rows if row >= 0], dtype=torch.long)
+            # expired rows still held by their id start over, and rows of this batch are not evicted below
+            expired = found[self._expired(found)]
+            self._touch(found)
+            new = [i for i, row in enumerate(rows) if row < 0]
+            for i, row in zip(new, self._allocate(len(new))):
+                self.index[keys[i]] = row
+                rows[i] = row
+            new_rows = torch.tensor([rows[i] for i in new], dtype=torch.long)
+            self.ids[new_rows.to(self.ids.device)] = ids[new].to(self.ids.device)
+            self._touch(new_rows)
+            reset = torch.cat([expired, new_rows])
+            if reset.numel():
+                self._reset_rows(reset)
+        rows = torch.tensor(rows, dtype=torch.long, device=input.device)
+        return rows[inverse].view(input.size())
+
+    def next_step(self):
+        """Starts a training step: rows looked up from now on are given the new step."""
+        self.step += 1
+
+    def forward(self, input):
+        rows = self.rows(input)
+        output = super(DynamicEmbedding, self).forward(rows.clamp(min=0))
+        if (rows < 0).any():
+            output = output * (rows >= 0).unsqueeze(-1).to(output.dtype)
+        return output
+
+    def evict(self, rows=None):
+        """Frees ``rows``, by default the expired ones, and returns how many were freed."""
+        if rows is None:
+            used = (self.last_step >= 0).nonzero().view(-1).cpu()
+            rows = used[self._expired(used)]
+        if rows.numel() == 0:
+            return 0
+        for key in self.ids[rows.to(self.ids.device)].tolist():
+            del self.index[key]
+        self.last_step[rows.to(self.last_step.device)] = -1
+        self.free_rows.extend(rows.tolist())
+        return rows.numel()
+
+    def _touch(self, rows):
+        self.last_step[rows.to(self.last_step.device)] = self.step
+        self.last_time[rows.to(self.last_time.device)] = time.time()
+
+    def _expired(self, rows):
+        # mask of the expired ones among used rows
+        expired = torch.zeros(rows.size(), dtype=torch.bool)
+        if self.expire_steps is not None:
+            expired |= (self.step - self.last_step[rows.to(self.last_step.device)].cpu()) > self.expire_steps
+        if self.expire_seconds is not None:
+            expired |= (time.time() - self.last_time[rows.to(self.last_time.device)].cpu()) > self.expire_seconds
+        return expired
+
+    def _allocate(self, n):
+        if len(self.free_rows) + self.num_embeddings - self.num_used < n:
+            self.evict()
+        if len(self.free_rows) + self.num_embeddings - self.num_used < n:
+            # least recently used rows first, rows of this batch were given the current step
+            used = (self.last_step >= 0) & (self.last_step < self.step)
+            candidates = used.nonzero().view(-1)
+            shortage = n - len(self.free_rows) - (self.num_embeddings - self.num_used)
+            if candidates.numel() < shortage:
+                raise RuntimeError("a batch holds more distinct ids than the %d rows of a DynamicEmbedding"
+                                   % self.num_embeddings)
+            order = self.last_step[candidates].argsort()[:shortage]
+            self.evict(candidates[order].cpu())
+        rows = self.free_rows[:n]
+        del self.free_rows[:n]
+        unused = n - len(rows)
+        rows += list(range(self.num_used, self.num_used + unused))
+        self.num_used += unused
+        return rows
+
+    def _reset_rows(self, rows):
+        with torch.no_grad():
+            device_rows = rows.to(self.weight.device)
+            self.weight.index_copy_(0, device_rows, self.weight.new_empty((rows.numel(), self.embedding_dim))
+                                    .normal_(0, self.init_std))
+        _reset_optimizer_state(self.optimizers, self.weight, rows)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super(DynamicEmbedding, self)._load_from_state_dict(*args, **kwargs)
+        self._reset_index()
+
+    def __getstate__(self):
+        state = super(DynamicEmbedding, self).__getstate__()
+        state['optimizers'] = []
+        return state
+
+
+class CachedEmbedding(SparseUpdateEmbedding):
+    """Embedding table whose rows live in host memory or a memory-mapped file, with a fixed-size fast tier.
+
+    Only ``cache_size`` rows are held in ``weight``, on the device of the module; the whole table is in
+    ``host_weight``, in pinned (or plain) host memory or in a file under ``storage_dir``. Looking up a row
+    that is not cached loads it into a free slot, or into the slot least recently used, whose row and
+    optimizer state (see ``optimizers``) are written back to the host tier first. The optimizer state of
+    rows in the host tier is kept there too, so a row coming back resumes where it left off.
+
+    Slots looked up since the last ``next_step()`` are not evicted, so the rows of one training step stay
+    put until their gradients are applied; ``BaseModel.fit`` calls it before every step and ``prefetch``es
+    the rows of the upcoming batch after it. Out of training, every lookup is a step of its own.
+
+      Input shape
+        - LongTensor of arbitrary shape containing the indices to extract.
+
+      Output shape
+        - ``(*, embedding_dim)``, where ``*`` is the input shape.
+
+      Arguments
+        - **num_embeddings**: int. Number of rows of the whole table.
+
+        - **embedding_dim**: int. Size of each embedding vector.
+
+        - **cache_size**: int. Number of rows of the fast tier.
+
+        - **storage**: str. Host tier, ``"pinned"`` (page-locked memory if CUDA is available), ``"memory"``
+          or ``"mmap"``.
+
+        - **storage_dir**: str. Directory of the files of ``storage="mmap"``.
+
+        - **init_std**: float. Standard deviation of the initial rows.
+
+        - **sparse**: bool. Whether gradients w.r.t. the weight are sparse tensors.
+    """
+
+    # ids are mapped to cache slots first
+    _rows_are_ids = False
+
+    def __init__(self, num_embeddings, embedding_dim, cache_size, storage='pinned', storage_dir=None,
+                 init_std=0.0001, sparse=False):
+        super(CachedEmbedding, self).__init__(cache_size, embedding_dim, sparse=sparse)
+        if storage not in ('pinned', 'memory', 'mmap'):
+            raise ValueError("storage must be 'pinned', 'memory' or 'mmap', got %s" % storage)
+        if storage == 'mmap' and storage_dir is None:
+            raise ValueError("storage='mmap' requires a storage_dir")
+        self.num_embeddings = num_embeddings
+        self.cache_size = cache_size
+        self.storage = storage
+        self.storage_dir = storage_dir
+        # optimizers of weight, whose state follows the rows between the tiers; set by BaseModel.compile
+        self.optimizers = []
+        self.host_weight = self._host_tensor('weight', (num_embeddings, embedding_dim), torch.float32)
+        nn.init.normal_(self.host_weight, mean=0, std=init_std)
+        # host copies of the optimizer state and whether a row has any, filled as rows are evicted
+        self.host_state = OrderedDict()
+        self.state_saved = self._host_tensor('state_saved', (num_embeddings,), torch.bool).fill_(False)
+        self.step = 0
+        self._clear()
+
+    def _host_tensor(self, name, size, dtype):
+        if self.storage == 'mmap':
+            if not os.path.isdir(self.storage_dir):
+                os.makedirs(self.storage_dir)
+            return torch.from_numpy(_memmap(os.path.join(self.storage_dir, name + '.bin'), size, dtype, 'w+'))
+        tensor = torch.empty(size, dtype=dtype)
+        if self.storage == 'pinned' and torch.cuda.is_available():
+            tensor = tensor.pin_memory()
+        return tensor
+
+    def _clear(self):
+        # empties the fast tier without writing it back
+        # row -> slot, and the row and the step of the last lookup of every slot, -1 for free slots
+        self.slots = {}
+        self.slot_rows = torch.full((self.cache_size,), -1, dtype=torch.long)
+        self.slot_step = torch.full((self.cache_size,), -1, dtype=torch.long)
+
+    def next_step(self):
+        """Starts a training step: the slots looked up before may be evicted again."""
+        self.step += 1
+
+    def prefetch(self, input):
+        """Loads the rows of ``input`` into the fast tier for the next step, evicting slots of the current one."""
+        rows = torch.unique(input.reshape(-1)).cpu()
+        self._load(rows, self.step + 1)
+
+    def forward(self, input):
+        if not (self.training and torch.is_grad_enabled()):
+            self.next_step()
+        rows, inverse = torch.unique(input.reshape(-1), return_inverse=True)
+        slots = self._load(rows.cpu(), self.step).to(input.device)
+        return super(CachedEmbedding, self).forward(slots[inverse].view(input.size()))
+
+    def _load(self, rows, step):
+        # Returns the slots of rows, loading the missing ones. Slots of a step before ``step`` may be evicted,
+        # the slots of rows are marked with ``step``.
+        slots = torch.tensor([self.slots.get(row, -1) for row in rows.tolist()], dtype=torch.long)
+        missing = (slots < 0).nonzero().view(-1)
+        self.slot_step[slots[slots >= 0]] = step
+        if missing.numel():
+            free = (self.slot_rows < 0).nonzero().view(-1)[:missing.numel()]
+            shortage = missing.numel() - free.numel()
+            if shortage > 0:
+                candidates = ((self.slot_rows >= 0) & (self.slot_step < step)).nonzero().view(-1)
+                if candidates.numel() < shortage:
+                    raise RuntimeError("the rows looked up in one step do not fit in the %d slots of a "
+                                       "CachedEmbedding, call next_step() between training steps" % self.cache_size)
+                victims = candidates[self.slot_step[candidates].argsort()[:shortage]]
+                self._write_back(victims)
+                for row in self.slot_rows[victims].tolist():
+                    del self.slots[row]
+                free = torch.cat([free, victims])
+            new_rows = rows[missing]
+            self._read(free, new_rows)
+            self.slot_rows[free] = new_rows
+            self.slot_step[free] = step
+            self.slots.update(zip(new_rows.tolist(), free.tolist()))
+            slots[missing] = free
+        return slots
+
+    def _slot_state(self):
+        # (name, tensor) of the optimizer state kept per slot
+        for i, optimizer in enumerate(self.optimizers):
+            for key, value in optimizer.state.get(self.weight, {}).items():
+                if torch.is_tensor(value) and value.dim() > 0 and value.size(0) == self.cache_size:
+                    yield '%d.%s' % (i, key), value
+
+    def _write_back(self, slots):
+        rows = self.slot_rows[slots]
+        self.host_weight[rows] = self.weight.detach().index_select(0, slots.to(self.weight.device)).cpu()
+        for name, value in self._slot_state():
+            if name not in self.host_state:
+                self.host_state[name] = self._host_tensor(
+                    'state.' + name, (self.num_embeddings,) + value.size()[1:], value.dtype)
+            self.host_state[name][rows] = value.index_select(0, slots.to(value.device)).cpu()
+        self.state_saved[rows] = True
+
+    def _read(self, slots, rows):
+        with torch.no_grad():
+            self.weight.index_copy_(0, slots.to(self.weight.device), self.host_weight[rows].to(self.weight.device))
+        _reset_optimizer_state(self.optimizers, self.weight, slots)
+        saved = self.state_saved[rows]
+        if bool(saved.any()):
+            for name, value in self._slot_state():
+                if name in self.host_state:
+                    value.index_copy_(0, slots[saved].to(value.device),
+                                      self.host_state[name][rows[saved]].to(value.device))
+
+    def flush(self):
+        """Writes every cached row and its optimizer state back to the host tier, the rows stay cached."""
+        self._write_back((self.slot_rows >= 0).nonzero().view(-1))
+
+    def full_weight(self):
+        """Returns the whole table, i.e. ``host_weight`` after a ``flush``."""
+        self.flush()
+        return self.host_weight
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        # the whole table and the host copy of the optimizer state, not the fast tier
+        destination[prefix + 'weight'] = self.full_weight()
+        destination[prefix + 'state_saved'] = self.state_saved
+        for name, value in self.host_state.items():
+            destination[prefix + 'state.' + name] = value
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        if prefix + 'weight' not in state_dict:
+            missing_keys.append(prefix + 'weight')
+            return
+        self.host_weight.copy_(state_dict[prefix + 'weight'])
+        self.state_saved.copy_(state_dict.get(prefix + 'state_saved', self.state_saved.new_zeros(())))
+        for key, value in state_dict.items():
+            if key.startswith(prefix + 'state.'):
+                name = key[len(prefix + 'state.'):]
+                if name not in self.host_state:
+                    self.host_state[name] = self._host_tensor('state.' + name, value.size(), value.dtype)
+                self.host_state[name].copy_(value)
+        self._clear()
+
+    def __getstate__(self):
+        state = super(CachedEmbedding, self).__getstate__()
+        state['optimizers'] = []
+        return state
+
+
+class MmapEmbedding(SparseUpdateEmbedding):
+    """Embedding table stored in a memory-mapped file, for tables larger than memory.
+
+    ``weight`` is a view of the file ``weight.bin`` under ``path``: lookups gather their rows through the
+    mapping and sparse optimizer updates scatter into it, so only the pages of the rows in use are held in
+    memory and the operating system writes the changed ones back. A file that already exists is opened as it
+    is, which is how training resumes. With ``mmap_state=True``, the row-indexed optimizer state of ``weight``
+    (e.g. the Adagrad accumulator, see ``optimizers``) is mapped from files next to it: the optimizers allocate
+    it through the ``state_allocator`` of ``weight``, so it is never held in memory as a whole.
+
+    The files are the checkpoint of the table: ``BaseModel.save_checkpoint`` only ``flush``es them and leaves
+    the table out, so a checkpoint refers to the files of its tables instead of holding a copy of them.
+
+    The table stays in host memory whatever device the model is moved to, the looked-up rows are copied to the
+    device of the input. It should get sparse gradients (``sparse=True`` or an optimizer applied in backward),
+    a dense gradient is as large as the table.
+
+      Input shape
+        - LongTensor of arbitrary shape containing the indices to extract.
+
+      Output shape
+        - ``(*, embedding_dim)``, where ``*`` is the input shape.
+
+      Arguments
+        - **num_embeddings**: int. Number of rows of the table.
+
+        - **embedding_dim**: int. Size of each embedding vector.
+
+        - **path**: str. Directory of the files of the table.
+
+        - **mmap_state**: bool. Whether the optimizer state of the table is memory-mapped too.
+
+        - **init_std**: float. Standard deviation of the initial rows of a new table.
+
+        - **sparse**: bool. Whether gradients w.r.t. the weight are sparse tensors.
+    """
+
+    # lookups go through forward, which gathers the rows on the CPU
+    _rows_are_ids = False
+
+    def __init__(self, num_embeddings, embedding_dim, path, mmap_state=True, init_std=0.0001, sparse=False):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        filename = os.path.join(path, 'weight.bin')
+        opened = os.path.exists(filename)
+        array = _memmap(filename, (num_embeddings, embedding_dim), torch.float32, 'r+' if opened else 'w+')
+        super(MmapEmbedding, self).__init__(num_embeddings, embedding_dim, sparse=sparse,
+                                            _weight=torch.from_numpy(array))
+        self.path = path
+        self.mmap_state = mmap_state
+        # whether the files were there already, then they hold the table and its state
+        self.opened = opened
+        # optimizers of weight, whose mapped state map_state() puts back; set by BaseModel.compile
+        self.optimizers = []
+        # '<optimizer class>.<state key>' -> mapped state tensor
+        self.state_files = OrderedDict()
+        self.arrays = [array]
+        if not opened:
+            nn.init.normal_(self.weight.data, mean=0, std=init_std)
+        self.weight.state_allocator = self.allocate_state
+
+    def forward(self, input):
+        return super(MmapEmbedding, self).forward(input.cpu()).to(input.device)
+
+    def allocate_state(self, optimizer, key, size, dtype, value):
+        """Returns the optimizer state ``key`` of ``weight`` mapped from a file under ``path``, or None if it is not
+        row-indexed.
+
+        A new file is filled with ``value``, the file of an opened table is mapped as it is, and the state mapped
+        already (e.g. by a previous ``compile``) is returned again, so training continues from it.
+        """
+        if not self.mmap_state or len(size) == 0 or size[0] != self.num_embeddings:
+            return None
+        name = '%s.%s' % (type(optimizer).__name__.lower(), key)
+        if name in self.state_files:
+            return self.state_files[name]
+        filename = os.path.join(self.path, 'state.%s.bin' % name)
+        reopen = self.opened and os.path.exists(filename)
+        array = _memmap(filename, size, dtype, 'r+' if reopen else 'w+')
+        mapped = torch.from_numpy(array)
+        if not reopen and value != 0:
+            # a new file is extended with zeros
+            mapped.fill_(value)
+        self.state_files[name] = mapped
+        self.arrays.append(array)
+        return mapped
+
+    def map_state(self):
+        """Puts the mapped optimizer state of ``weight`` back in the state of ``optimizers``.
+
+        Called by ``BaseModel.compile`` and ``BaseModel.load_checkpoint``, whose ``Optimizer.load_state_dict``
+        replaces the state by the checkpoint, which leaves the mapped tensors out.
+        """
+        for optimizer in self.optimizers:
+            state = optimizer.state[self.weight]
+            prefix = type(optimizer).__name__.lower() + '.'
+            for name, mapped in self.state_files.items():
+                if name.startswith(prefix):
+                    state[name[len(prefix):]] = mapped
+
+    def flush(self):
+        """Writes the changed pages of the table and of its mapped state to the files."""
+        for array in self.arrays:
+            array.flush()
+
+    def _apply(self, fn):
+        # the table stays in its file, e.g. model.to('cuda') or share_memory() leave it in place
+        return self
+
+    def __getstate__(self):
+        state = super(MmapEmbedding, self).__getstate__()
+        state['optimizers'] = []
+        state['arrays'] = []
+        return state
+
+
+class QREmbedding(nn.Module):
+    """Compositional embedding built from a quotient and a remainder table.
+
+    Id ``i`` is looked up as the combination of row ``i // num_collisions`` of the quotient table and row
+    ``i % num_collisions`` of the remainder table, so ``num_embeddings`` ids take about
+    ``num_embeddings / num_collisions + num_collisions`` rows instead of ``num_embeddings``, and unlike
+    hashing no two ids share both rows. See `Compositional Embeddings Using Complementary Partitions for
+    Memory-Efficient Recommendation Systems <https://arxiv.org/abs/1909.02107>`_.
+
+      Input shape
+        - LongTensor of arbitrary shape containing the indices to extract.
+
+      Output shape
+        - ``(*, embedding_dim)``, where ``*`` is the input shape.
+
+      Arguments
+        - **num_embeddings**: int. Number of ids.
+
+        - **embedding_dim**: int. Size of each embedding vector.
+
+        - **num_collisions**: int. Number of rows of the remainder table, i.e. of ids sharing a quotient row.
+
+        - **operation**: str. How the two rows are combined, ``"mult"`` (element-wise product), ``"add"`` or
+          ``"concat"`` (each table then holds half of the dimensions).
+
+        - **init_std**: float. Standard deviation of the initial quotient rows. The remainder rows start at
+          one for ``"mult"`` and zero for ``"add"``, so the initial embeddings are the quotient rows.
+
+        - **sparse**: bool. Whether gradients w.r.t. the weights are sparse tensors.
+    """
+
+    def __init__(self, num_embeddings, embedding_dim, num_collisions=4, operation='mult', init_std=0.0001,
+                 sparse=False):
+        super(QREmbedding, self).__init__()
+        if operation not in ('mult', 'add', 'concat'):
+            raise ValueError("operation must be 'mult', 'add' or 'concat', got %s" % operation)
+        if operation == 'concat' and embedding_dim < 2:
+            raise ValueError("operation='concat' needs an embedding_dim of at least 2")
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.num_collisions = num_collisions
+        self.operation = operation
+        if operation == 'concat':
+            dims = (embedding_dim // 2, embedding_dim - embedding_dim // 2)
+        else:
+            dims = (embedding_dim, embedding_dim)
+        self.quotient = SparseUpdateEmbedding((num_embeddings - 1) // num_collisions + 1, dims[0], sparse=sparse)
+        self.remainder = SparseUpdateEmbedding(num_collisions, dims[1], sparse=sparse)
+        nn.init.normal_(self.quotient.weight, mean=0, std=init_std)
+        if operation == 'mult':
+            nn.init.ones_(self.remainder.weight)
+        elif operation == 'add':
+            nn.init.zeros_(self.remainder.weight)
+        else:
+            nn.init.normal_(self.remainder.weight, mean=0, std=init_std)
+
+    def forward(self, input):
+        quotient = self.quotient(input // self.num_collisions)
+        remainder = self.remainder(input % self.num_collisions)
+        if self.operation == 'mult':
+            return quotient * remainder
+        if self.operation == 'add':
+            return quotient + remainder
+        return torch.cat([quotient, remainder], dim=-1)
+
+
+class AdmissionEmbedding(nn.Module):
+    """Embedding table in front of which ids are admitted only once they have been seen ``min_count`` times.
+
+    The number of times every id has been looked up in training is estimated by a count-min sketch of
+    ``depth`` rows of ``width`` counters. Until an id reaches ``min_count``, it is looked up as one shared
+    ``default`` row and never reaches ``embedding``, so the long tail of ids seen once or twice neither
+    takes a row (of a ``DynamicEmbedding``) nor trains one (of a hashed table). The sketch only
+    overestimates counts, so no frequent id is kept out.
+
+      Input shape
+        - LongTensor of arbitrary shape containing the indices to extract.
+
+      Output shape
+        - ``(*, embedding_dim)``, where ``*`` is the input shape.
+
+      Arguments
+        - **embedding**: the table the admitted ids are looked up in, e.g. a ``DynamicEmbedding``.
+
+        - **min_count**: int. Number of lookups after which an id is admitted.
+
+        - **width**: int. Number of counters per row of the sketch.
+
+        - **depth**: int. Number of rows of the sketch, i.e. of hash functions.
+
+        - **seed**: int. Seed of the hash functions.
+    """
+
+    def __init__(self, embedding, min_count, width=2 ** 20, depth=4, seed=1024):
+        super(AdmissionEmbedding, self).__init__()
+        self.embedding = embedding
+        self.min_count = min_count
+        self.default = nn.Parameter(torch.zeros(embedding.embedding_dim))
+        generator = torch.Generator().manual_seed(seed)
+        # odd multipliers and offsets of the hash functions, one per row of the sketch
+        self.register_buffer('hash_a', torch.randint(1, 2 ** 62, (depth, 1), generator=generator) * 2 + 1)
+        self.register_buffer('hash_b', torch.randint(0, 2 ** 62, (depth, 1), generator=generator))
+        if width > 2 ** 31:
+            raise ValueError("width must be at most 2 ** 31, got {}".format(width))
+        self.register_buffer('counts', torch.zeros(depth, width, dtype=torch.int32))
+
+    @property
+    def weight(self):
+        return self.embedding.weight
+
+    @property
+    def num_embeddings(self):
+        return self.embedding.num_embeddings
+
+    @property
+    def embedding_dim(self):
+        return self.embedding.embedding_dim
+
+    def buckets(self, ids):
+        """Returns the ``(depth, len(ids))`` counters the 1-D ids ``ids`` are counted in.
+
+        Multiply-shift hashing: the high 32 bits of ``a * id + b`` modulo ``2 ** 64`` (wrapping int64
+        arithmetic), scaled to ``width`` by another multiply and shift.
+        """
+        high = ((ids.unsqueeze(0) * self.hash_a + self.hash_b) >> 32) & 0xFFFFFFFF
+        return (high * self.counts.size(1)) >> 32
+
+    def admitted(self, input):
+        """Returns whether the ids ``input`` are admitted, counting them first in training."""
+        ids, inverse, counts = torch.unique(input.reshape(-1), return_inverse=True, return_counts=True)
+        buckets = self.buckets(ids)
+        if self.training and torch.is_grad_enabled():
+            for row, row_buckets in zip(self.counts, buckets):
+                row.index_add_(0, row_buckets, counts.to(row.dtype))
+        estimate = self.counts.gather(1, buckets).min(0)[0]
+        return (estimate >= self.min_count)[inverse].view(input.size())
+
+    def forward(self, input):
+        admitted = self.admitted(input)
+        if bool(admitted.all()):
+            return self.embedding(input)
+        output = self.default.expand(input.size() + self.default.size()).clone()
+        if bool(admitted.any()):
+            output[admitted] = self.embedding(input[admitted])
+        return output
+
+
+class FusedEmbedding(nn.Module):
+    """Deep embedding and linear weight of a feature stored in one table.
+
+    Every row of ``embedding`` holds the ``embedding_dim`` columns of the deep embedding followed by the 1-dim
+    weight of the linear part. The deep part looks the feature up through this module and the linear part
+    through ``linear_table()``; whichever comes first gathers the rows of the batch, and the other one takes
+    its columns of the same rows if it looks up the same ids. A feature then costs one gather, and one table
+    for the sparse optimizer to update, per step instead of two.
+
+      Input shape
+        - LongTensor of arbitrary shape containing the indices to extract.
+
+      Output shape
+        - ``(*, embedding_dim)``, where ``*`` is the input shape.
+
+      Arguments
+        - **embedding**: the table of ``embedding_dim + 1`` columns, e.g. a ``SparseUpdateEmbedding``.
+    """
+
+    def __init__(self, embedding):
+        super(FusedEmbedding, self).__init__()
+        self.embedding = embedding
+        # (ids, rows, part still to take them) of the last gather
+        self.pending = None
+
+    @property
+    def weight(self):
+        return self.embedding.weight
+
+    @property
+    def num_embeddings(self):
+        return self.embedding.num_embeddings
+
+    @property
+    def embedding_dim(self):
+        return self.embedding.embedding_dim - 1
+
+    def lookup(self, input, part):
+        """Returns the whole rows of ``input`` for the ``"deep"`` or the ``"linear"`` part."""
+        pending, self.pending = self.pending, None
+        if pending is not None and pending[2] == part and pending[0].size() == input.size() \
+                and torch.equal(pending[0], input):
+            return pending[1]
+        rows = self.embedding(input)
+        self.pending = (input, rows, 'linear' if part == 'deep' else 'deep')
+        return rows
+
+    def linear_table(self):
+        """Returns the linear weights, i.e. the last column, looked up like an ``nn.Embedding``."""
+        return _FusedLinearTable(self)
+
+    def forward(self, input):
+        return self.lookup(input, 'deep')[..., :self.embedding_dim]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pending'] = None
+        return state
+
+
+class EmbeddingArena(nn.Module):
+    """Embedding tables of the same dimension stored in one backing tensor.
+
+    Every table is a block of rows of ``weight[str(embedding_dim)]`` starting at its own offset. A batch of
+    lookups over many features is then one gather, and the sparse optimizer processes one parameter (and one
+    optimizer state) per embedding dimension instead of one per table.
+
+    ``arena[embedding_name]`` is a callable lookup into one table, so an arena can be used wherever the
+    ``nn.ModuleDict`` returned by ``create_embedding_matrix`` is expected.
+
+      Input shape
+        - LongTensor with shape ``(batch_size, len(names))``, column ``i`` holding ids of table ``names[i]``.
+
+      Output shape
+        - A list of 3D tensors with shape ``(batch_size, 1, embedding_dim)``, one per name.
+
+      Arguments
+        - **tables**: list of ``(embedding_name, vocabulary_size, embedding_dim)``.
+
+        - **sparse**: bool. Whether gradients w.r.t. the weights are sparse tensors.
+    """
+
+    def __init__(self, tables, sparse=False):
+        super(EmbeddingArena, self).__init__()
+        self.sparse = sparse
+        self.optimizer = None
+        self.seen_ids = None
+        # embedding_name -> (weight key, row offset, vocabulary_size)
+        self.offsets = OrderedDict()
+        num_rows = OrderedDict()
+        for name, vocabulary_size, embedding_dim in tables:
+            key = str(embedding_dim)
+            self.offsets[name] = (key, num_rows.get(key, 0), vocabulary_size)
+            num_rows[key] = num_rows.get(key, 0) + vocabulary_size
+        self.weight = nn.ParameterDict(
+            OrderedDict((key, nn.Parameter(torch.Tensor(rows, int(key)))) for key, rows in num_rows.items()))
+
+    def forward(self, input, names):
+        keys = [self.offsets[name][0] for name in names]
+        outputs = [None] * len(names)
+        for key in OrderedDict.fromkeys(keys):
+            columns = [i for i, k in enumerate(keys) if k == key]
+            offsets = input.new_tensor([self.offsets[names[i]][1] for i in columns])
+            ids = input if len(columns) == len(names) else input[:, columns]
+            embeddings = self.lookup(ids + offsets, key)
+            for i, embedding in zip(columns, embeddings.split(1, dim=1)):
+                outputs[i] = embedding
+        return outputs
+
+    def lookup(self, input, key):
+        # ``input`` holds row ids of ``weight[key]``, i.e. with table offsets already added
+        if self.seen_ids is not None:
+            self.seen_ids.append((key, input))
+        weight = self.weight[key]
+        if self.optimizer is not None and self.training and torch.is_grad_enabled() and weight.requires_grad:
+            return _EmbeddingInBackward.apply(input, weight, None, self.optimizer)
+        return F.embedding(input, weight, sparse=self.sparse)
+
+    def seen_embeddings(self):
+        """Returns ``[(weight, rows)]``, ``rows`` holding every row of ``weight`` looked up since ``seen_ids``
+        was set to a list once, and stops recording."""
+        seen_ids, self.seen_ids = self.seen_ids, None
+        if not seen_ids:
+            return []
+        seen = []
+        for key in OrderedDict.fromkeys(key for key, _ in seen_ids):
+            ids = torch.cat([ids.reshape(-1) for k, ids in seen_ids if k == key]).unique()
+            seen.append((self.weight[key], self.lookup(ids, key)))
+        return seen
+
+    def table_weight(self, name):
+        key, offset, vocabulary_size = self.offsets[name]
+        return self.weight[key].narrow(0, offset, vocabulary_size)
+
+    def __getitem__(self, name):
+        return _ArenaTable(self, name)
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def values(self):
+        return [self[name] for name in self.offsets]
+
+    def items(self):
+        return [(name, self[name]) for name in self.offsets]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['optimizer'] = None
+        state['seen_ids'] = None
+        return state
+
+
+class _ArenaTable(object):
+    # One table of an EmbeddingArena, looked up like an nn.Embedding.
+
+    def __init__(self, arena, name):
+        self.arena = arena
+        self.name = name
+
+    @property
+    def weight(self):
+        return self.arena.table_weight(self.name)
+
+    @property
+    def num_embeddings(self):
+        return self.arena.offsets[self.name][2]
+
+    @property
+    def embedding_dim(self):
+        return int(self.arena.offsets[self.name][0])
+
+    def __call__(self, input):
+        key, offset, _ = self.arena.offsets[self.name]
+        return self.arena.lookup(input + offset, key)
+
+
+class _FusedLinearTable(object):
+    # The linear weights of a FusedEmbedding, looked up like an nn.Embedding. It is not a module so that the
+    # table is only registered once, in the deep part.
+
+    def __init__(self, fused):
+        self.fused = fused
+
+    @property
+    def num_embeddings(self):
+        return self.fused.num_embeddings
+
+    @property
+    def embedding_dim(self):
+        return 1
+
+    def __call__(self, input):
+        return self.fused.lookup(input, 'linear')[..., self.fused.embedding_dim:]
+
+
+class CompactEmbedding(nn.Module):
+    """Read-only embedding table that stores only its non-zero rows.
+
+    Ids that are not stored are looked up as zero vectors. Built by ``Linear.compact()`` from tables whose
+    weights were driven to exactly zero, e.g. by ``Ftrl(l1=...)``.
+
+      Input shape
+        - LongTensor of arbitrary shape containing the indices to extract.
+
+      Output shape
+        - ``(*, embedding_dim)``, where ``*`` is the input shape.
+
+      Arguments
+        - **ids**: LongTensor. Ids of the stored rows.
+
+        - **weight**: 2D tensor. ``weight[i]`` is the row of ``ids[i]``.
+
+        - **num_embeddings**: int. Vocabulary size of the original table.
+    """
+
+    def __init__(self, ids, weight, num_embeddings):
+        super(CompactEmbedding, self).__init__()
+        ids, order = ids.sort()
+        self.register_buffer('ids', ids)
+        self.register_buffer('weight', weight.index_select(0, order))
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = weight.size(1)
+
+    @classmethod
+    def from_weight(cls, weight):
+        """Builds a ``CompactEmbedding`` from the non-zero rows of ``weight``."""
+        weight = weight.detach()
+        ids = weight.ne(0).any(1).nonzero().view(-1)
+        return cls(ids, weight.index_select(0, ids).clone(), weight.size(0))
+
+    def forward(self, input):
+        output = self.weight.new_zeros(input.size() + (self.embedding_dim,))
+        if self.ids.numel() == 0:
+            return output
+        position = _searchsorted(self.ids, input).clamp_(max=self.ids.numel() - 1)
+        found = self.ids[position] == input
+        output[found] = self.weight[position[found]]
+        return output
+
+
+class QuantizedEmbedding(nn.Module):
+    """Read-only embedding table stored row-wise in int8 or fp16, dequantized after the rows are gathered.
+
+    With ``dtype="int8"`` every row is stored as uint8 codes with its own fp32 ``scale`` and ``bias``, row
+    ``i`` being ``codes[i] * scale[i] + bias[i]``; a row of ``embedding_dim`` floats then takes
+    ``embedding_dim + 8`` bytes instead of ``4 * embedding_dim``. The scale of rows initialized with a small
+    ``init_std`` is below the normal range of fp16, so it is kept in fp32. With ``dtype="fp16"`` the rows are stored
+    in half precision. Built by ``BaseModel.quantize_embeddings()`` for prediction and serving.
+
+      Input shape
+        - LongTensor of arbitrary shape containing the indices to extract.
+
+      Output shape
+        - ``(*, embedding_dim)``, where ``*`` is the input shape.
+
+      Arguments
+        - **weight**: 2D tensor. Stored rows, uint8 codes for int8 and fp16 rows for fp16.
+
+        - **scale**: 1D fp32 tensor or None. Scale of every row, int8 only.
+
+        - **bias**: 1D fp32 tensor or None. Bias of every row, int8 only.
+    """
+
+    def __init__(self, weight, scale=None, bias=None):
+        super(QuantizedEmbedding, self).__init__()
+        self.register_buffer('weight', weight)
+        self.register_buffer('scale', scale)
+        self.register_buffer('bias', bias)
+        self.num_embeddings, self.embedding_dim = weight.size()
+
+    @classmethod
+    def from_weight(cls, weight, dtype='int8'):
+        """Quantizes the rows of ``weight`` to ``dtype``, ``"int8"`` or ``"fp16"``."""
+        weight = weight.detach().float()
+        if dtype == 'fp16':
+            return cls(weight.half())
+        if dtype != 'int8':
+            raise ValueError("dtype must be 'int8' or 'fp16', got %s" % dtype)
+        low = weight.min(1)[0]
+        high = weight.max(1)[0]
+        scale = (high - low).div_(255)
+        bias = low
+        # rows with a single value keep scale 0
+        codes = (weight - bias.unsqueeze(1)).div_(scale.clamp(min=1e-30).unsqueeze(1))
+        return cls(codes.round_().clamp_(0, 255).to(torch.uint8), scale, bias)
+
+    def forward(self, input):
+        index = input.reshape(-1)
+        rows = self.weight.index_select(0, index).float()
+        if self.scale is not None:
+            rows = rows.mul_(self.scale.index_select(0, index).unsqueeze(1)).add_(
+                self.bias.index_select(0, index).unsqueeze(1))
+        return rows.view(input.size() + (self.embedding_dim,))
+
+
+def _reset_optimizer_state(optimizers, weight, rows):
+    # resets the optimizer state of some rows of weight to its initial value
+    for optimizer in optimizers:
+        state = optimizer.state.get(weight)
+        if not state:
+            continue
+        if hasattr(optimizer, 'reset_state'):
+            optimizer.reset_state(weight, rows.to(weight.device))
+            continue
+        # e.g. the moments of torch.optim.Adam, which start at zero
+        for value in state.values():
+            if torch.is_tensor(value) and value.dim() > 0 and value.size(0) == weight.size(0):
+                value.index_fill_(0, rows.to(value.device), 0)
+
+
+def _memmap(filename, size, dtype, mode):
+    # numpy memory map of the file filename holding a tensor of the given size and torch dtype
+    numpy_dtype = np.bool_ if dtype == torch.bool else torch.empty(0, dtype=dtype).numpy().dtype
+    if mode == 'r+' and os.path.getsize(filename) != int(np.prod(size)) * np.dtype(numpy_dtype).itemsize:
+        raise ValueError("%s does not hold a table of size %s" % (filename, tuple(size)))
+    return np.memmap(filename, dtype=numpy_dtype, mode=mode, shape=tuple(size))
+
+
+def _searchsorted(sorted_sequence, input):
+    # torch.searchsorted only exists from torch 1.6 on
+    if hasattr(torch, 'searchsorted'):
+        return torch.searchsorted(sorted_sequence, input.contiguous())
+    position = np.searchsorted(sorted_sequence.cpu().numpy(), input.cpu().numpy())
+    return torch.from_numpy(position).to(input.device)
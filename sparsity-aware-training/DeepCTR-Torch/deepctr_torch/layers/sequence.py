@@ -76,6 +76,76 @@ class SequencePoolingLayer(nn.Module):
         return hist
 
 
+def bag_sizes(offsets, num_ids):
+    """Returns the number of ids of every bag, ``offsets`` holding where each bag starts among ``num_ids`` ids."""
+    return torch.cat([offsets[1:], offsets.new_tensor([num_ids])]) - offsets
+
+
+def pool_bags(embeddings, offsets, mode='mean', per_sample_weights=None):
+    """Pools the rows of consecutive bags of ids, like ``nn.EmbeddingBag`` does with the ids themselves.
+
+    Used for the tables that cannot pool their rows in ``F.embedding_bag``, see ``SparseUpdateEmbedding.bag``.
+
+      Input shape
+        - embeddings is a 2D tensor with shape ``(N, embedding_size)``, the rows of the ids of all bags.
+
+        - offsets is a 1D LongTensor with shape ``(batch_size,)``, where each bag starts in ``embeddings``.
+
+        - per_sample_weights is None or a 1D tensor with shape ``(N,)``, scaling the rows before they are pooled.
+
+      Output shape
+        - 2D tensor with shape ``(batch_size, embedding_size)``, zeros for empty bags.
+
+      Arguments
+        - **mode**: str. Pooling operation to be used, can be sum, mean or max. A weighted mean divides the
+          weighted sum by the number of ids of the bag.
+    """
+    if mode not in ['sum', 'mean', 'max']:
+        raise ValueError('parameter mode should in [sum, mean, max]')
+    num_bags = offsets.size(0)
+    sizes = bag_sizes(offsets, embeddings.size(0))
+    if per_sample_weights is not None:
+        embeddings = embeddings * per_sample_weights.unsqueeze(1).to(embeddings.dtype)
+    if embeddings.size(0) == 0:
+        return embeddings.new_zeros((num_bags, embeddings.size(1)))
+    if mode == 'max':
+        padded = pad_bags(embeddings, offsets, value=float('-inf'))
+        return padded.max(dim=1)[0].masked_fill((sizes == 0).unsqueeze(1), 0)
+    bags = torch.arange(num_bags, device=offsets.device).repeat_interleave(sizes)
+    pooled = embeddings.new_zeros((num_bags, embeddings.size(1))).index_add(0, bags, embeddings)
+    if mode == 'mean':
+        pooled = pooled / sizes.clamp(min=1).unsqueeze(1).to(pooled.dtype)
+    return pooled
+
+
+def pad_bags(embeddings, offsets, maxlen=None, value=0):
+    """Lays the rows of consecutive bags of ids out as padded sequences, for the layers that need them.
+
+      Input shape
+        - embeddings is a 2D tensor with shape ``(N, embedding_size)``, the rows of the ids of all bags.
+
+        - offsets is a 1D LongTensor with shape ``(batch_size,)``, where each bag starts in ``embeddings``.
+
+      Output shape
+        - 3D tensor with shape ``(batch_size, maxlen, embedding_size)``, bags longer than ``maxlen`` being
+          truncated and shorter ones padded with ``value``.
+
+      Arguments
+        - **maxlen**: int or None. Length of the sequences, by default the size of the largest bag.
+
+        - **value**: float. Value of the padding.
+    """
+    num_bags = offsets.size(0)
+    sizes = bag_sizes(offsets, embeddings.size(0))
+    if maxlen is None:
+        maxlen = int(sizes.max()) if num_bags else 0
+    padded = embeddings.new_full((num_bags, maxlen, embeddings.size(1)), value)
+    bags = torch.arange(num_bags, device=offsets.device).repeat_interleave(sizes)
+    positions = torch.arange(embeddings.size(0), device=offsets.device) - offsets[bags]
+    kept = positions < maxlen
+    return padded.index_put((bags[kept], positions[kept]), embeddings[kept])
+
+
 class AttentionSequencePoolingLayer(nn.Module):
     """The Attentional sequence pooling operation used in DIN & DIEN.
 
@@ -5,9 +5,17 @@ Author:
     Weichen Shen,wcshen1994@163.com
 
 """
+import multiprocessing
+import os
+
 import numpy as np
 import torch
 
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
 
 def concat_fun(inputs, axis=-1):
     if len(inputs) == 1:
@@ -68,3 +76,300 @@ def slice_arrays(arrays, start=None, stop=None):
             return arrays[start:stop]
         else:
             return [None]
+
+
+class Hash(object):
+    """
+    hash the input to [0,num_buckets)
+    if mask_zero = True,0 or 0.0 will be set to 0,other value will be set in range[1,num_buckets)
+
+    Works on numpy arrays of ints, floats or strings before they are batched into a tensor, and gives the same
+    buckets as ``tf.strings.to_hash_bucket_fast`` (FarmHash ``Fingerprint64`` of the string form) in the
+    tensorflow version. Every distinct value of an array is hashed once.
+    """
+
+    def __init__(self, num_buckets, mask_zero=False):
+        self.num_buckets = num_buckets
+        self.mask_zero = mask_zero
+
+    def __call__(self, x):
+        x = np.asarray(x)
+        values, inverse = np.unique(x, return_inverse=True)
+        strings = [_as_string(value) for value in values]
+        num_buckets = self.num_buckets - 1 if self.mask_zero else self.num_buckets
+        hash_x = np.array([_fingerprint64(s) % num_buckets for s in strings], dtype=np.int64)
+        if self.mask_zero:
+            mask = np.array([s not in (b"0", b"0.0") for s in strings], dtype=np.int64)
+            hash_x = (hash_x + 1) * mask
+        return hash_x[inverse].reshape(x.shape)
+
+
+def _as_string(value):
+    # the string form tf.as_string gives to a value
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    if isinstance(value, (float, np.floating)):
+        return ('%f' % value).encode('utf-8')
+    return str(int(value)).encode('utf-8')
+
+
+class CategoryEncoder(object):
+    """
+    encode categorical columns as ids in [0,vocabulary_size), replacing one LabelEncoder per column
+
+    The vocabulary of a column is found with a hash table (``pandas.factorize``, ``numpy.unique`` without
+    pandas) instead of sorting it, and the columns are encoded in ``workers`` processes, forked so that they
+    read the columns copy-on-write instead of receiving a pickled copy (without fork, they are encoded in this
+    process). Columns that already hold ids, i.e. every integer of [0,max] and nothing else, keep them. Values
+    that are missing, or not in a vocabulary loaded from ``path``, get the last id, vocabulary_size - 1.
+
+    With ``path``, the vocabularies are saved there as one ``<column>.npy`` file each; ``fit_transform`` then
+    loads the vocabularies of the columns that have one instead of fitting them again, so that later runs and
+    the data to predict on get the same ids.
+    """
+
+    def __init__(self, path=None, workers=1):
+        self.path = path
+        self.workers = workers
+        # column name -> array of the values of ids 0,1,... or a 0-d array with the size of an id column
+        self.vocabularies = {}
+
+    def fit_transform(self, data, columns):
+        """Returns {column: ids} for the columns of ``data`` (a DataFrame or a dict of arrays)."""
+        if self.path is not None:
+            for column in columns:
+                file = self._file(column)
+                if column not in self.vocabularies and os.path.exists(file):
+                    self.vocabularies[column] = np.load(file, allow_pickle=True)
+        ids = self._encode(data, columns)
+        if self.path is not None:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            for column in columns:
+                np.save(self._file(column), self.vocabularies[column], allow_pickle=True)
+        return ids
+
+    def transform(self, data, columns):
+        """Returns {column: ids} for the columns of ``data``, with the vocabularies already fitted or loaded."""
+        missing = [column for column in columns if column not in self.vocabularies]
+        if missing:
+            raise ValueError("no vocabulary for the columns {}".format(missing))
+        return self._encode(data, columns)
+
+    def vocabulary_size(self, column):
+        vocabulary = self.vocabularies[column]
+        return (int(vocabulary) if vocabulary.ndim == 0 else len(vocabulary)) + 1
+
+    def _file(self, column):
+        return os.path.join(self.path, column + '.npy')
+
+    def _encode(self, data, columns):
+        global _encoding
+        if self.workers > 1 and len(columns) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            # the forked workers find the columns here, only the names are sent to them
+            _encoding = (data, self.vocabularies)
+            pool = multiprocessing.get_context('fork').Pool(min(self.workers, len(columns)))
+            try:
+                results = pool.map(_encode_named_column, columns)
+            finally:
+                pool.close()
+                pool.join()
+                _encoding = None
+        else:
+            results = [_encode_column((np.asarray(data[column]), self.vocabularies.get(column)))
+                       for column in columns]
+        ids = {}
+        for column, (column_ids, vocabulary) in zip(columns, results):
+            ids[column] = column_ids
+            self.vocabularies[column] = vocabulary
+        return ids
+
+
+# (data, vocabularies) of the columns the forked workers of CategoryEncoder encode
+_encoding = None
+
+
+def _encode_named_column(column):
+    data, vocabularies = _encoding
+    return _encode_column((np.asarray(data[column]), vocabularies.get(column)))
+
+
+def _encode_column(task):
+    # ids of one column and its vocabulary, fitted if it is None; runs in the processes of CategoryEncoder
+    values, vocabulary = task
+    if vocabulary is None:
+        # a column of ids holds every id up to its largest one, checked only when there can be that many
+        if values.dtype.kind in 'iu' and len(values) and 0 <= values.min() and values.max() < len(values) \
+                and np.bincount(values).all():
+            vocabulary = np.array(int(values.max()) + 1)
+        else:
+            if pd is not None:
+                codes, vocabulary = pd.factorize(values)
+            else:
+                # numbered by first occurrence, like pandas.factorize
+                vocabulary, first, codes = np.unique(values, return_index=True, return_inverse=True)
+                order = np.argsort(first)
+                rank = np.empty_like(order)
+                rank[order] = np.arange(len(order))
+                vocabulary, codes = vocabulary[order], rank[codes]
+            return _as_ids(codes, len(vocabulary)), vocabulary
+
+    if vocabulary.ndim == 0:
+        size = int(vocabulary)
+        codes = values.astype(np.int64)
+        codes[(codes < 0) | (codes >= size)] = -1
+    elif pd is not None:
+        codes = pd.Index(vocabulary).get_indexer(values)
+    else:
+        order = np.argsort(vocabulary)
+        positions = np.searchsorted(vocabulary, values, sorter=order).clip(max=len(vocabulary) - 1)
+        codes = np.where(vocabulary[order[positions]] == values, order[positions], -1) if len(vocabulary) else \
+            np.full(len(values), -1)
+    return _as_ids(codes, int(vocabulary) if vocabulary.ndim == 0 else len(vocabulary)), vocabulary
+
+
+def _as_ids(codes, size):
+    # codes of -1 (missing or unseen values) become the last id, size
+    ids = np.asarray(codes).astype(np.int32 if size < 2 ** 31 - 1 else np.int64)
+    ids[ids < 0] = size
+    return ids
+
+
+_MASK64 = 0xffffffffffffffff
+_K0 = 0xc3a5c85c97cb3127
+_K1 = 0xb492b66fbe98f273
+_K2 = 0x9ae16a3b2f90404f
+
+
+def _fetch64(s, i):
+    return int.from_bytes(s[i:i + 8], 'little')
+
+
+def _fetch32(s, i):
+    return int.from_bytes(s[i:i + 4], 'little')
+
+
+def _rotate(val, shift):
+    return val if shift == 0 else ((val >> shift) | (val << (64 - shift))) & _MASK64
+
+
+def _shift_mix(val):
+    return val ^ (val >> 47)
+
+
+def _hash_len16(u, v, mul):
+    a = ((u ^ v) * mul) & _MASK64
+    a ^= a >> 47
+    b = ((v ^ a) * mul) & _MASK64
+    b ^= b >> 47
+    return (b * mul) & _MASK64
+
+
+def _hash_len0to16(s):
+    length = len(s)
+    if length >= 8:
+        mul = _K2 + length * 2
+        a = (_fetch64(s, 0) + _K2) & _MASK64
+        b = _fetch64(s, length - 8)
+        c = (_rotate(b, 37) * mul + a) & _MASK64
+        d = ((_rotate(a, 25) + b) * mul) & _MASK64
+        return _hash_len16(c, d, mul)
+    if length >= 4:
+        mul = _K2 + length * 2
+        a = _fetch32(s, 0)
+        return _hash_len16(length + (a << 3), _fetch32(s, length - 4), mul)
+    if length > 0:
+        y = (s[0] + (s[length >> 1] << 8)) & 0xffffffff
+        z = (length + (s[length - 1] << 2)) & 0xffffffff
+        return (_shift_mix(((y * _K2) ^ (z * _K0)) & _MASK64) * _K2) & _MASK64
+    return _K2
+
+
+def _hash_len17to32(s):
+    length = len(s)
+    mul = _K2 + length * 2
+    a = (_fetch64(s, 0) * _K1) & _MASK64
+    b = _fetch64(s, 8)
+    c = (_fetch64(s, length - 8) * mul) & _MASK64
+    d = (_fetch64(s, length - 16) * _K2) & _MASK64
+    return _hash_len16((_rotate((a + b) & _MASK64, 43) + _rotate(c, 30) + d) & _MASK64,
+                       (a + _rotate((b + _K2) & _MASK64, 18) + c) & _MASK64, mul)
+
+
+def _hash_len33to64(s):
+    length = len(s)
+    mul = _K2 + length * 2
+    a = (_fetch64(s, 0) * _K2) & _MASK64
+    b = _fetch64(s, 8)
+    c = (_fetch64(s, length - 8) * mul) & _MASK64
+    d = (_fetch64(s, length - 16) * _K2) & _MASK64
+    y = (_rotate((a + b) & _MASK64, 43) + _rotate(c, 30) + d) & _MASK64
+    z = _hash_len16(y, (a + _rotate((b + _K2) & _MASK64, 18) + c) & _MASK64, mul)
+    e = (_fetch64(s, 16) * mul) & _MASK64
+    f = _fetch64(s, 24)
+    g = ((y + _fetch64(s, length - 32)) * mul) & _MASK64
+    h = ((z + _fetch64(s, length - 24)) * mul) & _MASK64
+    return _hash_len16((_rotate((e + f) & _MASK64, 43) + _rotate(g, 30) + h) & _MASK64,
+                       (e + _rotate((f + a) & _MASK64, 18) + g) & _MASK64, mul)
+
+
+def _weak_hash_len32_with_seeds(s, i, a, b):
+    w, x, y, z = _fetch64(s, i), _fetch64(s, i + 8), _fetch64(s, i + 16), _fetch64(s, i + 24)
+    a = (a + w) & _MASK64
+    b = _rotate((b + a + z) & _MASK64, 21)
+    c = a
+    a = (a + x + y) & _MASK64
+    b = (b + _rotate(a, 44)) & _MASK64
+    return (a + z) & _MASK64, (b + c) & _MASK64
+
+
+def _fingerprint64(s):
+    # FarmHash Fingerprint64 (farmhashna::Hash64) of the bytes ``s``
+    length = len(s)
+    if length <= 16:
+        return _hash_len0to16(s)
+    if length <= 32:
+        return _hash_len17to32(s)
+    if length <= 64:
+        return _hash_len33to64(s)
+
+    seed = 81
+    x = seed
+    y = (seed * _K1 + 113) & _MASK64
+    z = (_shift_mix((y * _K2 + 113) & _MASK64) * _K2) & _MASK64
+    v = (0, 0)
+    w = (0, 0)
+    x = (x * _K2 + _fetch64(s, 0)) & _MASK64
+
+    end = ((length - 1) // 64) * 64
+    last64 = end + ((length - 1) & 63) - 63
+    i = 0
+    while i != end:
+        x = (_rotate((x + y + v[0] + _fetch64(s, i + 8)) & _MASK64, 37) * _K1) & _MASK64
+        y = (_rotate((y + v[1] + _fetch64(s, i + 48)) & _MASK64, 42) * _K1) & _MASK64
+        x ^= w[1]
+        y = (y + v[0] + _fetch64(s, i + 40)) & _MASK64
+        z = (_rotate((z + w[0]) & _MASK64, 33) * _K1) & _MASK64
+        v = _weak_hash_len32_with_seeds(s, i, (v[1] * _K1) & _MASK64, (x + w[0]) & _MASK64)
+        w = _weak_hash_len32_with_seeds(s, i + 32, (z + w[1]) & _MASK64, (y + _fetch64(s, i + 16)) & _MASK64)
+        z, x = x, z
+        i += 64
+
+    mul = _K1 + ((z & 0xff) << 1)
+    i = last64
+    w0 = (w[0] + ((length - 1) & 63)) & _MASK64
+    v0 = (v[0] + w0) & _MASK64
+    w = ((w0 + v0) & _MASK64, w[1])
+    v = (v0, v[1])
+    x = (_rotate((x + y + v[0] + _fetch64(s, i + 8)) & _MASK64, 37) * mul) & _MASK64
+    y = (_rotate((y + v[1] + _fetch64(s, i + 48)) & _MASK64, 42) * mul) & _MASK64
+    x ^= (w[1] * 9) & _MASK64
+    y = (y + v[0] * 9 + _fetch64(s, i + 40)) & _MASK64
+    z = (_rotate((z + w[0]) & _MASK64, 33) * mul) & _MASK64
+    v = _weak_hash_len32_with_seeds(s, i, (v[1] * mul) & _MASK64, (x + w[0]) & _MASK64)
+    w = _weak_hash_len32_with_seeds(s, i + 32, (z + w[1]) & _MASK64, (y + _fetch64(s, i + 16)) & _MASK64)
+    z, x = x, z
+    return _hash_len16((_hash_len16(v[0], w[0], mul) + _shift_mix(y) * _K0 + z) & _MASK64,
+                       (_hash_len16(v[1], w[1], mul) + x) & _MASK64, mul)
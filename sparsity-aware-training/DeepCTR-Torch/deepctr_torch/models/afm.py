@@ -27,20 +27,25 @@ class AFM(BaseModel):
     :param seed: integer ,to use as random seed.
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
     :param device: str, ``"cpu"`` or ``"cuda:0"``
+    :param embedding_arena: bool. Whether to store all embedding tables of the same dimension in one ``EmbeddingArena`` tensor, looked up with one gather per batch.
+    :param sparse_embedding: bool. Whether the embedding tables produce sparse gradients, which the sparse optimizer then applies to the looked-up rows only.
+    :param fuse_linear_embedding: bool. Whether a feature of both the linear and the deep part keeps its linear weight as an extra column of its deep embedding table, so that one lookup feeds both parts.
     :return: A PyTorch model instance.
 
     """
 
     def __init__(self, linear_feature_columns, dnn_feature_columns, use_attention=True, attention_factor=8,
                  l2_reg_linear=1e-5, l2_reg_embedding=1e-5, l2_reg_att=1e-5, afm_dropout=0, init_std=0.0001, seed=1024,
-                 task='binary', device='cpu'):
+                 task='binary', device='cpu', embedding_arena=False, sparse_embedding=False,
+                 fuse_linear_embedding=False):
         super(AFM, self).__init__(linear_feature_columns, dnn_feature_columns,
                                   dnn_hidden_units=[],
                                   l2_reg_linear=l2_reg_linear,
                                   l2_reg_embedding=l2_reg_embedding, l2_reg_dnn=0, init_std=init_std,
                                   seed=seed,
                                   dnn_dropout=0, dnn_activation='relu',
-                                  task=task, device=device)
+                                  task=task, device=device, embedding_arena=embedding_arena, sparse_embedding=sparse_embedding,
+                                  fuse_linear_embedding=fuse_linear_embedding)
 
         self.use_attention = use_attention
 
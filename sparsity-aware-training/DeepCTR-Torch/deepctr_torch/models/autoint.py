@@ -32,6 +32,9 @@ class AutoInt(BaseModel):
     :param seed: integer ,to use as random seed.
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
     :param device: str, ``"cpu"`` or ``"cuda:0"``
+    :param embedding_arena: bool. Whether to store all embedding tables of the same dimension in one ``EmbeddingArena`` tensor, looked up with one gather per batch.
+    :param sparse_embedding: bool. Whether the embedding tables produce sparse gradients, which the sparse optimizer then applies to the looked-up rows only.
+    :param fuse_linear_embedding: bool. Whether a feature of both the linear and the deep part keeps its linear weight as an extra column of its deep embedding table, so that one lookup feeds both parts.
     :return: A PyTorch model instance.
     
     """
@@ -40,7 +43,8 @@ class AutoInt(BaseModel):
                  att_res=True,
                  dnn_hidden_units=(256, 128), dnn_activation='relu',
                  l2_reg_dnn=0, l2_reg_embedding=1e-5, dnn_use_bn=False, dnn_dropout=0, init_std=0.0001, seed=1024,
-                 task='binary', device='cpu'):
+                 task='binary', device='cpu', embedding_arena=False, sparse_embedding=False,
+                 fuse_linear_embedding=False):
 
         super(AutoInt, self).__init__(linear_feature_columns, dnn_feature_columns,
                                       dnn_hidden_units=dnn_hidden_units,
@@ -48,7 +52,8 @@ class AutoInt(BaseModel):
                                       l2_reg_embedding=l2_reg_embedding, l2_reg_dnn=l2_reg_dnn, init_std=init_std,
                                       seed=seed,
                                       dnn_dropout=dnn_dropout, dnn_activation=dnn_activation,
-                                      task=task, device=device)
+                                      task=task, device=device, embedding_arena=embedding_arena, sparse_embedding=sparse_embedding,
+                                      fuse_linear_embedding=fuse_linear_embedding)
 
         if len(dnn_hidden_units) <= 0 and att_layer_num <= 0:
             raise ValueError("Either hidden_layer or att_layer_num must > 0")
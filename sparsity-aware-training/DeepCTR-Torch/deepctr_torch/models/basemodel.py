@@ -8,45 +8,120 @@ Author:
 from __future__ import print_function
 
 import time
+from collections import OrderedDict
 
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.multiprocessing as mp
 import torch.nn.functional as F
 import torch.utils.data as Data
 from sklearn.metrics import *
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from ..inputs import build_input_features, SparseFeat, DenseFeat, VarLenSparseFeat, get_varlen_pooling_list, \
-    create_embedding_matrix
-from ..layers import PredictionLayer
+from ..inputs import build_input_features, SparseFeat, DenseFeat, VarLenSparseFeat, create_embedding_matrix, \
+    build_input_hashes, init_embedding_weights, count_id_columns, split_feature_arrays, FeatureBatch, InputPlan, \
+    JaggedArray
+from ..layers import PredictionLayer, SparseUpdateEmbedding, EmbeddingArena, CompactEmbedding, DynamicEmbedding, \
+    AdmissionEmbedding, QREmbedding, QuantizedEmbedding, CachedEmbedding, MmapEmbedding, FusedEmbedding
 from ..layers.utils import slice_arrays
 
 
+class _BatchedDataset(Data.Dataset):
+    # Input arrays that are batched on the fly: features with use_hash are hashed into buckets batch by batch,
+    # and the rows of JaggedArray inputs are gathered without padding. It is indexed with a list of sample
+    # indices, see _data_loader, and returns the id and dense matrices and the jagged dict of a FeatureBatch.
+
+    def __init__(self, x, y, names, hashes, num_id_columns):
+        self.x = [array if isinstance(array, JaggedArray) else np.asarray(array) for array in x]
+        self.y = None if y is None else np.asarray(y)
+        self.names = names
+        self.hashes = hashes
+        self.num_id_columns = num_id_columns
+
+    def __len__(self):
+        return len(self.x[0])
+
+    def __getitem__(self, index):
+        arrays, jagged = [], OrderedDict()
+        for name, array, hash in zip(self.names, self.x, self.hashes):
+            array = array[index]
+            if isinstance(array, JaggedArray):
+                values = array.values if hash is None else hash(array.values)
+                dtype = np.float32 if np.issubdtype(values.dtype, np.floating) else np.int64
+                jagged[name] = (torch.from_numpy(values.astype(dtype, copy=False)), torch.from_numpy(array.offsets))
+            else:
+                arrays.append(array if hash is None else hash(array))
+        ids, dense = split_feature_arrays(arrays, self.num_id_columns, len(index))
+        if self.y is None:
+            return torch.from_numpy(ids), torch.from_numpy(dense), jagged
+        return torch.from_numpy(ids), torch.from_numpy(dense), jagged, torch.from_numpy(self.y[index])
+
+
+def _data_loader(dataset, shuffle, batch_size):
+    if not isinstance(dataset, _BatchedDataset):
+        return DataLoader(dataset=dataset, shuffle=shuffle, batch_size=batch_size)
+    sampler = Data.RandomSampler(dataset) if shuffle else Data.SequentialSampler(dataset)
+    return DataLoader(dataset=dataset, batch_size=None,
+                      sampler=Data.BatchSampler(sampler, batch_size, drop_last=False))
+
+
+def _lookahead(iterable):
+    # yields (item, next item), the next item of the last one being None
+    iterator = iter(iterable)
+    item = next(iterator, None)
+    while item is not None:
+        following = next(iterator, None)
+        yield item, following
+        item = following
+
+
+def _quantize_embeddings(module, dtype):
+    # replaces the embedding tables below module by QuantizedEmbedding tables, see BaseModel.quantize_embeddings
+    for name, child in module.named_children():
+        if isinstance(child, EmbeddingArena):
+            setattr(module, name, nn.ModuleDict(
+                [(table, QuantizedEmbedding.from_weight(child.table_weight(table), dtype)) for table in child]))
+        elif isinstance(child, CachedEmbedding):
+            setattr(module, name, QuantizedEmbedding.from_weight(child.full_weight(), dtype))
+        elif isinstance(child, nn.Embedding) and not isinstance(child, DynamicEmbedding):
+            setattr(module, name, QuantizedEmbedding.from_weight(child.weight, dtype))
+        elif not isinstance(child, (DynamicEmbedding, CompactEmbedding, QuantizedEmbedding)):
+            _quantize_embeddings(child, dtype)
+
+
+def _clear_fused_lookups(model, *args):
+    # forward (pre-)hook of the models with FusedEmbedding tables, see BaseModel.__init__
+    for table in model.embedding_dict.values():
+        if isinstance(table, FusedEmbedding):
+            table.pending = None
+
+
 class Linear(nn.Module):
-    def __init__(self, feature_columns, feature_index, init_std=0.0001, device='cpu'):
+    def __init__(self, feature_columns, feature_index, init_std=0.0001, device='cpu', embedding_arena=False,
+                 sparse=False, fused_embeddings=None):
         super(Linear, self).__init__()
         self.feature_index = feature_index
         self.device = device
-        self.sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, SparseFeat), feature_columns)) if len(feature_columns) else []
-        self.dense_feature_columns = list(
-            filter(lambda x: isinstance(x, DenseFeat), feature_columns)) if len(feature_columns) else []
-
-        self.varlen_sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, VarLenSparseFeat), feature_columns)) if len(feature_columns) else []
-
-        self.embedding_dict = create_embedding_matrix(feature_columns, init_std, linear=True, sparse=False,
-                                                      device=device)
+        self.input_plan = InputPlan(feature_columns, feature_index)
+        self.sparse_feature_columns = self.input_plan.sparse_feature_columns
+        self.dense_feature_columns = self.input_plan.dense_feature_columns
+        self.varlen_sparse_feature_columns = self.input_plan.varlen_sparse_feature_columns
+
+        # embedding_name -> linear weights of a FusedEmbedding of the deep part, which owns the table
+        self.fused_tables = OrderedDict(
+            (name, table.linear_table()) for name, table in (fused_embeddings or {}).items())
+        self.embedding_dict = create_embedding_matrix(
+            [feat for feat in feature_columns if getattr(feat, 'embedding_name', None) not in self.fused_tables],
+            init_std, linear=True, sparse=sparse, device=device, arena=embedding_arena)
 
         #         nn.ModuleDict(
         #             {feat.embedding_name: nn.Embedding(feat.dimension, 1, sparse=True) for feat in
         #              self.sparse_feature_columns}
         #         )
         # .to("cuda:1")
-        for tensor in self.embedding_dict.values():
-            nn.init.normal_(tensor.weight, mean=0, std=init_std)
+        init_embedding_weights(self.embedding_dict, init_std)
 
         if len(self.dense_feature_columns) > 0:
             self.weight = nn.Parameter(torch.Tensor(sum(fc.dimension for fc in self.dense_feature_columns), 1)).to(
@@ -54,16 +129,16 @@ class Linear(nn.Module):
             torch.nn.init.normal_(self.weight, mean=0, std=init_std)
 
     def forward(self, X):
+        embedding_dict = self.embedding_dict
+        if self.fused_tables:
+            embedding_dict = dict(self.embedding_dict.items())
+            embedding_dict.update(self.fused_tables)
 
-        sparse_embedding_list = [self.embedding_dict[feat.embedding_name](
-            X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]].long()) for
-            feat in self.sparse_feature_columns]
+        sparse_embedding_list = self.input_plan.sparse_embeddings(X, embedding_dict)
 
-        dense_value_list = [X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]] for feat in
-                            self.dense_feature_columns]
+        dense_value_list = self.input_plan.dense_values(X)
 
-        varlen_embedding_list = get_varlen_pooling_list(self.embedding_dict, X, self.feature_index,
-                                                        self.varlen_sparse_feature_columns, self.device)
+        varlen_embedding_list = self.input_plan.pooled_embeddings(X, embedding_dict)
 
         sparse_embedding_list += varlen_embedding_list
 
@@ -83,6 +158,23 @@ class Linear(nn.Module):
             linear_logit = torch.zeros([X.shape[0], 1])
         return linear_logit
 
+    def compact(self):
+        """Replaces every embedding table by a ``CompactEmbedding`` holding only its non-zero rows.
+
+        Meant for serving or exporting a linear part trained with an L1 penalty, e.g. by
+        ``compile(optimizer_linear='ftrl', optimizer_linear_params={'l1': ...})``; the compacted tables
+        cannot be trained any further. A ``DynamicEmbedding`` already holds only the rows of its ids and is
+        kept as it is, and so are an ``AdmissionEmbedding``, which must keep routing unadmitted ids to its
+        default row, and a ``QREmbedding``, whose rows are shared between ids. Weights fused into the tables of
+        the deep part (``fuse_linear_embedding``) are not compacted.
+        """
+        self.embedding_dict = nn.ModuleDict(
+            [(name, table if isinstance(table, (CompactEmbedding, DynamicEmbedding, AdmissionEmbedding, QREmbedding))
+              else CompactEmbedding.from_weight(table.full_weight() if isinstance(table, CachedEmbedding)
+                                                else table.weight))
+             for name, table in self.embedding_dict.items()])
+        return self
+
 
 class BaseModel(nn.Module):
     def __init__(self,
@@ -90,29 +182,62 @@ class BaseModel(nn.Module):
                      128, 128),
                  l2_reg_linear=1e-5,
                  l2_reg_embedding=1e-5, l2_reg_dnn=0, init_std=0.0001, seed=1024, dnn_dropout=0, dnn_activation='relu',
-                 task='binary', device='cpu'):
+                 task='binary', device='cpu', embedding_arena=False, sparse_embedding=False,
+                 fuse_linear_embedding=False):
 
         super(BaseModel, self).__init__()
 
         self.dnn_feature_columns = dnn_feature_columns
 
         self.reg_loss = torch.zeros((1,), device=device)
+        self.regularization_weight = []
+        self.regularization_mode = 'full'
+        self._batch_regularized = set()
         self.aux_loss = torch.zeros((1,), device=device)
         self.device = device  # device
 
         self.feature_index = build_input_features(
             linear_feature_columns + dnn_feature_columns)
+        self.num_id_columns = count_id_columns(linear_feature_columns + dnn_feature_columns)
+        self.feature_hash = build_input_hashes(linear_feature_columns + dnn_feature_columns)
+        # embedding_name -> names of the features looked up in it
+        self.embedding_features = OrderedDict()
+        for feat in linear_feature_columns + dnn_feature_columns:
+            if isinstance(feat, (SparseFeat, VarLenSparseFeat)):
+                self.embedding_features.setdefault(feat.embedding_name, [])
+                if feat.name not in self.embedding_features[feat.embedding_name]:
+                    self.embedding_features[feat.embedding_name].append(feat.name)
         self.dnn_feature_columns = dnn_feature_columns
+        self.input_plan = InputPlan(dnn_feature_columns, self.feature_index)
+        # names of feature columns other than dnn_feature_columns -> their InputPlan, see input_from_feature_columns
+        self._input_plans = {}
+
+        # embedding names of the features of both parts, whose linear weight is a column of the deep table
+        fused = set()
+        if fuse_linear_embedding:
+            if embedding_arena:
+                raise ValueError("fuse_linear_embedding cannot be combined with embedding_arena")
+            linear_names = set(feat.embedding_name for feat in linear_feature_columns
+                               if isinstance(feat, (SparseFeat, VarLenSparseFeat)))
+            fused = set(feat.embedding_name for feat in dnn_feature_columns
+                        if isinstance(feat, (SparseFeat, VarLenSparseFeat)) and feat.embedding_name in linear_names)
 
         self.embedding_dict = create_embedding_matrix(
-            dnn_feature_columns, init_std, sparse=False, device=device)
+            dnn_feature_columns, init_std, sparse=sparse_embedding, device=device, arena=embedding_arena, fused=fused)
         #         nn.ModuleDict(
         #             {feat.embedding_name: nn.Embedding(feat.dimension, embedding_size, sparse=True) for feat in
         #              self.dnn_feature_columns}
         #         )
 
         self.linear_model = Linear(
-            linear_feature_columns, self.feature_index, device=device)
+            linear_feature_columns, self.feature_index, device=device, embedding_arena=embedding_arena,
+            sparse=sparse_embedding, fused_embeddings=OrderedDict(
+                (name, table) for name, table in self.embedding_dict.items() if name in fused))
+        if fused:
+            # a gather of one part the other part has not taken must not outlive the forward, the next one
+            # could take its rows, computed before the last optimizer step
+            self.register_forward_pre_hook(_clear_fused_lookups)
+            self.register_forward_hook(_clear_fused_lookups)
 
         self.add_regularization_loss(
             self.embedding_dict.parameters(), l2_reg_embedding)
@@ -134,7 +259,10 @@ class BaseModel(nn.Module):
             use_double=True,
             model_name="xmh_test",
             verbose_steps=500,
-            xmh_model_dir=""):
+            xmh_model_dir="",
+            workers=1,
+            dense_sync='hogwild',
+            dense_sync_steps=100):
         """
         :param x: Numpy array of training data (if the model has a single input), or list of Numpy arrays (if the model has multiple inputs).If input layers in the model are named, you can also pass a
             dictionary mapping input names to Numpy arrays.
@@ -147,6 +275,9 @@ class BaseModel(nn.Module):
         :param validation_data: tuple `(x_val, y_val)` or tuple `(x_val, y_val, val_sample_weights)` on which to evaluate the loss and any model metrics at the end of each epoch. The model will not be trained on this data. `validation_data` will override `validation_split`.
         :param shuffle: Boolean. Whether to shuffle the order of the batches at the beginning of each epoch.
         :param use_double: Boolean. Whether to use double precision in metric calculation.
+        :param workers: Integer. Number of CPU processes to train with. If greater than 1, the embeddings and the state of the sparse optimizer are put in shared memory and each process trains on its own shard of the data, updating them without locks (Hogwild). The embedding tables must get sparse updates (``sparse_embedding=True`` or ``optimizer_sparse_in_backward=True``).
+        :param dense_sync: String. How the processes share the dense parameters if `workers` > 1: ``"hogwild"`` updates one shared copy without locks like the embeddings, ``"periodic"`` trains a local copy per process, with its own dense optimizer state, and adds its change to the shared copy every `dense_sync_steps` steps.
+        :param dense_sync_steps: Integer. Number of steps between two synchronizations of ``dense_sync="periodic"``.
 
         """
         if isinstance(x, dict):
@@ -182,17 +313,31 @@ class BaseModel(nn.Module):
             val_x = []
             val_y = []
         for i in range(len(x)):
-            if len(x[i].shape) == 1:
+            if not isinstance(x[i], JaggedArray) and len(x[i].shape) == 1:
                 x[i] = np.expand_dims(x[i], axis=1)
 
-        train_tensor_data = Data.TensorDataset(
-            torch.from_numpy(
-                np.concatenate(x, axis=-1)),
-            torch.from_numpy(y))
+        jagged = any(isinstance(array, JaggedArray) for array in x)
+        if self.feature_hash or jagged:
+            train_tensor_data = _BatchedDataset(x, y, list(self.feature_index), self._input_hashes(),
+                                                self.num_id_columns)
+        else:
+            train_ids, train_dense = split_feature_arrays(x, self.num_id_columns)
+            train_tensor_data = Data.TensorDataset(
+                torch.from_numpy(train_ids), torch.from_numpy(train_dense),
+                torch.from_numpy(y))
         if batch_size is None:
             batch_size = 256
-        train_loader = DataLoader(
-            dataset=train_tensor_data, shuffle=shuffle, batch_size=batch_size)
+        if workers > 1:
+            if jagged:
+                raise ValueError("training with workers > 1 does not support JaggedArray inputs, the workers "
+                                 "batch their shard sample by sample")
+            if self.feature_hash:
+                # the workers shard the data sample by sample, so it is hashed once up front
+                train_ids, train_dense, _, train_y = train_tensor_data[np.arange(len(train_tensor_data))]
+                train_tensor_data = Data.TensorDataset(train_ids, train_dense, train_y)
+            return self._fit_hogwild(train_tensor_data, val_x, val_y, batch_size, epochs, verbose, shuffle, workers,
+                                     dense_sync, dense_sync_steps)
+        train_loader = _data_loader(train_tensor_data, shuffle, batch_size)
 
         from torch.utils.tensorboard import SummaryWriter
 
@@ -205,6 +350,7 @@ class BaseModel(nn.Module):
         loss_func = self.loss_func
         optim = self.optim
         optim_s = self.optim_s
+        optim_l = self.optim_l
 
         sample_num = len(train_tensor_data)
         best_val_auc= 0
@@ -213,6 +359,9 @@ class BaseModel(nn.Module):
 
         print("Train on {0} samples, validate on {1} samples, {2} steps per epoch".format(
             len(train_tensor_data), len(val_y), steps_per_epoch))
+        cached_tables = [module for module in self.modules() if isinstance(module, CachedEmbedding)]
+        # tables whose clock advances once per batch
+        stepped_tables = cached_tables + [module for module in self.modules() if isinstance(module, DynamicEmbedding)]
         for epoch in range(initial_epoch, epochs):
             start_time = time.time()
             loss_epoch = 0
@@ -220,27 +369,36 @@ class BaseModel(nn.Module):
             # if abs(loss_last - loss_now) < 0.0
             train_result = {}
             try:
-                with tqdm(enumerate(train_loader), disable=True) as t:
-                    for index, (x_train, y_train) in t:
-                        x = x_train.to(self.device).float()
-                        y = y_train.to(self.device).float()
-
-                        optim.zero_grad()
-                        if optim_s is not None:
-                            optim_s.zero_grad()
-
+                with tqdm(enumerate(_lookahead(train_loader)), disable=True) as t:
+                    for index, (batch, next_batch) in t:
+                        # (ids, dense[, jagged], y)
+                        x = FeatureBatch(*batch[:-1]).to(self.device)
+                        y = batch[-1].to(self.device).float()
+                        for table in stepped_tables:
+                            table.next_step()
+
+                        self._zero_grad(optim)
+                        self._zero_grad(optim_s)
+                        self._zero_grad(optim_l)
+
+                        self._record_lookups()
                         y_pred = model(x).squeeze()
                         loss = loss_func(y_pred, y.squeeze(), reduction='sum')
 
-                        total_loss = loss + self.reg_loss + self.aux_loss
+                        total_loss = loss + self.get_regularization_loss() + self.aux_loss
 
                         loss_epoch += loss.item()
                         total_loss_epoch += total_loss.item()
-                        total_loss.backward(retain_graph=True)
+                        # the 'full' penalty is a graph built with the model, kept across steps
+                        total_loss.backward(retain_graph=self.regularization_mode == 'full')
 
                         optim.step()
                         if optim_s is not None:
                             optim_s.step()
+                        if optim_l is not None:
+                            optim_l.step()
+                        if cached_tables and next_batch is not None:
+                            self._prefetch(FeatureBatch(*next_batch[:-1]))
 
                         if verbose > 0:
                             for name, metric_fun in self.metrics.items():
@@ -267,6 +425,7 @@ class BaseModel(nn.Module):
                                     '{0}/train'.format(name), np.sum(result) / (index+1), index+steps_per_epoch*epoch)
 
                             if len(val_x) and len(val_y):
+                                self._flush_optim(optim_s)
                                 eval_result = self.evaluate(
                                     val_x, val_y, 20480)
                                 if eval_result['auc'] < 0.6:
@@ -295,6 +454,7 @@ class BaseModel(nn.Module):
             t.close()
 
             epoch_time = int(time.time() - start_time)
+            self._flush_optim(optim_s)
             if verbose > 0:
                 print('Epoch {0}/{1}'.format(epoch + 1, epochs))
 
@@ -315,6 +475,218 @@ class BaseModel(nn.Module):
                 print(eval_str)
         writer.close()
 
+    def compact_linear(self):
+        """Compacts the embeddings of every linear part to their non-zero rows, see ``Linear.compact``."""
+        for module in [module for module in self.modules() if isinstance(module, Linear)]:
+            module.compact()
+        return self
+
+    def quantize_embeddings(self, dtype='int8'):
+        """Replaces the embedding tables by read-only ``QuantizedEmbedding`` tables for prediction and serving.
+
+        Covers ``embedding_dict``, the tables of every linear part and the tables nested in other modules, e.g.
+        the two tables of a ``QREmbedding``; an ``EmbeddingArena`` is split into one quantized table per
+        feature. A ``DynamicEmbedding`` or a ``CompactEmbedding`` is kept as it is. The model cannot be
+        trained any further.
+
+        :param dtype: String. ``"int8"`` for row-wise int8 with a per-row scale and bias, or ``"fp16"``.
+        """
+        _quantize_embeddings(self, dtype)
+        return self
+
+    def _fit_hogwild(self, train_tensor_data, val_x, val_y, batch_size, epochs, verbose, shuffle, workers,
+                     dense_sync, dense_sync_steps):
+        if self.device != 'cpu':
+            raise ValueError("training with workers > 1 is only supported on cpu")
+        if dense_sync not in ('hogwild', 'periodic'):
+            raise ValueError("dense_sync must be 'hogwild' or 'periodic', got %s" % dense_sync)
+        if any(isinstance(module, (DynamicEmbedding, CachedEmbedding, MmapEmbedding)) for module in self.modules()):
+            raise ValueError("training with workers > 1 does not support dynamic, cached or memory-mapped "
+                             "embeddings, their index or their files are not shared between processes")
+        dense_tables = [name for name, module in self.named_modules()
+                        if isinstance(module, (SparseUpdateEmbedding, EmbeddingArena)) and not module.sparse
+                        and module.optimizer is None and any(p.requires_grad for p in module.parameters())]
+        if dense_tables:
+            # a dense gradient makes every step of every worker update the whole table, the lock-free
+            # contention over all rows Hogwild relies on sparse updates to avoid
+            raise ValueError("training with workers > 1 requires sparse updates of the embedding tables, build "
+                             "the model with sparse_embedding=True or compile it with "
+                             "optimizer_sparse_in_backward=True; dense tables: %s" % dense_tables)
+
+        # the parameters and the optimizer state are moved to shared memory, the workers are forked
+        # below and update the same tensors; the training data is only read and stays copy-on-write
+        self.share_memory()
+        optims = [optim for optim in (self.optim, self.optim_s, self.optim_l) if optim is not None]
+        for optim in optims:
+            if hasattr(optim, 'share_memory'):
+                optim.share_memory()
+
+        print("Train on {0} samples with {1} workers, validate on {2} samples".format(
+            len(train_tensor_data), workers, len(val_y)))
+        lock = mp.Lock()
+        processes = []
+        for rank in range(workers):
+            process = mp.Process(target=self._hogwild_worker,
+                                 args=(rank, workers, train_tensor_data, batch_size, epochs, verbose, shuffle,
+                                       optims, dense_sync, dense_sync_steps, lock))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
+        if any(process.exitcode != 0 for process in processes):
+            raise RuntimeError("a training worker exited with code %s" % [p.exitcode for p in processes])
+
+        for optim in optims:
+            self._flush_optim(optim)
+        if verbose > 0 and len(val_x) and len(val_y):
+            eval_result = self.evaluate(val_x, val_y, batch_size)
+            print(" - ".join("val_" + name + ": {0: .4f}".format(result) for name, result in eval_result.items()))
+
+    def _hogwild_worker(self, rank, workers, train_tensor_data, batch_size, epochs, verbose, shuffle, optims,
+                        dense_sync, dense_sync_steps, lock):
+        torch.manual_seed(rank)
+        torch.set_num_threads(max(1, torch.get_num_threads() // workers))
+        shard = Data.Subset(train_tensor_data, list(range(rank, len(train_tensor_data), workers)))
+        train_loader = DataLoader(dataset=shard, shuffle=shuffle, batch_size=batch_size)
+
+        model = self.train()
+        # same split as _get_optim: everything but the embeddings is dense
+        dense_params = [p for name, p in self.named_parameters() if 'embed' not in name] \
+            if dense_sync == 'periodic' else []
+        shared_values = [p.data for p in dense_params]
+        for p in dense_params:
+            p.data = p.data.clone()
+        self._clone_state(optims, dense_params)
+        synced_values = [p.data.clone() for p in dense_params]
+
+        for epoch in range(epochs):
+            start_time = time.time()
+            loss_epoch = 0
+            for index, (ids_train, dense_train, y_train) in enumerate(train_loader):
+                x = FeatureBatch(ids_train, dense_train)
+                y = y_train.float()
+
+                for optim in optims:
+                    self._zero_grad(optim)
+
+                self._record_lookups()
+                y_pred = model(x).squeeze()
+                loss = self.loss_func(y_pred, y.squeeze(), reduction='sum')
+                total_loss = loss + self.get_regularization_loss() + self.aux_loss
+
+                loss_epoch += loss.item()
+                total_loss.backward(retain_graph=self.regularization_mode == 'full')
+
+                for optim in optims:
+                    optim.step()
+
+                if dense_params and index % dense_sync_steps == (dense_sync_steps - 1):
+                    self._sync_dense(dense_params, shared_values, synced_values, lock)
+            if dense_params:
+                self._sync_dense(dense_params, shared_values, synced_values, lock)
+
+            if verbose > 0 and rank == 0:
+                print('Epoch {0}/{1} (worker 0)'.format(epoch + 1, epochs))
+                print("{0}s - loss: {1: .4f}".format(int(time.time() - start_time), loss_epoch / len(shard)))
+
+    @staticmethod
+    def _clone_state(optims, params):
+        # gives this worker its own optimizer state for params, e.g. its local copies of the dense parameters,
+        # instead of the state shared by share_memory: the moments of one copy are not those of another
+        param_ids = set(id(p) for p in params)
+        for optim in optims:
+            for p, state in optim.state.items():
+                if id(p) in param_ids:
+                    for key, value in state.items():
+                        if torch.is_tensor(value):
+                            state[key] = value.clone()
+
+    @staticmethod
+    def _sync_dense(dense_params, shared_values, synced_values, lock):
+        # adds what this worker has learned since its last sync to the shared dense parameters
+        # and continues from the result
+        with lock:
+            for p, shared, synced in zip(dense_params, shared_values, synced_values):
+                shared.add_(p.data - synced)
+                p.data.copy_(shared)
+                synced.copy_(shared)
+
+    @staticmethod
+    def _zero_grad(optim):
+        # Like optim.zero_grad(), but sparse gradients are dropped instead of zeroed: the next backward
+        # then creates a new sparse gradient holding only the rows of that batch.
+        if optim is None:
+            return
+        for group in optim.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    p.grad = None
+                else:
+                    p.grad.detach_()
+                    p.grad.zero_()
+
+    def save_checkpoint(self, path):
+        """Saves the weights and the state of the optimizers set by ``compile`` to ``path``.
+
+        Lazily updated optimizer state is brought up to date first, gradients are not saved. ``MmapEmbedding``
+        tables and their mapped optimizer state are flushed to their files and left out, the checkpoint only
+        refers to them.
+        """
+        optims = [getattr(self, name, None) for name in ('optim', 'optim_s', 'optim_l')]
+        for optim in optims:
+            self._flush_optim(optim)
+        mmap_tables = self._mmap_tables()
+        for table in mmap_tables.values():
+            table.flush()
+        model_state = self.state_dict()
+        for name in mmap_tables:
+            del model_state[name + '.weight']
+        mapped_ids = set(id(value) for table in mmap_tables.values() for value in table.state_files.values())
+        optim_states = []
+        for optim in optims:
+            optim_state = optim.state_dict() if optim is not None else None
+            if optim_state is not None and mapped_ids:
+                optim_state['state'] = {key: {k: v for k, v in value.items() if id(v) not in mapped_ids}
+                                        for key, value in optim_state['state'].items()}
+            optim_states.append(optim_state)
+        torch.save({'model': model_state, 'optim': optim_states,
+                    'mmap': {name: table.path for name, table in mmap_tables.items()}}, path)
+
+    def load_checkpoint(self, path):
+        """Restores a checkpoint written by ``save_checkpoint``; call ``compile`` with the same optimizers first.
+
+        ``MmapEmbedding`` tables keep the content of their files.
+        """
+        checkpoint = torch.load(path, map_location=self.device)
+        mmap_tables = self._mmap_tables()
+        if set(checkpoint.get('mmap', {})) != set(mmap_tables):
+            raise ValueError("the checkpoint was saved with the memory-mapped tables %s, the model has %s"
+                             % (sorted(checkpoint.get('mmap', {})), sorted(mmap_tables)))
+        incompatible = self.load_state_dict(checkpoint['model'], strict=False)
+        missing_keys = set(incompatible.missing_keys) - set(name + '.weight' for name in mmap_tables)
+        if missing_keys or incompatible.unexpected_keys:
+            raise RuntimeError("Error(s) in loading the checkpoint: missing keys %s, unexpected keys %s"
+                               % (sorted(missing_keys), incompatible.unexpected_keys))
+        for name, optim_state in zip(('optim', 'optim_s', 'optim_l'), checkpoint['optim']):
+            optim = getattr(self, name, None)
+            if optim is not None and optim_state is not None:
+                optim.load_state_dict(optim_state)
+        for table in mmap_tables.values():
+            table.map_state()
+
+    def _mmap_tables(self):
+        # name -> MmapEmbedding module
+        return OrderedDict((name, module) for name, module in self.named_modules()
+                           if isinstance(module, MmapEmbedding))
+
+    def _flush_optim(self, optim):
+        # optimizers that decay their state lazily (e.g. RAdagrad(lazy_decay=True)) must be brought up to date
+        # before the weights are evaluated or saved
+        if optim is not None and hasattr(optim, 'flush'):
+            optim.flush()
+
     def evaluate(self, x, y, batch_size=20480):
         """
 
@@ -340,18 +712,21 @@ class BaseModel(nn.Module):
         if isinstance(x, dict):
             x = [x[feature] for feature in self.feature_index]
         for i in range(len(x)):
-            if len(x[i].shape) == 1:
+            if not isinstance(x[i], JaggedArray) and len(x[i].shape) == 1:
                 x[i] = np.expand_dims(x[i], axis=1)
 
-        tensor_data = Data.TensorDataset(
-            torch.from_numpy(np.concatenate(x, axis=-1)))
-        test_loader = DataLoader(
-            dataset=tensor_data, shuffle=False, batch_size=batch_size)
+        if self.feature_hash or any(isinstance(array, JaggedArray) for array in x):
+            tensor_data = _BatchedDataset(x, None, list(self.feature_index), self._input_hashes(),
+                                          self.num_id_columns)
+        else:
+            test_ids, test_dense = split_feature_arrays(x, self.num_id_columns)
+            tensor_data = Data.TensorDataset(torch.from_numpy(test_ids), torch.from_numpy(test_dense))
+        test_loader = _data_loader(tensor_data, False, batch_size)
 
         pred_ans = []
         with torch.no_grad():
-            for index, x_test in enumerate(test_loader):
-                x = x_test[0].to(self.device).float()
+            for index, batch in enumerate(test_loader):
+                x = FeatureBatch(*batch).to(self.device)
                 # y = y_test.to(self.device).float()
 
                 y_pred = model(x).cpu().data.numpy()  # .squeeze()
@@ -362,29 +737,44 @@ class BaseModel(nn.Module):
         else:
             return np.concatenate(pred_ans)
 
-    def input_from_feature_columns(self, X, feature_columns, embedding_dict, support_dense=True):
-
-        sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, SparseFeat), feature_columns)) if len(feature_columns) else []
-        dense_feature_columns = list(
-            filter(lambda x: isinstance(x, DenseFeat), feature_columns)) if len(feature_columns) else []
+    def _prefetch(self, X):
+        # loads the rows the batch X will look up into the fast tier of the CachedEmbedding tables
+        for module in self.modules():
+            embedding_dict = getattr(module, 'embedding_dict', None)
+            if not isinstance(embedding_dict, nn.ModuleDict):
+                continue
+            for embedding_name, table in embedding_dict.items():
+                features = self.embedding_features.get(embedding_name)
+                if isinstance(table, FusedEmbedding):
+                    table = table.embedding
+                if isinstance(table, CachedEmbedding) and features:
+                    table.prefetch(torch.cat([X.jagged[name][0] if name in X.jagged else
+                                              X[:, self.feature_index[name][0]:self.feature_index[name][1]]
+                                              .reshape(-1) for name in features]))
+
+    def _input_hashes(self):
+        # one entry per input array, the Hash of its feature or None
+        return [self.feature_hash.get(feature) for feature in self.feature_index]
 
-        varlen_sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, VarLenSparseFeat), feature_columns)) if feature_columns else []
+    def input_from_feature_columns(self, X, feature_columns, embedding_dict, support_dense=True):
+        # the features are split and located once, by the InputPlan of feature_columns
+        if feature_columns is self.dnn_feature_columns:
+            plan = self.input_plan
+        else:
+            key = tuple(feat.name for feat in feature_columns)
+            if key not in self._input_plans:
+                self._input_plans[key] = InputPlan(feature_columns, self.feature_index)
+            plan = self._input_plans[key]
 
-        if not support_dense and len(dense_feature_columns) > 0:
+        if not support_dense and len(plan.dense_feature_columns) > 0:
             raise ValueError(
                 "DenseFeat is not supported in dnn_feature_columns")
 
-        sparse_embedding_list = [embedding_dict[feat.embedding_name](
-            X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]].long()) for
-            feat in sparse_feature_columns]
+        sparse_embedding_list = plan.sparse_embeddings(X, embedding_dict)
 
-        varlen_sparse_embedding_list = get_varlen_pooling_list(self.embedding_dict, X, self.feature_index,
-                                                               varlen_sparse_feature_columns, self.device)
+        varlen_sparse_embedding_list = plan.pooled_embeddings(X, embedding_dict)
 
-        dense_value_list = [X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]] for feat in
-                            dense_feature_columns]
+        dense_value_list = plan.dense_values(X)
 
         return sparse_embedding_list + varlen_sparse_embedding_list, dense_value_list
 
@@ -410,15 +800,53 @@ class BaseModel(nn.Module):
         return input_dim
 
     def add_regularization_loss(self, weight_list, weight_decay, p=2):
+        if not torch.is_tensor(weight_list):
+            # a single tensor is kept as is and penalized row by row
+            weight_list = [w[1] if isinstance(w, tuple) else w for w in weight_list]
+        # 'full' regularization: the penalty of the weights, computed once here
         reg_loss = torch.zeros((1,), device=self.device)
         for w in weight_list:
-            if isinstance(w, tuple):
-                l2_reg = torch.norm(w[1], p=p, )
-            else:
-                l2_reg = torch.norm(w, p=p, )
+            l2_reg = torch.norm(w, p=p, )
             reg_loss = reg_loss + l2_reg
         reg_loss = weight_decay * reg_loss
         self.reg_loss = self.reg_loss + reg_loss
+        # 'batch' regularization computes the penalty at every step, see get_regularization_loss
+        self.regularization_weight.append((weight_list, weight_decay, p))
+
+    def get_regularization_loss(self):
+        """Returns the sum of the penalties added by ``add_regularization_loss``.
+
+        With ``compile(regularization='full')`` it is ``reg_loss``, the penalty of the whole weights computed when
+        they were added, whose graph is kept across steps. With ``compile(regularization='batch')`` it is
+        computed anew at every step, and an embedding table is only penalized over the rows looked up since the
+        last call, i.e. in the current batch.
+        """
+        if self.regularization_mode == 'full':
+            return self.reg_loss
+        seen_rows = {}
+        for module in self.modules():
+            if isinstance(module, (SparseUpdateEmbedding, EmbeddingArena)):
+                for weight, rows in module.seen_embeddings():
+                    seen_rows[id(weight)] = rows
+        reg_loss = torch.zeros((1,), device=self.device)
+        for weight_list, weight_decay, p in self.regularization_weight:
+            if weight_decay == 0:
+                continue
+            for w in weight_list:
+                if id(w) in self._batch_regularized:
+                    if id(w) in seen_rows:
+                        reg_loss = reg_loss + weight_decay * torch.norm(seen_rows[id(w)], p=p, )
+                else:
+                    reg_loss = reg_loss + weight_decay * torch.norm(w, p=p, )
+        return reg_loss
+
+    def _record_lookups(self):
+        # in batch regularization mode, makes the embeddings record the ids looked up until the next
+        # get_regularization_loss
+        if self.regularization_mode == 'batch':
+            for module in self.modules():
+                if isinstance(module, (SparseUpdateEmbedding, EmbeddingArena)):
+                    module.seen_ids = []
 
     def add_auxiliary_loss(self, aux_loss, alpha):
         self.aux_loss = aux_loss * alpha
@@ -429,49 +857,135 @@ class BaseModel(nn.Module):
                 optimizer_sparse=None,
                 optimizer_dense_lr=0.001,
                 optimizer_sparse_lr=0.001,
+                optimizer_sparse_params=None,
+                optimizer_sparse_in_backward=False,
+                optimizer_linear=None,
+                optimizer_linear_lr=0.01,
+                optimizer_linear_params=None,
+                regularization=None,
                 ):
         """
         :param optimizer: String (name of optimizer) or optimizer instance. See [optimizers](https://pytorch.org/docs/stable/optim.html).
+        :param optimizer_sparse: String (name of optimizer) or optimizer instance for the embedding parameters. If `None`, `optimizer` updates all parameters.
+        :param optimizer_sparse_params: dict. Extra keyword arguments for the sparse optimizer built from a string, e.g. ``{'rowwise': True}`` for ``adagrad``/``radagrad``.
+        :param optimizer_linear: String (name of optimizer) or optimizer instance for the embeddings of the linear part, e.g. ``"ftrl"``. If `None`, they are updated by `optimizer_sparse` (or `optimizer`).
+        :param optimizer_linear_params: dict. Extra keyword arguments for the linear optimizer built from a string, e.g. ``{'l1': 1.0}`` for ``ftrl``.
+        :param regularization: String. ``"full"`` adds the L2 penalty of the whole weights as computed when the model was built, whose graph is kept across steps (``backward(retain_graph=True)``), ``"batch"`` computes it at every step and penalizes an embedding table only over the rows looked up in the current batch. Tables with dense gradients still get a gradient the size of the table. If `None`, ``"batch"`` for a model built with `sparse_embedding=True` (whose tables only take sparse gradients) and ``"full"`` otherwise.
         :param loss: String (name of objective function) or objective function. See [losses](https://pytorch.org/docs/stable/nn.functional.html#loss-functions).
         :param metrics: List of metrics to be evaluated by the model during training and testing. Typically you will use `metrics=['accuracy']`.
         """
 
-        self.optim, self.optim_s = self._get_optim(
-            optimizer, optimizer_sparse, optimizer_dense_lr, optimizer_sparse_lr)
+        if optimizer_sparse_in_backward and optimizer_sparse is None:
+            raise ValueError("optimizer_sparse_in_backward requires an optimizer_sparse to apply in backward")
+        self.optim, self.optim_s, self.optim_l = self._get_optim(
+            optimizer, optimizer_sparse, optimizer_dense_lr, optimizer_sparse_lr, optimizer_sparse_params,
+            optimizer_linear, optimizer_linear_lr, optimizer_linear_params)
+        self._set_optimizer_in_backward(self.optim_s if optimizer_sparse_in_backward else None)
+        for module in self.modules():
+            if isinstance(module, (DynamicEmbedding, CachedEmbedding, MmapEmbedding)):
+                module.optimizers = [optim for optim in (self.optim, self.optim_s, self.optim_l) if optim is not None
+                                     and any(p is module.weight for group in optim.param_groups
+                                             for p in group['params'])]
+            if isinstance(module, MmapEmbedding):
+                module.map_state()
+        sparse_ids = self._sparse_gradient_ids()
+        if regularization is None:
+            regularization = 'batch' if sparse_ids else 'full'
+        if regularization not in ('full', 'batch'):
+            raise ValueError("regularization must be 'full' or 'batch', got %s" % regularization)
+        if regularization == 'full' and sparse_ids:
+            raise ValueError("regularization='full' would give dense gradients to embedding tables built with "
+                             "sparse_embedding=True, use regularization='batch'")
+        self.regularization_mode = regularization
+        # weights regularized over their looked-up rows in batch mode
+        self._batch_regularized = set(
+            id(p) for module in self.modules() if isinstance(module, (SparseUpdateEmbedding, EmbeddingArena))
+            for p in module.parameters()) if regularization == 'batch' else set()
         self.loss_func = self._get_loss_func(loss)
         self.metrics = self._get_metrics(metrics, False)
 
+    def _sparse_gradient_ids(self):
+        # ids of the embedding tables whose gradients are sparse tensors
+        return set(id(p) for module in self.modules()
+                   if isinstance(module, (SparseUpdateEmbedding, EmbeddingArena)) and module.sparse
+                   for p in module.parameters())
+
+    def _set_optimizer_in_backward(self, optim):
+        if optim is not None and not hasattr(optim, 'sparse_step'):
+            raise ValueError("optimizer_sparse_in_backward requires a sparse optimizer with a `sparse_step` method")
+        param_ids = set(id(p) for group in optim.param_groups for p in group['params']) if optim is not None else set()
+        for module in self.modules():
+            if isinstance(module, SparseUpdateEmbedding):
+                module.optimizer = optim if id(module.weight) in param_ids else None
+            elif isinstance(module, EmbeddingArena):
+                in_optim = all(id(weight) in param_ids for weight in module.weight.values())
+                module.optimizer = optim if in_optim else None
+
     def _get_optim(self, optimizer, optimizer_sparse, optimizer_dense_lr,
-                   optimizer_sparse_lr):
+                   optimizer_sparse_lr, optimizer_sparse_params=None,
+                   optimizer_linear=None, optimizer_linear_lr=0.01, optimizer_linear_params=None):
         optim_s = None
+        optim_l = None
+        if optimizer_sparse_params is None:
+            optimizer_sparse_params = {}
+        if optimizer_linear_params is None:
+            optimizer_linear_params = {}
+
+        # embeddings of the linear part(s) get their own optimizer if optimizer_linear is given
+        linear_parameters = [p for module in self.modules() if isinstance(module, Linear)
+                             for p in module.embedding_dict.parameters()] if optimizer_linear is not None else []
+        linear_ids = set(id(p) for p in linear_parameters)
+        # tables with sparse gradients always go to the sparse optimizer, whatever their name
+        sparse_ids = self._sparse_gradient_ids()
+
+        def all_parameters(named_gen):
+            for name, item in named_gen:
+                if id(item) not in linear_ids:
+                    yield item
+
+        def sparse_parameters(named_gen):
+            for name, item in named_gen:
+                if ('embed' in name or id(item) in sparse_ids) and id(item) not in linear_ids:
+                    yield item
+
+        def dense_parameters(named_gen):
+            for name, item in named_gen:
+                if 'embed' not in name and id(item) not in sparse_ids:
+                    yield item
+
+        if len(linear_parameters) > 0:
+            if isinstance(optimizer_linear, str):
+                if optimizer_linear == "ftrl":
+                    optim_l = torch.optim.Ftrl(linear_parameters, lr=optimizer_linear_lr, **optimizer_linear_params)
+                elif optimizer_linear == "adagrad":
+                    optim_l = torch.optim.Adagrad(linear_parameters, lr=optimizer_linear_lr,
+                                                  **optimizer_linear_params)
+                elif optimizer_linear == "sgd":
+                    optim_l = torch.optim.SGD(linear_parameters, lr=optimizer_linear_lr, **optimizer_linear_params)
+                else:
+                    raise NotImplementedError
+            else:
+                optim_l = optimizer_linear
+
         if optimizer_sparse is None:
             if isinstance(optimizer, str):
                 if optimizer == "sgd":
                     optim = torch.optim.SGD(
-                        self.parameters(), lr=optimizer_dense_lr)
+                        all_parameters(self.named_parameters()), lr=optimizer_dense_lr)
                 elif optimizer == "adam":
                     optim = torch.optim.Adam(
-                        self.parameters(), lr=optimizer_dense_lr)  # 0.001
+                        all_parameters(self.named_parameters()), lr=optimizer_dense_lr)  # 0.001
                 elif optimizer == "adagrad":
                     optim = torch.optim.Adagrad(
-                        self.parameters(), lr=optimizer_dense_lr)  # 0.01
+                        all_parameters(self.named_parameters()), lr=optimizer_dense_lr)  # 0.01
                 elif optimizer == "rmsprop":
                     optim = torch.optim.RMSprop(
-                        self.parameters(), lr=optimizer_dense_lr)
+                        all_parameters(self.named_parameters()), lr=optimizer_dense_lr)
                 else:
                     raise NotImplementedError
             else:
                 optim = optimizer
         else:
-            def sparse_parameters(named_gen):
-                for name, item in named_gen:
-                    if 'embed' in name:
-                        yield item
-
-            def dense_parameters(named_gen):
-                for name, item in named_gen:
-                    if 'embed' not in name:
-                        yield item
 
             if isinstance(optimizer, str):
                 if optimizer == "sgd":
@@ -493,22 +1007,24 @@ class BaseModel(nn.Module):
             if isinstance(optimizer_sparse, str):
                 if optimizer_sparse == "sgd":
                     optim_s = torch.optim.SGD(sparse_parameters(
-                        self.named_parameters()), lr=optimizer_sparse_lr)
+                        self.named_parameters()), lr=optimizer_sparse_lr, **optimizer_sparse_params)
                 elif optimizer_sparse == "adam":
                     optim_s = torch.optim.Adam(sparse_parameters(
-                        self.named_parameters()), lr=optimizer_sparse_lr)  # 0.001
+                        self.named_parameters()), lr=optimizer_sparse_lr, **optimizer_sparse_params)  # 0.001
                 elif optimizer_sparse == "adagrad":
                     optim_s = torch.optim.Adagrad(
-                        sparse_parameters(self.named_parameters()), lr=optimizer_sparse_lr)  # 0.01
+                        sparse_parameters(self.named_parameters()), lr=optimizer_sparse_lr,
+                        **optimizer_sparse_params)  # 0.01
                 elif optimizer_sparse == "radagrad":
                     optim_s = torch.optim.RAdagrad(
-                        sparse_parameters(self.named_parameters()), lr=optimizer_sparse_lr, alpha = 0.9999)
+                        sparse_parameters(self.named_parameters()), lr=optimizer_sparse_lr, alpha = 0.9999,
+                        **optimizer_sparse_params)
                 else:
                     raise NotImplementedError
             else:
                 optim_s = optimizer_sparse
 
-        return optim, optim_s
+        return optim, optim_s, optim_l
 
     def _get_loss_func(self, loss):
         if isinstance(loss, str):
@@ -34,6 +34,9 @@ class CCPM(BaseModel):
     :param seed: integer ,to use as random seed.
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
     :param device: str, ``"cpu"`` or ``"cuda:0"``
+    :param embedding_arena: bool. Whether to store all embedding tables of the same dimension in one ``EmbeddingArena`` tensor, looked up with one gather per batch.
+    :param sparse_embedding: bool. Whether the embedding tables produce sparse gradients, which the sparse optimizer then applies to the looked-up rows only.
+    :param fuse_linear_embedding: bool. Whether a feature of both the linear and the deep part keeps its linear weight as an extra column of its deep embedding table, so that one lookup feeds both parts.
     :return: A PyTorch model instance.
 
     """
@@ -41,7 +44,8 @@ class CCPM(BaseModel):
     def __init__(self, linear_feature_columns, dnn_feature_columns, conv_kernel_width=(6, 5),
                  conv_filters=(4, 4),
                  dnn_hidden_units=(256,), l2_reg_linear=1e-5, l2_reg_embedding=1e-5, l2_reg_dnn=0, dnn_dropout=0,
-                 init_std=0.0001, seed=1024, task='binary', device='cpu', dnn_use_bn=False, dnn_activation='relu'):
+                 init_std=0.0001, seed=1024, task='binary', device='cpu', embedding_arena=False, sparse_embedding=False, dnn_use_bn=False, dnn_activation='relu',
+                 fuse_linear_embedding=False):
 
         super(CCPM, self).__init__(linear_feature_columns, dnn_feature_columns,
                                    dnn_hidden_units=dnn_hidden_units,
@@ -49,7 +53,8 @@ class CCPM(BaseModel):
                                    l2_reg_embedding=l2_reg_embedding, l2_reg_dnn=l2_reg_dnn, init_std=init_std,
                                    seed=seed,
                                    dnn_dropout=dnn_dropout, dnn_activation=dnn_activation,
-                                   task=task, device=device)
+                                   task=task, device=device, embedding_arena=embedding_arena, sparse_embedding=sparse_embedding,
+                                   fuse_linear_embedding=fuse_linear_embedding)
 
         if len(conv_kernel_width) != len(conv_filters):
             raise ValueError(
@@ -30,6 +30,9 @@ class DCN(BaseModel):
     :param dnn_activation: Activation function to use in DNN
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
     :param device: str, ``"cpu"`` or ``"cuda:0"``
+    :param embedding_arena: bool. Whether to store all embedding tables of the same dimension in one ``EmbeddingArena`` tensor, looked up with one gather per batch.
+    :param sparse_embedding: bool. Whether the embedding tables produce sparse gradients, which the sparse optimizer then applies to the looked-up rows only.
+    :param fuse_linear_embedding: bool. Whether a feature of both the linear and the deep part keeps its linear weight as an extra column of its deep embedding table, so that one lookup feeds both parts.
     :return: A PyTorch model instance.
     
     """
@@ -39,7 +42,8 @@ class DCN(BaseModel):
                  dnn_hidden_units=(128, 128), l2_reg_linear=0.00001,
                  l2_reg_embedding=0.00001, l2_reg_cross=0.00001, l2_reg_dnn=0, init_std=0.0001, seed=1024,
                  dnn_dropout=0,
-                 dnn_activation='relu', dnn_use_bn=False, task='binary', device='cpu'):
+                 dnn_activation='relu', dnn_use_bn=False, task='binary', device='cpu', embedding_arena=False, sparse_embedding=False,
+                 fuse_linear_embedding=False):
 
         super(DCN, self).__init__(linear_feature_columns=linear_feature_columns,
                                   dnn_feature_columns=dnn_feature_columns,
@@ -47,7 +51,8 @@ class DCN(BaseModel):
                                   l2_reg_embedding=l2_reg_embedding, l2_reg_dnn=l2_reg_dnn, init_std=init_std,
                                   seed=seed,
                                   dnn_dropout=dnn_dropout, dnn_activation=dnn_activation,
-                                  task=task, device=device)
+                                  task=task, device=device, embedding_arena=embedding_arena, sparse_embedding=sparse_embedding,
+                                  fuse_linear_embedding=fuse_linear_embedding)
         self.dnn_hidden_units = dnn_hidden_units
         self.cross_num = cross_num
         self.dnn = DNN(self.compute_input_dim(dnn_feature_columns), dnn_hidden_units,
@@ -34,6 +34,8 @@ class DIEN(BaseModel):
        :param seed: integer ,to use as random seed.
        :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
        :param device: str, ``"cpu"`` or ``"cuda:0"``
+       :param embedding_arena: bool. Whether to store all embedding tables of the same dimension in one ``EmbeddingArena`` tensor, looked up with one gather per batch.
+       :param sparse_embedding: bool. Whether the embedding tables produce sparse gradients, which the sparse optimizer then applies to the looked-up rows only.
        :return: A PyTorch model instance.
     """
 
@@ -43,12 +45,12 @@ class DIEN(BaseModel):
                  dnn_activation='relu',
                  att_hidden_units=(64, 16), att_activation="relu", att_weight_normalization=True,
                  l2_reg_dnn=0, l2_reg_embedding=1e-6, dnn_dropout=0, init_std=0.0001, seed=1024, task='binary',
-                 device='cpu'):
+                 device='cpu', embedding_arena=False, sparse_embedding=False):
         super(DIEN, self).__init__([], dnn_feature_columns, dnn_hidden_units=dnn_hidden_units,
                                    l2_reg_linear=0, l2_reg_embedding=l2_reg_embedding,
                                    l2_reg_dnn=l2_reg_dnn, init_std=init_std, seed=seed,
                                    dnn_dropout=dnn_dropout, dnn_activation=dnn_activation,
-                                   task=task, device=device)
+                                   task=task, device=device, embedding_arena=embedding_arena, sparse_embedding=sparse_embedding)
 
         self.item_features = history_feature_list
         self.use_negsampling = use_negsampling
@@ -97,7 +99,7 @@ class DIEN(BaseModel):
         # [B, H2]
         deep_input_emb = self._get_deep_input_emb(X)
         deep_input_emb = concat_fun([hist, deep_input_emb])
-        dense_value_list = get_dense_input(X, self.feature_index, self.dense_feature_columns)
+        dense_value_list = self.input_plan.dense_values(X)
         dnn_input = combined_dnn_input([deep_input_emb], dense_value_list)
         # [B, 1]
         output = self.linear(self.dnn(dnn_input))
@@ -105,41 +107,24 @@ class DIEN(BaseModel):
         return y_pred
 
     def _get_emb(self, X):
-        # history feature columns : pos, neg
-        history_feature_columns = []
-        neg_history_feature_columns = []
-        sparse_varlen_feature_columns = []
-        history_fc_names = list(map(lambda x: "hist_" + x, self.item_features))
-        neg_history_fc_names = list(map(lambda x: "neg_" + x, history_fc_names))
-        for fc in self.varlen_sparse_feature_columns:
-            feature_name = fc.name
-            if feature_name in history_fc_names:
-                history_feature_columns.append(fc)
-            elif feature_name in neg_history_fc_names:
-                neg_history_feature_columns.append(fc)
-            else:
-                sparse_varlen_feature_columns.append(fc)
-
         # convert input to emb
-        features = self.feature_index
-        query_emb_list = embedding_lookup(X, self.embedding_dict, features, self.sparse_feature_columns,
-                                          return_feat_list=self.item_features, to_list=True)
+        query_emb_list = self.query_plan.sparse_embeddings(X, self.embedding_dict)
         # [batch_size, dim]
         query_emb = torch.squeeze(concat_fun(query_emb_list), 1)
 
-        keys_emb_list = embedding_lookup(X, self.embedding_dict, features, history_feature_columns,
-                                         return_feat_list=history_fc_names, to_list=True)
+        keys_emb_list = self.keys_plan.sequence_embeddings(X, self.embedding_dict)
         # [batch_size, max_len, dim]
         keys_emb = concat_fun(keys_emb_list)
 
-        keys_length_feature_name = [feat.length_name for feat in self.varlen_sparse_feature_columns if
-                                    feat.length_name is not None]
         # [batch_size]
-        keys_length = torch.squeeze(maxlen_lookup(X, features, keys_length_feature_name), 1)
+        if self.keys_length_feature_name:
+            keys_length = torch.squeeze(maxlen_lookup(X, self.feature_index, self.keys_length_feature_name), 1)
+        else:
+            # jagged histories carry their lengths in their offsets
+            keys_length = self.keys_plan.sequence_lengths(X)[0]
 
         if self.use_negsampling:
-            neg_keys_emb_list = embedding_lookup(X, self.embedding_dict, features, neg_history_feature_columns,
-                                                 return_feat_list=neg_history_fc_names, to_list=True)
+            neg_keys_emb_list = self.neg_keys_plan.sequence_embeddings(X, self.embedding_dict)
             neg_keys_emb = concat_fun(neg_keys_emb_list)
         else:
             neg_keys_emb = None
@@ -147,15 +132,23 @@ class DIEN(BaseModel):
         return query_emb, keys_emb, neg_keys_emb, keys_length
 
     def _split_columns(self):
-        self.sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, SparseFeat), self.dnn_feature_columns)) if len(
-            self.dnn_feature_columns) else []
-        self.dense_feature_columns = list(
-            filter(lambda x: isinstance(x, DenseFeat), self.dnn_feature_columns)) if len(
-            self.dnn_feature_columns) else []
-        self.varlen_sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, VarLenSparseFeat),
-                   self.dnn_feature_columns)) if len(self.dnn_feature_columns) else []
+        self.sparse_feature_columns = self.input_plan.sparse_feature_columns
+        self.dense_feature_columns = self.input_plan.dense_feature_columns
+        self.varlen_sparse_feature_columns = self.input_plan.varlen_sparse_feature_columns
+
+        # history feature columns : pos, neg
+        history_fc_names = list(map(lambda x: "hist_" + x, self.item_features))
+        neg_history_fc_names = list(map(lambda x: "neg_" + x, history_fc_names))
+        history_feature_columns = [fc for fc in self.varlen_sparse_feature_columns if fc.name in history_fc_names]
+        neg_history_feature_columns = [fc for fc in self.varlen_sparse_feature_columns
+                                       if fc.name in neg_history_fc_names]
+        self.keys_length_feature_name = [feat.length_name for feat in self.varlen_sparse_feature_columns if
+                                         feat.length_name is not None]
+
+        self.query_plan = InputPlan([fc for fc in self.sparse_feature_columns if fc.name in self.item_features],
+                                    self.feature_index)
+        self.keys_plan = InputPlan(history_feature_columns, self.feature_index)
+        self.neg_keys_plan = InputPlan(neg_history_feature_columns, self.feature_index)
 
     def _compute_interest_dim(self):
         interest_dim = 0
@@ -173,8 +166,7 @@ class DIEN(BaseModel):
         return dnn_input_dim
 
     def _get_deep_input_emb(self, X):
-        dnn_input_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.sparse_feature_columns,
-                                              mask_feat_list=self.item_features, to_list=True)
+        dnn_input_emb_list = self.input_plan.sparse_embeddings(X, self.embedding_dict)
         dnn_input_emb = concat_fun(dnn_input_emb_list)
         return dnn_input_emb.squeeze(1)
 
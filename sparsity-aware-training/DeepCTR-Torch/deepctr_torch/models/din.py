@@ -29,6 +29,8 @@ class DIN(BaseModel):
     :param init_std: float,to use as the initialize std of embedding vector
     :param seed: integer ,to use as random seed.
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
+    :param embedding_arena: bool. Whether to store all embedding tables of the same dimension in one ``EmbeddingArena`` tensor, looked up with one gather per batch.
+    :param sparse_embedding: bool. Whether the embedding tables produce sparse gradients, which the sparse optimizer then applies to the looked-up rows only.
     :return:  A PyTorch model instance.
 
     """
@@ -37,14 +39,14 @@ class DIN(BaseModel):
                  dnn_hidden_units=(256, 128), dnn_activation='relu', att_hidden_size=(64, 16),
                  att_activation='Dice', att_weight_normalization=False, l2_reg_dnn=0.0,
                  l2_reg_embedding=1e-6, dnn_dropout=0, init_std=0.0001,
-                 seed=1024, task='binary', device='cpu'):
+                 seed=1024, task='binary', device='cpu', embedding_arena=False, sparse_embedding=False):
         super(DIN, self).__init__([], dnn_feature_columns,
                                   dnn_hidden_units=dnn_hidden_units, l2_reg_linear=0,
                                   l2_reg_dnn=l2_reg_dnn, init_std=init_std,
                                   l2_reg_embedding=l2_reg_embedding,
                                   dnn_dropout=dnn_dropout, dnn_activation=dnn_activation,
                                   seed=seed, task=task, 
-                                  device=device)
+                                  device=device, embedding_arena=embedding_arena, sparse_embedding=sparse_embedding)
 
         self.sparse_feature_columns = list(
             filter(lambda x: isinstance(x, SparseFeat), dnn_feature_columns)) if dnn_feature_columns else []
@@ -64,6 +66,11 @@ class DIN(BaseModel):
             else:
                 self.sparse_varlen_feature_columns.append(fc)
 
+        self.query_plan = InputPlan([fc for fc in self.sparse_feature_columns if fc.name in history_feature_list],
+                                    self.feature_index)
+        self.keys_plan = InputPlan(self.history_feature_columns, self.feature_index)
+        self.sequence_plan = InputPlan(self.sparse_varlen_feature_columns, self.feature_index)
+
         att_emb_dim = self._compute_interest_dim()
 
         self.attention = AttentionSequencePoolingLayer(att_hidden_units=att_hidden_size,
@@ -84,22 +91,14 @@ class DIN(BaseModel):
 
 
     def forward(self, X):
-        sparse_embedding_list, dense_value_list = self.input_from_feature_columns(X, self.dnn_feature_columns,
-                                                                                  self.embedding_dict)
+        dense_value_list = self.input_plan.dense_values(X)
 
         # sequence pooling part
-        query_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.sparse_feature_columns,
-                                          self.history_feature_list, self.history_feature_list, to_list=True)
-        keys_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.history_feature_columns,
-                                         self.history_fc_names, self.history_fc_names, to_list=True)
-        dnn_input_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.sparse_feature_columns, mask_feat_list=self.history_feature_list, to_list=True)
-
-
-        sequence_embed_dict = varlen_embedding_lookup(X, self.embedding_dict, self.feature_index,
-                                                      self.sparse_varlen_feature_columns)
+        query_emb_list = self.query_plan.sparse_embeddings(X, self.embedding_dict)
+        keys_emb_list = self.keys_plan.sequence_embeddings(X, self.embedding_dict)
+        dnn_input_emb_list = self.input_plan.sparse_embeddings(X, self.embedding_dict)
 
-        sequence_embed_list = get_varlen_pooling_list(sequence_embed_dict, X, self.feature_index,
-                                                      self.sparse_varlen_feature_columns, self.device)
+        sequence_embed_list = self.sequence_plan.pooled_embeddings(X, self.embedding_dict)
 
         dnn_input_emb_list += sequence_embed_list
 
@@ -10,7 +10,7 @@ import torch
 import torch.nn as nn
 
 from .basemodel import Linear, BaseModel
-from ..inputs import build_input_features
+from ..inputs import build_input_features, build_input_hashes, count_id_columns
 from ..layers import PredictionLayer
 
 
@@ -57,6 +57,10 @@ class MLR(BaseModel):
 
         self.feature_index = build_input_features(
             self.region_feature_columns + self.base_feature_columns + self.bias_feature_columns)
+        self.num_id_columns = count_id_columns(
+            self.region_feature_columns + self.base_feature_columns + self.bias_feature_columns)
+        self.feature_hash = build_input_hashes(
+            self.region_feature_columns + self.base_feature_columns + self.bias_feature_columns)
 
         self.region_linear_model = nn.ModuleList([Linear(
             self.region_feature_columns, self.feature_index, self.init_std, self.device) for i in
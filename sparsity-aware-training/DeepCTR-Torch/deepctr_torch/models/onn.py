@@ -8,14 +8,14 @@ Reference:
 
 from .basemodel import *
 from ..inputs import combined_dnn_input
-from ..layers import DNN
+from ..layers import DNN, SparseUpdateEmbedding
 
 
 class Interac(nn.Module):
     def __init__(self, first_size, second_size, emb_size, init_std, sparse=False):
         super(Interac, self).__init__()
-        self.emb1 = nn.Embedding(first_size, emb_size, sparse=sparse)
-        self.emb2 = nn.Embedding(second_size, emb_size, sparse=sparse)
+        self.emb1 = SparseUpdateEmbedding(first_size, emb_size, sparse=sparse)
+        self.emb2 = SparseUpdateEmbedding(second_size, emb_size, sparse=sparse)
         self.__init_weight(init_std)
 
     def __init_weight(self, init_std):
@@ -50,6 +50,9 @@ class ONN(BaseModel):
     :param reduce_sum: bool,whether apply reduce_sum on cross vector
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
     :param device: str, ``"cpu"`` or ``"cuda:0"``
+    :param embedding_arena: bool. Whether to store all embedding tables of the same dimension in one ``EmbeddingArena`` tensor, looked up with one gather per batch.
+    :param sparse_embedding: bool. Whether the embedding tables produce sparse gradients, which the sparse optimizer then applies to the looked-up rows only.
+    :param fuse_linear_embedding: bool. Whether a feature of both the linear and the deep part keeps its linear weight as an extra column of its deep embedding table, so that one lookup feeds both parts.
     :return: A PyTorch model instance.
     
     """
@@ -58,19 +61,21 @@ class ONN(BaseModel):
                  dnn_hidden_units=(128, 128),
                  l2_reg_embedding=1e-5, l2_reg_linear=1e-5, l2_reg_dnn=0,
                  dnn_dropout=0, init_std=0.0001, seed=1024, dnn_use_bn=False, dnn_activation='relu',
-                 task='binary', device='cpu'):
+                 task='binary', device='cpu', embedding_arena=False, sparse_embedding=False,
+                 fuse_linear_embedding=False):
         super(ONN, self).__init__(linear_feature_columns, dnn_feature_columns,
                                   dnn_hidden_units=dnn_hidden_units,
                                   l2_reg_linear=l2_reg_linear,
                                   l2_reg_embedding=l2_reg_embedding, l2_reg_dnn=l2_reg_dnn, init_std=init_std,
                                   seed=seed,
                                   dnn_dropout=dnn_dropout, dnn_activation=dnn_activation,
-                                  task=task, device=device)
+                                  task=task, device=device, embedding_arena=embedding_arena, sparse_embedding=sparse_embedding,
+                                  fuse_linear_embedding=fuse_linear_embedding)
 
         # second order part
         embedding_size = self.embedding_size
         self.second_order_embedding_dict = self.__create_second_order_embedding_matrix(
-            dnn_feature_columns, embedding_size=embedding_size, sparse=False).to(device)
+            dnn_feature_columns, embedding_size=embedding_size, sparse=sparse_embedding).to(device)
 
         # add regularization for second_order_embedding
         self.add_regularization_loss(
@@ -116,9 +121,9 @@ class ONN(BaseModel):
                 second_order_embedding_list.append(
                     second_order_embedding_dict[first_name + "+" + second_name](
                         X[:, self.feature_index[first_name][0]
-                             :self.feature_index[first_name][1]].long(),
+                             :self.feature_index[first_name][1]],
                         X[:, self.feature_index[second_name][0]
-                             :self.feature_index[second_name][1]].long()
+                             :self.feature_index[second_name][1]]
                     )
                 )
         return second_order_embedding_list
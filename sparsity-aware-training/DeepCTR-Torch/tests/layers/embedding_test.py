@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+
+from deepctr_torch.layers import SparseUpdateEmbedding, EmbeddingArena, CompactEmbedding, DynamicEmbedding, \
+    AdmissionEmbedding, QREmbedding, QuantizedEmbedding, CachedEmbedding, \
+    MmapEmbedding, FusedEmbedding, SequencePoolingLayer, pool_bags, pad_bags
+
+
+class RecordingOptimizer(object):
+    def __init__(self):
+        self.calls = []
+
+    def sparse_step(self, p, indices, values):
+        self.calls.append((p, indices, values))
+
+
+def test_SparseUpdateEmbedding_in_backward():
+    embedding = SparseUpdateEmbedding(10, 4)
+    optimizer = RecordingOptimizer()
+    embedding.optimizer = optimizer
+
+    embedding(torch.LongTensor([[1, 2], [2, 3]])).sum().backward()
+
+    assert embedding.weight.grad is None
+    p, indices, values = optimizer.calls[0]
+    assert p is embedding.weight
+    assert indices.tolist() == [1, 2, 2, 3]
+    assert values.shape == (4, 4)
+
+
+def test_SparseUpdateEmbedding_in_backward_shared():
+    # a table looked up twice, like the query and the history of DIN sharing an embedding_name
+    embedding = SparseUpdateEmbedding(10, 4)
+    optimizer = RecordingOptimizer()
+    embedding.optimizer = optimizer
+
+    (embedding(torch.LongTensor([[1]])).sum() + 2 * embedding(torch.LongTensor([[1, 3]])).sum()).backward()
+
+    # stepped once, with the gradients of both lookups
+    assert len(optimizer.calls) == 1
+    p, indices, values = optimizer.calls[0]
+    assert p is embedding.weight
+    assert sorted(indices.tolist()) == [1, 1, 3]
+    assert values.sum().item() == 4 * (1 + 2 + 2)
+
+
+class FailingBackward(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, input):
+        return input.clone()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        raise RuntimeError("failing backward")
+
+
+def test_SparseUpdateEmbedding_in_backward_after_failure():
+    embedding = SparseUpdateEmbedding(10, 4)
+    optimizer = RecordingOptimizer()
+    embedding.optimizer = optimizer
+
+    # created before the lookup, so its backward runs after the lookup has queued its step
+    failing = FailingBackward.apply(torch.ones(1, requires_grad=True))
+    with pytest.raises(RuntimeError):
+        (embedding(torch.LongTensor([[1]])) * failing).sum().backward()
+    assert not optimizer.calls
+
+    # the next backward pass still steps, with its own gradient only
+    embedding(torch.LongTensor([[2]])).sum().backward()
+    assert len(optimizer.calls) == 1
+    assert optimizer.calls[0][1].tolist() == [2]
+
+
+def test_SparseUpdateEmbedding_without_optimizer():
+    embedding = SparseUpdateEmbedding(10, 4)
+    embedding(torch.LongTensor([[1, 2]])).sum().backward()
+    assert embedding.weight.grad is not None
+
+
+@pytest.mark.parametrize(
+    'mode',
+    ['sum', 'mean', 'max']
+)
+def test_SparseUpdateEmbedding_bag(mode):
+    embedding = SparseUpdateEmbedding(10, 4)
+    seq = torch.LongTensor([[1, 2, 0], [3, 0, 0], [0, 0, 0]])
+    mask = seq != 0
+    expected = SequencePoolingLayer(mode, supports_masking=True)([embedding(seq), mask]).squeeze(1).detach()
+    expected[2] = 0
+    offsets = torch.LongTensor([0, 2, 3])
+    assert torch.allclose(embedding.bag(seq[mask], offsets, mode), expected)
+    # looked up through forward and pooled apart, as for an optimizer applied in backward
+    embedding.optimizer = RecordingOptimizer()
+    pooled = embedding.bag(seq[mask], offsets, mode)
+    assert torch.allclose(pooled, expected)
+    pooled.sum().backward()
+    assert embedding.optimizer.calls[0][1].tolist() == [1, 2, 3]
+
+
+def test_pool_bags_weights():
+    embeddings = torch.Tensor([[1, 2], [3, 4], [5, 6]])
+    offsets = torch.LongTensor([0, 2])
+    weights = torch.Tensor([1, 0.5, 2])
+    assert torch.equal(pool_bags(embeddings, offsets, 'sum', weights), torch.Tensor([[2.5, 4], [10, 12]]))
+    assert torch.equal(pool_bags(embeddings, offsets, 'mean', weights), torch.Tensor([[1.25, 2], [10, 12]]))
+    assert torch.equal(pool_bags(embeddings, offsets, 'max', weights), torch.Tensor([[1.5, 2], [10, 12]]))
+    assert torch.equal(SparseUpdateEmbedding.from_pretrained(embeddings).bag(torch.LongTensor([0, 1, 2]), offsets,
+                                                                            'mean', weights),
+                       torch.Tensor([[1.25, 2], [10, 12]]))
+
+
+def test_pad_bags():
+    embeddings = torch.Tensor([[1, 2], [3, 4], [5, 6]])
+    offsets = torch.LongTensor([0, 0, 2])
+    assert torch.equal(pad_bags(embeddings, offsets),
+                       torch.Tensor([[[0, 0], [0, 0]], [[1, 2], [3, 4]], [[5, 6], [0, 0]]]))
+    assert torch.equal(pad_bags(embeddings, offsets, maxlen=1), torch.Tensor([[[0, 0]], [[1, 2]], [[5, 6]]]))
+
+
+def test_FusedEmbedding():
+    table = SparseUpdateEmbedding(10, 3)
+    table.optimizer = RecordingOptimizer()
+    embedding = FusedEmbedding(table)
+    linear = embedding.linear_table()
+    assert embedding.embedding_dim == 2 and linear.embedding_dim == 1
+
+    input = torch.LongTensor([[1], [4]])
+    deep_output = embedding(input)
+    linear_output = linear(input.clone())
+    assert torch.equal(deep_output, table.weight[input][..., :2])
+    assert torch.equal(linear_output, table.weight[input][..., 2:])
+    # one gather, so one sparse update holding the gradients of both parts
+    (deep_output.sum() + 2 * linear_output.sum()).backward()
+    assert len(table.optimizer.calls) == 1
+    assert torch.equal(table.optimizer.calls[0][2], torch.Tensor([[1, 1, 2], [1, 1, 2]]))
+
+    # other ids are looked up again
+    linear(torch.LongTensor([[2]]))
+    embedding(torch.LongTensor([[1]])).sum().backward()
+    assert len(table.optimizer.calls) == 2
+
+
+def test_EmbeddingArena():
+    arena = EmbeddingArena([('a', 3, 4), ('b', 5, 4), ('c', 2, 8)])
+    for weight in arena.weight.values():
+        torch.nn.init.normal_(weight)
+    assert arena.weight['4'].shape == (8, 4)
+    assert arena.weight['8'].shape == (2, 8)
+
+    ids = torch.LongTensor([[0, 4, 1], [2, 0, 0]])
+    outputs = arena(ids, ['a', 'b', 'c'])
+    for i, name in enumerate(['a', 'b', 'c']):
+        assert outputs[i].shape == (2, 1, arena[name].embedding_dim)
+        assert torch.equal(outputs[i], arena[name](ids[:, i:i + 1]))
+        assert torch.equal(outputs[i][:, 0], arena[name].weight[ids[:, i]])
+
+
+def test_EmbeddingArena_in_backward():
+    arena = EmbeddingArena([('a', 3, 4), ('b', 5, 4)])
+    optimizer = RecordingOptimizer()
+    arena.optimizer = optimizer
+
+    arena(torch.LongTensor([[1, 2]]), ['a', 'b'])[1].sum().backward()
+
+    p, indices, values = optimizer.calls[0]
+    assert p is arena.weight['4']
+    assert indices.tolist() == [1, 5]
+
+
+def test_CompactEmbedding():
+    weight = torch.zeros(10, 1)
+    weight[[2, 7, 9]] = torch.Tensor([[0.5], [-1.0], [2.0]])
+    embedding = CompactEmbedding.from_weight(weight)
+    assert embedding.ids.tolist() == [2, 7, 9]
+
+    ids = torch.LongTensor([[0, 2], [7, 8], [9, 1]])
+    assert torch.equal(embedding(ids), torch.nn.functional.embedding(ids, weight))
+
+
+def test_DynamicEmbedding():
+    embedding = DynamicEmbedding(3, 2, expire_steps=1)
+    optimizer = torch.optim.Adagrad(embedding.parameters(), initial_accumulator_value=0.)
+    embedding.optimizers = [optimizer]
+
+    for ids in ([[10 ** 12], [7]], [[7], [7]]):
+        embedding.next_step()
+        optimizer.zero_grad()
+        embedding(torch.LongTensor(ids)).sum().backward()
+        optimizer.step()
+    assert set(embedding.index) == {10 ** 12, 7}
+    row = embedding.index[10 ** 12]
+    assert optimizer.state[embedding.weight]['sum'][row].gt(0).all()
+
+    # lookups of one step, e.g. by several features, do not age the rows
+    embedding(torch.LongTensor([[7]]))
+    embedding(torch.LongTensor([[7]]))
+    assert not embedding._expired(torch.LongTensor([row])).any()
+
+    # 10 ** 12 was not looked up for more than expire_steps, its row goes to a new id with fresh state
+    embedding.next_step()
+    embedding(torch.LongTensor([[1], [2], [7]]))
+    assert 10 ** 12 not in embedding.index and len(embedding.index) == 3
+    reused = [embedding.index[key] for key in (1, 2) if embedding.index[key] == row]
+    assert len(reused) == 1
+    assert optimizer.state[embedding.weight]['sum'][row].eq(0).all()
+
+    embedding.eval()
+    assert embedding(torch.LongTensor([[5]])).abs().sum() == 0
+
+    state = embedding.state_dict()
+    loaded = DynamicEmbedding(3, 2)
+    loaded.load_state_dict(state)
+    assert loaded.index == embedding.index
+
+
+def test_CachedEmbedding():
+    embedding = CachedEmbedding(5, 2, cache_size=2, storage='memory')
+    optimizer = torch.optim.Adagrad(embedding.parameters(), initial_accumulator_value=0.)
+    embedding.optimizers = [optimizer]
+
+    for ids in ([[0], [1]], [[2], [3]]):
+        embedding.next_step()
+        optimizer.zero_grad()
+        embedding(torch.LongTensor(ids)).sum().backward()
+        optimizer.step()
+    # 0 and 1 were evicted by 2 and 3, with their rows and optimizer state
+    assert set(embedding.slots) == {2, 3}
+    assert embedding.state_saved[:2].all() and not embedding.state_saved[2:].any()
+    saved = embedding.host_state['0.sum'][0].clone()
+    assert saved.gt(0).all()
+
+    embedding.next_step()
+    embedding(torch.LongTensor([[0]]))
+    assert torch.equal(optimizer.state[embedding.weight]['sum'][embedding.slots[0]], saved)
+    try:
+        embedding(torch.LongTensor([[1], [4]]))
+        assert False, "the rows of one step must not evict each other"
+    except RuntimeError:
+        pass
+
+    embedding.prefetch(torch.LongTensor([4]))
+    embedding.next_step()
+    slots = dict(embedding.slots)
+    embedding(torch.LongTensor([[4]]))
+    assert 4 in slots and embedding.slots == slots
+
+    embedding.eval()
+    weight = embedding.full_weight().clone()
+    assert torch.equal(embedding(torch.LongTensor([[1, 3]]))[0], weight[[1, 3]])
+
+    loaded = CachedEmbedding(5, 2, cache_size=3, storage='memory')
+    loaded.load_state_dict(embedding.state_dict())
+    assert torch.equal(loaded.full_weight(), weight)
+    assert torch.equal(loaded.host_state['0.sum'][0], saved)
+
+
+def test_MmapEmbedding(tmpdir):
+    path = str(tmpdir.join('table'))
+    embedding = MmapEmbedding(5, 2, path, sparse=True)
+    optimizer = torch.optim.Adagrad(embedding.parameters(), initial_accumulator_value=0.)
+    embedding.optimizers = [optimizer]
+    # the state is allocated in its file by the optimizer
+    assert optimizer.state[embedding.weight]['sum'] is embedding.state_files['adagrad.sum']
+
+    embedding(torch.LongTensor([[1], [3]])).sum().backward()
+    optimizer.step()
+    embedding.flush()
+
+    # the files are the table: a new instance opens them as they are
+    reopened = MmapEmbedding(5, 2, path, sparse=True)
+    assert reopened.opened and torch.equal(reopened.weight, embedding.weight)
+    reopened_optimizer = torch.optim.Adagrad(reopened.parameters(), initial_accumulator_value=0.)
+    reopened.optimizers = [reopened_optimizer]
+    state_sum = reopened_optimizer.state[reopened.weight]['sum']
+    assert torch.equal(state_sum, optimizer.state[embedding.weight]['sum'])
+    assert state_sum[[1, 3]].gt(0).all() and state_sum[[0, 2, 4]].eq(0).all()
+
+    # state replaced by Optimizer.load_state_dict is put back
+    del reopened_optimizer.state[reopened.weight]['sum']
+    reopened.map_state()
+    assert reopened_optimizer.state[reopened.weight]['sum'] is state_sum
+
+
+def test_MmapEmbedding_ftrl_state(tmpdir):
+    embedding = MmapEmbedding(5, 1, str(tmpdir.join('table')), sparse=True)
+    optimizer = torch.optim.Ftrl(embedding.parameters(), initial_accumulator_value=0.5)
+    state = optimizer.state[embedding.weight]
+    assert state['z'] is embedding.state_files['ftrl.z'] and state['n'] is embedding.state_files['ftrl.n']
+    assert state['n'].eq(0.5).all()
+
+
+def test_AdmissionEmbedding():
+    embedding = AdmissionEmbedding(DynamicEmbedding(10, 2), min_count=2, width=64)
+
+    output = embedding(torch.LongTensor([[3], [4], [4]]))
+    # 4 is admitted by its second lookup, 3 stays on the default row and takes no row
+    assert output[0].eq(embedding.default).all()
+    assert set(embedding.embedding.index) == {4}
+    output.sum().backward()
+    assert embedding.default.grad.eq(1).all()
+
+    embedding(torch.LongTensor([[3]]))
+    assert set(embedding.embedding.index) == {3, 4}
+
+
+def test_AdmissionEmbedding_sketch_rows():
+    embedding = AdmissionEmbedding(DynamicEmbedding(10, 2), min_count=2, width=16, depth=2)
+    ids = torch.arange(1000)
+    buckets = embedding.buckets(ids)
+    assert buckets.min() >= 0 and buckets.max() < 16
+    # two ids sharing a counter in the first row are told apart by the second
+    first, second = next((x, y) for x in range(1000) for y in range(x + 1, 1000)
+                         if buckets[0, x] == buckets[0, y] and buckets[1, x] != buckets[1, y])
+    embedding(torch.LongTensor([first, first]))
+    assert embedding.admitted(torch.LongTensor([first])).all()
+    embedding.eval()
+    assert not embedding.admitted(torch.LongTensor([second])).any()
+
+
+def test_QREmbedding():
+    for operation in ('mult', 'add', 'concat'):
+        embedding = QREmbedding(10, 4, num_collisions=3, operation=operation)
+        assert embedding.quotient.num_embeddings == 4 and embedding.remainder.num_embeddings == 3
+        input = torch.LongTensor([[0, 9], [4, 5]])
+        output = embedding(input)
+        assert output.size() == (2, 2, 4)
+        if operation != 'concat':
+            # the remainder rows start neutral
+            assert torch.equal(output, embedding.quotient.weight[input // 3])
+        output.sum().backward()
+        assert embedding.remainder.weight.grad is not None
+
+
+def test_QuantizedEmbedding():
+    weight = torch.randn(10, 4)
+    weight[3] = 0.5
+    input = torch.LongTensor([[1, 3], [9, 1]])
+    expected = torch.nn.functional.embedding(input, weight)
+
+    fp16 = QuantizedEmbedding.from_weight(weight, 'fp16')
+    assert fp16.weight.dtype == torch.float16
+    assert torch.allclose(fp16(input), expected, atol=1e-2)
+
+    int8 = QuantizedEmbedding.from_weight(weight, 'int8')
+    assert int8.weight.dtype == torch.uint8
+    assert int8(input).size() == (2, 2, 4)
+    step = (weight.max(1)[0] - weight.min(1)[0]).max() / 255
+    assert (int8(input) - expected).abs().max() <= step + 1e-2
+    assert torch.allclose(int8(torch.LongTensor([3])), weight[3:4])
+
+
+def test_QuantizedEmbedding_small_rows():
+    # a freshly initialized table, whose scale is below the normal range of fp16
+    weight = torch.empty(100, 8).normal_(mean=0, std=0.0001)
+    int8 = QuantizedEmbedding.from_weight(weight, 'int8')
+    assert int8.scale.dtype == torch.float32
+    error = (int8(torch.arange(100)) - weight).abs().max(1)[0]
+    assert (error <= int8.scale / 2 * (1 + 1e-3)).all()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from deepctr_torch.layers import Hash, CategoryEncoder
+
+
+def test_Hash_matches_tensorflow():
+    # tf.strings.to_hash_bucket_fast(["Hello", "TensorFlow", "2.x"], 3) -> [0, 2, 2]
+    assert Hash(3)(np.array(["Hello", "TensorFlow", "2.x"])).tolist() == [0, 2, 2]
+
+
+def test_Hash_mask_zero():
+    x = np.array([[0, 5, 12345678901], [5, 0, 0]])
+    hash_x = Hash(10, mask_zero=True)(x)
+    assert hash_x.shape == x.shape
+    assert hash_x[0, 0] == 0 and hash_x[1, 1] == 0
+    assert hash_x[0, 1] == hash_x[1, 0]
+    assert ((hash_x[0, 1:] >= 1) & (hash_x[0, 1:] < 10)).all()
+
+
+def test_CategoryEncoder(tmpdir):
+    data = {'site': np.array(['b', 'a', 'b', 'c']), 'C1': np.array([2, 0, 1, 2]), 'C2': np.array([7, 1000, 7, 3]),
+            'C3': np.array([3, 1, 3, 1])}
+    encoder = CategoryEncoder(str(tmpdir), workers=2)
+    ids = encoder.fit_transform(data, ['site', 'C1', 'C2', 'C3'])
+    assert ids['site'].tolist() == [0, 1, 0, 2] and encoder.vocabulary_size('site') == 4
+    # already ids, kept as they are
+    assert ids['C1'].tolist() == [2, 0, 1, 2] and encoder.vocabulary_size('C1') == 4
+    assert ids['C2'].tolist() == [0, 1, 0, 2]
+    # in range but with gaps, encoded
+    assert ids['C3'].tolist() == [0, 1, 0, 1] and encoder.vocabulary_size('C3') == 3
+
+    # a later run loads the saved vocabularies, unseen values get the last id
+    encoder = CategoryEncoder(str(tmpdir))
+    ids = encoder.fit_transform({'site': np.array(['c', 'd']), 'C1': np.array([1, 5]), 'C2': np.array([3, 4])},
+                                ['site', 'C1', 'C2'])
+    assert ids['site'].tolist() == [2, 3] and ids['C1'].tolist() == [1, 3] and ids['C2'].tolist() == [2, 3]
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 import numpy as np
+import torch
 
-from deepctr_torch.inputs import SparseFeat, VarLenSparseFeat, DenseFeat, get_feature_names
+from deepctr_torch.inputs import SparseFeat, VarLenSparseFeat, DenseFeat, get_feature_names, JaggedArray
 from deepctr_torch.models.din import DIN
 from ..utils import check_model, get_device
 
@@ -50,5 +51,30 @@ def test_DIN():
     check_model(model, model_name, x, y)  # only have 3 train data so we set validation ratio at 0
 
 
+def test_DIN_sparse_in_backward():
+    # the query and the history features share their tables
+    x, y, feature_columns, behavior_feature_list = get_xy_fd()
+    model = DIN(feature_columns, behavior_feature_list, dnn_dropout=0.5, device=get_device())
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'], optimizer_sparse='adagrad',
+                  optimizer_sparse_in_backward=True)
+    weight = model.embedding_dict['item_id'].weight.detach().clone()
+    model.fit(x, y, batch_size=100, epochs=1)
+    assert not torch.equal(weight, model.embedding_dict['item_id'].weight.detach())
+
+
+def test_DIN_jagged_history():
+    model_name = "DIN"
+
+    x, y, feature_columns, behavior_feature_list = get_xy_fd()
+    feature_columns = [fc._replace(length_name=None, jagged=True) if isinstance(fc, VarLenSparseFeat) else fc
+                       for fc in feature_columns]
+    lengths = x.pop('seq_length')
+    for name in ['hist_item_id', 'hist_cate_id']:
+        x[name] = JaggedArray.from_lists([row[:length] for row, length in zip(x[name], lengths)])
+    model = DIN(feature_columns, behavior_feature_list, dnn_dropout=0.5, device=get_device())
+
+    check_model(model, model_name, x, y)
+
+
 if __name__ == "__main__":
     pass
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import numpy as np
 import pytest
+import torch
 
+from deepctr_torch.inputs import SparseFeat, VarLenSparseFeat, FeatureBatch, JaggedArray
 from deepctr_torch.models import DeepFM
 from ..utils import get_test_data, SAMPLE_SIZE, check_model, get_device
 
@@ -23,5 +26,241 @@ def test_DeepFM(use_fm, hidden_size, sparse_feature_num):
     check_model(model, model_name, x, y)
 
 
+def test_DeepFM_embedding_arena():
+    model_name = "DeepFM"
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=3, dense_feature_num=3)
+
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device=get_device(),
+                   embedding_arena=True)
+    check_model(model, model_name, x, y)
+
+
+def test_DeepFM_batch_regularization():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=3, dense_feature_num=3)
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), l2_reg_embedding=0.1, device='cpu')
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'], regularization='batch')
+
+    model._record_lookups()
+    model(FeatureBatch.from_arrays([x[name][:1].reshape(1, -1) for name in model.feature_index],
+                                   model.num_id_columns))
+    model.get_regularization_loss().backward()
+
+    feature = feature_columns[0]
+    grad = model.embedding_dict[feature.embedding_name].weight.grad
+    touched = grad.abs().sum(1).nonzero().view(-1).tolist()
+    assert touched == [int(x[feature.name][0])]
+
+    model.fit(x, y, batch_size=16, epochs=1)
+
+
+def test_DeepFM_full_regularization():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=3, dense_feature_num=3)
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), l2_reg_embedding=0.1, device='cpu')
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'])
+    # the default penalty is the one computed when the model was built
+    assert model.regularization_mode == 'full'
+    assert model.get_regularization_loss() is model.reg_loss
+    model.fit(x, y, batch_size=16, epochs=1)
+
+
+def test_DeepFM_sparse_embedding(tmpdir):
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=3, dense_feature_num=3)
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu', sparse_embedding=True)
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'], optimizer_sparse='adagrad')
+    assert model.regularization_mode == 'batch'
+    model.fit(x, y, batch_size=16, epochs=1)
+
+    for name, p in model.named_parameters():
+        if 'embedding_dict' in name:
+            assert p.grad is None or p.grad.is_sparse
+        else:
+            assert p.grad is None or not p.grad.is_sparse
+
+    checkpoint = str(tmpdir.join('DeepFM_checkpoint.h5'))
+    model.save_checkpoint(checkpoint)
+    model.load_checkpoint(checkpoint)
+
+
+def test_DeepFM_mmap_embedding(tmpdir):
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=2, dense_feature_num=2)
+    feature_columns = [fc._replace(mmap=str(tmpdir.join('tables'))) if isinstance(fc, SparseFeat) else fc
+                       for fc in feature_columns]
+    checkpoint = str(tmpdir.join('DeepFM_checkpoint.h5'))
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu', sparse_embedding=True)
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'], optimizer_sparse='adagrad')
+    model.fit(x, y, batch_size=16, epochs=1)
+    model.save_checkpoint(checkpoint)
+    expected = model.predict(x, batch_size=16)
+
+    # a new model opens the same files
+    restored = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu', sparse_embedding=True)
+    restored.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'], optimizer_sparse='adagrad')
+    restored.load_checkpoint(checkpoint)
+    assert np.allclose(restored.predict(x, batch_size=16), expected)
+    restored.fit(x, y, batch_size=16, epochs=1)
+
+
+def test_DeepFM_fuse_linear_embedding():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=3, dense_feature_num=2)
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu', sparse_embedding=True,
+                   fuse_linear_embedding=True)
+    # only the dense weights are left to the linear part
+    assert len(model.linear_model.embedding_dict) == 0
+    for feat in feature_columns:
+        if isinstance(feat, (SparseFeat, VarLenSparseFeat)):
+            assert model.embedding_dict[feat.embedding_name].weight.size(1) == feat.embedding_dim + 1
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'], optimizer_sparse='adagrad',
+                  optimizer_sparse_in_backward=True)
+    model.fit(x, y, batch_size=16, epochs=1)
+    model.predict(x, batch_size=16)
+    # no gather is kept from one forward to the next
+    assert all(table.pending is None for table in model.embedding_dict.values())
+
+
+def test_DeepFM_sparse_in_backward_batch_regularization():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=3, dense_feature_num=2)
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu', sparse_embedding=True,
+                   l2_reg_embedding=1e-3)
+    with pytest.raises(ValueError):
+        model.compile('adam', 'binary_crossentropy', optimizer_sparse_in_backward=True)
+    model.compile('adam', 'binary_crossentropy', optimizer_sparse='adagrad', optimizer_sparse_in_backward=True)
+    assert model.regularization_mode == 'batch'
+    model.fit(x, y, batch_size=SAMPLE_SIZE, epochs=1)
+    # the penalty and the data gradient of the batch make one sparse step per table
+    for weight in model.embedding_dict.parameters():
+        assert weight.grad is None
+        assert model.optim_s.state[weight]['step'] == 1
+
+
+def test_DeepFM_weighted_sequence():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=2, dense_feature_num=2,
+                                          sequence_feature=['weight', 'sum', 'mean', 'max'])
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu')
+    check_model(model, 'DeepFM', x, y)
+
+
+def test_JaggedArray():
+    rows = JaggedArray.from_lists([[1, 2, 3], [], [4], [5, 6]])
+    assert rows.offsets.tolist() == [0, 3, 3, 4, 6]
+    assert rows.lengths().tolist() == [3, 0, 1, 2]
+    assert rows[1:3].values.tolist() == [4] and rows[1:3].offsets.tolist() == [0, 0, 1]
+    taken = rows[np.array([3, 0, 3])]
+    assert taken.values.tolist() == [5, 6, 1, 2, 3, 5, 6] and taken.offsets.tolist() == [0, 2, 5, 7]
+    assert rows.pad(2).tolist() == [[1, 2], [0, 0], [4, 0], [5, 6]]
+
+
+@pytest.mark.parametrize(
+    'combiner',
+    ['sum', 'mean', 'max', 'weight']
+)
+def test_DeepFM_jagged_sequence(combiner):
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=2, dense_feature_num=2,
+                                          sequence_feature=[])
+    lengths = np.random.randint(0, 6, SAMPLE_SIZE)
+    x['jagged_seq'] = JaggedArray.from_lists([np.random.randint(1, 8, length) for length in lengths])
+    weight_name = None
+    if combiner == 'weight':
+        weight_name, combiner = 'jagged_weight', 'sum'
+        x[weight_name] = JaggedArray(np.random.random(len(x['jagged_seq'].values)), x['jagged_seq'].offsets)
+    feature_columns.append(VarLenSparseFeat(SparseFeat('jagged_seq', vocabulary_size=8, embedding_dim=4),
+                                            maxlen=5, combiner=combiner, weight_name=weight_name, jagged=True))
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu')
+    # no column of the input matrices is given to the jagged feature
+    assert model.feature_index['jagged_seq'][0] == model.feature_index['jagged_seq'][1]
+    check_model(model, 'DeepFM', x, y)
+    assert model.predict(x, batch_size=16).shape == (SAMPLE_SIZE, 1)
+
+    with pytest.raises(ValueError):
+        VarLenSparseFeat(SparseFeat('jagged_seq', vocabulary_size=8), maxlen=5, length_name='jagged_seq_length',
+                         jagged=True)
+
+
+def test_DeepFM_input_plan():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=3, dense_feature_num=2)
+    # two features looked up in one table, with a column of another table between them
+    feature_columns[2] = feature_columns[2]._replace(vocabulary_size=feature_columns[0].vocabulary_size,
+                                                     embedding_name=feature_columns[0].embedding_name)
+    x[feature_columns[2].name] = x[feature_columns[2].name] % feature_columns[0].vocabulary_size
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu')
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'])
+    model.fit(x, y, batch_size=16, epochs=1)
+
+    X = FeatureBatch.from_arrays([x[name].reshape(len(y), -1) for name in model.feature_index], model.num_id_columns)
+    sparse_embedding_list, dense_value_list = model.input_from_feature_columns(X, model.dnn_feature_columns,
+                                                                               model.embedding_dict)
+    expected = [model.embedding_dict[feat.embedding_name](X[:, model.feature_index[feat.name][0]:
+                                                             model.feature_index[feat.name][1]])
+                for feat in model.input_plan.sparse_feature_columns]
+    assert len(sparse_embedding_list) == len(feature_columns) - 2
+    for embedding, expected_embedding in zip(sparse_embedding_list, expected):
+        assert torch.equal(embedding, expected_embedding)
+    assert torch.equal(torch.cat(dense_value_list, dim=-1), X.dense)
+
+
+def test_DeepFM_use_hash():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=2, dense_feature_num=2)
+    feature_columns = [fc._replace(vocabulary_size=8, use_hash=True) if isinstance(fc, SparseFeat) else fc
+                       for fc in feature_columns]
+    for fc in feature_columns:
+        if isinstance(fc, SparseFeat):
+            x[fc.name] = np.array(['id_%d' % i for i in x[fc.name]])
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu')
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'])
+    model.fit(x, y, batch_size=16, epochs=1, validation_split=0.5)
+    assert model.predict(x, batch_size=16).shape == (SAMPLE_SIZE, 1)
+
+
+def test_DeepFM_dynamic_embedding():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=2, dense_feature_num=2)
+    feature_columns = [fc._replace(vocabulary_size=4, dynamic={'expire_steps': 2}) if isinstance(fc, SparseFeat)
+                       else fc for fc in feature_columns]
+    for fc in feature_columns:
+        if isinstance(fc, SparseFeat):
+            x[fc.name] = x[fc.name] * 100003 + 1000000
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu')
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'], optimizer_sparse='adagrad')
+    model.fit(x, y, batch_size=4, epochs=1)
+    model.predict(x, batch_size=16)
+
+
+def test_DeepFM_large_ids():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=1, dense_feature_num=2)
+    feature_columns = [fc._replace(vocabulary_size=SAMPLE_SIZE, dynamic=True) if isinstance(fc, SparseFeat)
+                       else fc for fc in feature_columns]
+    name = feature_columns[0].name
+    # neighbouring ids above 2 ** 24 are equal as float32, they must stay apart as int64
+    x[name] = np.arange(SAMPLE_SIZE, dtype=np.int64) + 2 ** 40 + 1
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu')
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'], optimizer_sparse='adagrad')
+    model.fit(x, y, batch_size=4, epochs=1)
+    assert sorted(model.embedding_dict[name].index) == x[name].tolist()
+
+
+def test_DeepFM_cached_embedding():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=2, dense_feature_num=2)
+    feature_columns = [fc._replace(cache=4) if isinstance(fc, SparseFeat) else fc for fc in feature_columns]
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu')
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'], optimizer_sparse='adagrad')
+    model.fit(x, y, batch_size=4, epochs=1)
+    model.predict(x, batch_size=4)
+
+
+@pytest.mark.parametrize(
+    'embedding_arena',
+    [False, True]
+)
+def test_DeepFM_quantize_embeddings(embedding_arena):
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=3, dense_feature_num=3)
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(32,), device='cpu',
+                   embedding_arena=embedding_arena)
+    model.compile('adam', 'binary_crossentropy', metrics=['binary_crossentropy'])
+    model.fit(x, y, batch_size=16, epochs=1)
+    expected = model.predict(x, batch_size=16)
+
+    model.quantize_embeddings('int8')
+    assert not any('embedding_dict' in name for name, _ in model.named_parameters())
+    assert np.allclose(model.predict(x, batch_size=16), expected, atol=1e-3)
+
+
 if __name__ == "__main__":
     pass
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import pytest
+import torch
 
 from deepctr_torch.models import WDL
 from ..utils import get_test_data, SAMPLE_SIZE, check_model, get_device
@@ -21,5 +22,45 @@ def test_WDL(sparse_feature_num, dense_feature_num):
     check_model(model, model_name, x, y)
 
 
+@pytest.mark.parametrize(
+    'dense_sync',
+    ['hogwild', 'periodic']
+)
+def test_WDL_hogwild(dense_sync):
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=2, dense_feature_num=2)
+
+    model = WDL(feature_columns, feature_columns, dnn_hidden_units=[32, 32], device='cpu', sparse_embedding=True)
+    model.compile('adagrad', 'binary_crossentropy', metrics=['binary_crossentropy'],
+                  optimizer_sparse='adagrad')
+    model.fit(x, y, batch_size=16, epochs=1, validation_split=0.5, workers=2, dense_sync=dense_sync,
+              dense_sync_steps=1)
+
+
+def test_WDL_hogwild_periodic_state():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=2, dense_feature_num=2)
+
+    model = WDL(feature_columns, feature_columns, dnn_hidden_units=[32, 32], device='cpu', sparse_embedding=True)
+    model.compile('adagrad', 'binary_crossentropy', optimizer_sparse='adagrad')
+    model.optim.share_memory()
+    dense_params = [p for group in model.optim.param_groups for p in group['params']]
+    shared = [model.optim.state[p]['sum'] for p in dense_params]
+    # what a worker of dense_sync='periodic' does with the state of its copy of the dense parameters
+    model._clone_state([model.optim], dense_params)
+    for p, shared_sum in zip(dense_params, shared):
+        state_sum = model.optim.state[p]['sum']
+        assert state_sum is not shared_sum and not state_sum.is_shared()
+        assert torch.equal(state_sum, shared_sum)
+
+
+def test_WDL_hogwild_dense_tables():
+    x, y, feature_columns = get_test_data(SAMPLE_SIZE, sparse_feature_num=2, dense_feature_num=2)
+
+    model = WDL(feature_columns, feature_columns, dnn_hidden_units=[32, 32], device='cpu')
+    model.compile('adagrad', 'binary_crossentropy', metrics=['binary_crossentropy'],
+                  optimizer_sparse='adagrad')
+    with pytest.raises(ValueError):
+        model.fit(x, y, batch_size=16, epochs=1, workers=2)
+
+
 if __name__ == "__main__":
     pass
@@ -16,6 +16,7 @@ from .sgd import SGD
 from .rprop import Rprop
 from .rmsprop import RMSprop
 from .radagrad import RAdagrad
+from .ftrl import Ftrl
 from .optimizer import Optimizer
 from .lbfgs import LBFGS
 from . import lr_scheduler
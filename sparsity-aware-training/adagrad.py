@@ -1,3 +1,8 @@
+import os
+import tempfile
+from collections import defaultdict
+
+import numpy as np
 import torch
 from .optimizer import Optimizer
 from ..tensor import Tensor
@@ -15,12 +20,41 @@ class Adagrad(Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         eps (float, optional): term added to the denominator to improve
             numerical stability (default: 1e-10)
+        fused_sparse (bool, optional): if ``True``, sparse gradients are applied
+            by gathering the touched rows once and updating the accumulator and
+            the weights in place with index ops, instead of building
+            intermediate sparse tensors over the whole table (default: False)
+        rowwise (bool, optional): if ``True``, parameters with more than one
+            dimension (embedding tables) keep a single accumulator value per
+            row, updated with the mean of the squared gradient of that row.
+            This cuts the optimizer state of an embedding table by a factor
+            of ``embedding_dim`` (default: False)
+        multi_tensor (bool, optional): if ``True``, parameters with dense
+            gradients and element-wise state are bucketed by dtype, device and
+            step, and each bucket is updated with a few ops over one flat
+            buffer instead of several small kernels per parameter. The state
+            of the parameters of a group is created as views of one buffer per
+            dtype and device, a bucket of other parameters is gathered and
+            written back (default: False)
+        state_placement (str, optional): where the accumulators are stored:
+            ``'device'`` (next to the parameter), ``'pinned'`` (page-locked
+            host memory) or ``'mmap'`` (a memory-mapped file per parameter
+            in ``state_dir``). The state is allocated there directly, and
+            mmap files are private to the optimizer and removed from
+            ``state_dir`` once mapped. Off-device state is updated row by
+            row: each step only the rows touched by the gradient are transferred to
+            the parameter's device and back, which lets the state of large
+            embedding tables exceed device memory (``'pinned'``) or RAM
+            (``'mmap'``) (default: 'device')
+        state_dir (str, optional): directory of the state files, required by
+            ``state_placement='mmap'`` (default: None)
 
     .. _Adaptive Subgradient Methods for Online Learning and Stochastic
         Optimization: http://jmlr.org/papers/v12/duchi11a.html
     """
 
-    def __init__(self, params, lr=1e-2, lr_decay=0, weight_decay=0, initial_accumulator_value=0, eps=1e-10):
+    def __init__(self, params, lr=1e-2, lr_decay=0, weight_decay=0, initial_accumulator_value=0, eps=1e-10,
+                 fused_sparse=False, rowwise=False, multi_tensor=False, state_placement='device', state_dir=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= lr_decay:
@@ -31,20 +65,108 @@ class Adagrad(Optimizer):
             raise ValueError("Invalid initial_accumulator_value value: {}".format(initial_accumulator_value))
         if not 0.0 <= eps:
             raise ValueError("Invalid epsilon value: {}".format(eps))
+        if state_placement not in ('device', 'pinned', 'mmap'):
+            raise ValueError("Invalid state_placement value: {}".format(state_placement))
+        if state_placement == 'mmap' and state_dir is None:
+            raise ValueError("state_placement='mmap' requires a state_dir")
 
         defaults = dict(lr=lr, lr_decay=lr_decay, eps=eps, weight_decay=weight_decay,
-                        initial_accumulator_value=initial_accumulator_value)
+                        initial_accumulator_value=initial_accumulator_value, fused_sparse=fused_sparse,
+                        rowwise=rowwise, multi_tensor=multi_tensor, state_placement=state_placement,
+                        state_dir=state_dir)
         super(Adagrad, self).__init__(params, defaults)
 
+        for index, (p, group) in enumerate(self._params_with_groups()):
+            state = self.state[p]
+            state['step'] = 0
+            value = group['initial_accumulator_value']
+            size = (p.size(0),) if group['rowwise'] and p.dim() > 1 else p.size()
+            if group['state_placement'] == 'device' and len(size) == p.dim():
+                default = lambda: torch.full_like(p.data, value, memory_format=torch.preserve_format)
+            else:
+                default = lambda: self._new_state(size, p, group, index, value)
+            state['sum'] = _allocate_state(self, p, 'sum', size, p.dtype, value, default)
+
+        # the accumulators of a multi_tensor bucket are views of one flat buffer from the start, so the
+        # buffer is updated in place and keeps the storage share_memory() gives them
+        flat_buffers = self.__dict__.setdefault('_flat_buffers', {})
         for group in self.param_groups:
+            if not group['multi_tensor'] or group['state_placement'] != 'device':
+                continue
+            buckets = defaultdict(list)
             for p in group['params']:
-                state = self.state[p]
-                state['step'] = 0
-                state['sum'] = torch.full_like(p.data, initial_accumulator_value, memory_format=torch.preserve_format)
-                state['sum'].to(p.device) 
+                if self.state[p]['sum'].dim() == p.dim() and getattr(p, 'state_allocator', None) is None:
+                    buckets[(p.dtype, p.device)].append(p)
+            for params in buckets.values():
+                if len(params) < 2:
+                    continue
+                views = _flatten_state(flat_buffers, ('sum',) + tuple(id(p) for p in params),
+                                       [self.state[p]['sum'] for p in params])
+                for p, view in zip(params, views):
+                    self.state[p]['sum'] = view
+
+    def __setstate__(self, state):
+        super(Adagrad, self).__setstate__(state)
+        for group in self.param_groups:
+            group.setdefault('fused_sparse', False)
+            group.setdefault('rowwise', False)
+            group.setdefault('multi_tensor', False)
+            group.setdefault('state_placement', 'device')
+            group.setdefault('state_dir', None)
+
+    def load_state_dict(self, state_dict):
+        # ``Optimizer.load_state_dict`` moves the state to the parameters' device, put it back in place
+        current = _state_tensors(self.state)
+        super(Adagrad, self).load_state_dict(state_dict)
+        _copy_into(current, self.state)
+        for index, (p, group) in enumerate(self._params_with_groups()):
+            if p in self.state and 'sum' in self.state[p] and self.state[p]['sum'] is not current.get((p, 'sum')):
+                self.state[p]['sum'] = self._place_state(self.state[p]['sum'], group, index)
+
+    def _params_with_groups(self):
+        for group in self.param_groups:
+            for p in group['params']:
+                yield p, group
+
+    @classmethod
+    def _place_state(cls, tensor, group, index):
+        # Returns a copy of ``tensor`` stored as requested by ``group['state_placement']``.
+        if group['state_placement'] == 'device':
+            return tensor
+        return cls._new_state(tensor.size(), tensor, group, index).copy_(tensor.detach())
+
+    @staticmethod
+    def _new_state(size, p, group, index, value=None):
+        # Returns a state tensor of ``size`` for ``p`` filled with ``value`` (uninitialized if None),
+        # allocated where ``group['state_placement']`` asks, so that no copy of it is ever held elsewhere.
+        if group['state_placement'] == 'device':
+            tensor = torch.empty(size, dtype=p.dtype, device=p.device)
+        elif group['state_placement'] == 'pinned':
+            tensor = torch.empty(size, dtype=p.dtype, pin_memory=torch.cuda.is_available())
+        else:
+            # a new file per tensor, so optimizers and runs sharing state_dir never overwrite each other's
+            # state; it is unlinked once mapped and lives as long as the mapping, which forked processes share
+            fd, filename = tempfile.mkstemp(suffix='.bin', prefix='adagrad_sum_{0}_'.format(index),
+                                            dir=group['state_dir'])
+            try:
+                dtype = torch.empty(0, dtype=p.dtype).numpy().dtype
+                # the file is extended with zeros without writing them
+                os.ftruncate(fd, int(np.prod(size)) * dtype.itemsize)
+                tensor = torch.from_numpy(np.memmap(filename, dtype=dtype, mode='r+', shape=tuple(size)))
+            finally:
+                os.close(fd)
+                os.unlink(filename)
+            if value == 0:
+                return tensor
+        return tensor if value is None else tensor.fill_(value)
 
     def share_memory(self):
         for group in self.param_groups:
+            if group['state_placement'] == 'pinned':
+                raise RuntimeError("state_placement='pinned' is not compatible with shared state, moving it to "
+                                   "shared memory would unpin it")
+            if group['state_placement'] == 'mmap':
+                continue  # the state files are mapped shared already
             for p in group['params']:
                 state = self.state[p]
                 state['sum'].share_memory_()
@@ -61,48 +183,226 @@ class Adagrad(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            updated = self._multi_tensor_update(group) if group['multi_tensor'] else set()
             for p in group['params']:
-                if p.grad is None:
+                if p.grad is None or id(p) in updated:
                     continue
+                self._update(p, p.grad.data, group)
 
-                grad = p.grad.data
-                state = self.state[p]
+        return loss
+
+    def sparse_step(self, p, indices, values):
+        """Applies a row-sparse gradient to a single parameter right away.
+
+        Used to update embedding tables from their backward pass, without a
+        gradient ever being stored in ``p.grad``.
+
+        Arguments:
+            p (Tensor): a parameter of this optimizer, e.g. an embedding table
+            indices (LongTensor): 1-D indices of the rows the gradient refers
+                to, may contain repeated rows
+            values (Tensor): gradient rows, ``values[i]`` belongs to
+                ``p[indices[i]]``
+        """
+        grad = torch.sparse_coo_tensor(indices.unsqueeze(0), values, p.size())
+        self._update(p, grad, self._param_group(p))
+
+    def reset_state(self, p, rows):
+        """Resets the state of some rows of a parameter to its initial value.
+
+        Used when embedding rows are given to new ids, see ``DynamicEmbedding``.
+
+        Arguments:
+            p (Tensor): a parameter of this optimizer, e.g. an embedding table
+            rows (LongTensor): 1-D indices of the rows to reset
+        """
+        state = self.state[p]
+        if 'sum' not in state:
+            return
+        group = self._param_group(p)
+        state['sum'].index_fill_(0, rows.to(state['sum'].device), group['initial_accumulator_value'])
+
+    def _param_group(self, p):
+        for group in self.param_groups:
+            for param in group['params']:
+                if param is p:
+                    return group
+        raise ValueError("parameter is not optimized by this optimizer")
 
+    def _multi_tensor_update(self, group):
+        # Updates the dense, element-wise parameters of ``group`` bucket by bucket and
+        # returns the ids of the parameters it has updated.
+        buckets = defaultdict(list)
+        for p in group['params']:
+            if p.grad is None or p.grad.is_sparse:
+                continue
+            state = self.state[p]
+            if state['sum'].dim() < p.dim() or state['sum'].device != p.device or group['state_placement'] != 'device':
+                continue
+            buckets[(p.dtype, p.device, state['step'])].append(p)
+
+        updated = set()
+        flat_buffers = self.__dict__.setdefault('_flat_buffers', {})
+        for (_, _, step), params in buckets.items():
+            if len(params) < 2:
+                continue
+            key = ('sum',) + tuple(id(p) for p in params)
+            sums = [self.state[p]['sum'] for p in params]
+            flat_sum, gathered = _flat_state(flat_buffers, key, sums)
+            flat_grad = torch.cat([p.grad.data.reshape(-1) for p in params])
+            if group['weight_decay'] != 0:
+                flat_grad.add_(group['weight_decay'], torch.cat([p.data.reshape(-1) for p in params]))
+
+            clr = group['lr'] / (1 + step * group['lr_decay'])
+            flat_sum.addcmul_(1, flat_grad, flat_grad)
+            std = flat_sum.sqrt().add_(group['eps'])
+            flat_update = flat_grad.div_(std).mul_(-clr)
+            if gathered:
+                _scatter_state(flat_sum, sums)
+
+            offset = 0
+            for p in params:
+                state = self.state[p]
                 state['step'] += 1
+                p.data.add_(flat_update[offset:offset + p.numel()].view_as(p))
+                offset += p.numel()
+                updated.add(id(p))
+        return updated
 
-                if group['weight_decay'] != 0:
-                    if p.grad.data.is_sparse:
-                        raise RuntimeError("weight_decay option is not compatible with sparse gradients")
-                    grad = grad.add(group['weight_decay'], p.data)
-
-                clr = group['lr'] / (1 + (state['step'] - 1) * group['lr_decay'])
-
-                if grad.is_sparse:
-                    grad = grad.coalesce()  # the update is non-linear so indices must be unique
-                    ori_grad = grad
-                    if(grad.device != state['sum'].device):
-                        grad = grad.clone().detach().to(state['sum'].device)
-                    grad_indices = grad._indices()
-                    grad_values = grad._values()
-                    size = grad.size()
-
-                    def make_sparse(values):
-                        constructor = grad.new
-                        if grad_indices.dim() == 0 or values.dim() == 0:
-                            return constructor().resize_as_(grad)
-                        return constructor(grad_indices, values, size)
-                    state['sum'].add_(make_sparse(grad_values.pow(2)))
-                    std = state['sum'].sparse_mask(grad)
-                    std_values = std._values().sqrt_().add_(group['eps'])
-                    if (p.data.device != grad_values.device):
-                        grad_values = ori_grad._values()
-                        std_values = std_values.to(p.data.device)
-                        grad_indices = ori_grad._indices()
-                        # clr = clr.clone().detach().to(p.data.device)                   
-                    p.data.add_(-clr, make_sparse(grad_values / std_values))
-                else:
-                    state['sum'].addcmul_(1, grad, grad)
-                    std = state['sum'].sqrt().add_(group['eps'])
-                    p.data.addcdiv_(-clr, grad, std)
+    def _update(self, p, grad, group):
+        state = self.state[p]
 
-        return loss
+        state['step'] += 1
+
+        if group['weight_decay'] != 0:
+            if grad.is_sparse:
+                raise RuntimeError("weight_decay option is not compatible with sparse gradients")
+            grad = grad.add(group['weight_decay'], p.data)
+
+        clr = group['lr'] / (1 + (state['step'] - 1) * group['lr_decay'])
+
+        rowwise = state['sum'].dim() < p.dim()
+        offloaded = group['state_placement'] != 'device' or state['sum'].device != p.device
+
+        if offloaded and not grad.is_sparse:
+            # only the rows with a non-zero gradient change, so only those are transferred
+            rows = grad.reshape(grad.size(0), -1).ne(0).any(1).nonzero().view(-1)
+            grad = torch.sparse_coo_tensor(rows.unsqueeze(0), grad.index_select(0, rows), grad.size())
+
+        if grad.is_sparse and (group['fused_sparse'] or rowwise or offloaded):
+            if grad.sparse_dim() != 1:
+                raise RuntimeError("fused_sparse, rowwise and state_placement options require row-sparse gradients")
+            self._fused_sparse_update(p, grad, state, clr, group['eps'])
+        elif grad.is_sparse:
+            grad = grad.coalesce()  # the update is non-linear so indices must be unique
+            grad_indices = grad._indices()
+            grad_values = grad._values()
+            size = grad.size()
+
+            def make_sparse(values):
+                constructor = grad.new
+                if grad_indices.dim() == 0 or values.dim() == 0:
+                    return constructor().resize_as_(grad)
+                return constructor(grad_indices, values, size)
+            state['sum'].add_(make_sparse(grad_values.pow(2)))
+            std = state['sum'].sparse_mask(grad)
+            std_values = std._values().sqrt_().add_(group['eps'])
+            p.data.add_(-clr, make_sparse(grad_values / std_values))
+        elif rowwise:
+            state['sum'].add_(grad.pow(2).view(grad.size(0), -1).mean(1))
+            std = state['sum'].sqrt().add_(group['eps'])
+            p.data.addcdiv_(-clr, grad, std.view((-1,) + (1,) * (p.dim() - 1)))
+        else:
+            state['sum'].addcmul_(1, grad, grad)
+            std = state['sum'].sqrt().add_(group['eps'])
+            p.data.addcdiv_(-clr, grad, std)
+
+    @staticmethod
+    def _fused_sparse_update(p, grad, state, clr, eps):
+        # Row-sparse update: only the rows present in ``grad`` are gathered from and
+        # scattered back to the accumulator, nothing proportional to the table is allocated.
+        # The accumulator may live on another device (see ``state_placement``), then only the
+        # touched rows are transferred and the update is computed on the parameter's device.
+        rows = grad._indices()[0]
+        values = grad._values()
+        if not grad.is_coalesced():
+            # the update is non-linear so gradients of repeated rows must be summed first
+            rows, inverse = torch.unique(rows, return_inverse=True)
+            values = values.new_zeros((rows.size(0),) + values.size()[1:]).index_add_(0, inverse, values)
+        if rows.numel() == 0:
+            return
+
+        state_sum = state['sum']
+        state_rows = rows.to(state_sum.device)
+        sum_values = state_sum.index_select(0, state_rows).to(p.device, non_blocking=True)
+        if state_sum.dim() < values.dim():
+            sum_values.add_(values.pow(2).view(rows.size(0), -1).mean(1))
+        else:
+            sum_values.addcmul_(1, values, values)
+        state_sum.index_copy_(0, state_rows, sum_values.to(state_sum.device))
+        std_values = sum_values.sqrt_().add_(eps)
+        if std_values.dim() < values.dim():
+            std_values = std_values.view((-1,) + (1,) * (values.dim() - 1))
+        p.data.index_add_(0, rows, values.div(std_values).mul_(-clr))
+
+
+def _flatten_state(flat_buffers, key, tensors):
+    # Returns views of a new flat buffer holding the values of ``tensors``, for the state to be
+    # replaced by; the buffer is cached under ``key``. Only called when the state is created, so
+    # the cache holds one buffer per bucket of parameters.
+    flat = torch.cat([tensor.reshape(-1) for tensor in tensors])
+    views = []
+    offset = 0
+    for tensor in tensors:
+        views.append(flat[offset:offset + tensor.numel()].view_as(tensor))
+        offset += tensor.numel()
+    flat_buffers[key] = (flat, views)
+    return views
+
+
+def _flat_state(flat_buffers, key, tensors):
+    # Returns a flat buffer holding the values of ``tensors`` and whether it is a copy. If the
+    # tensors are the views of the buffer cached under ``key`` it is that buffer. Otherwise (a
+    # bucket of other parameters, or state created apart) their values are gathered into a new
+    # buffer, to be written back to them with _scatter_state: the state keeps its own storage,
+    # e.g. the shared memory of Hogwild training.
+    cached = flat_buffers.get(key)
+    if cached is not None and len(cached[1]) == len(tensors) and \
+            all(view is tensor for view, tensor in zip(cached[1], tensors)):
+        return cached[0], False
+    return torch.cat([tensor.reshape(-1) for tensor in tensors]), True
+
+
+def _allocate_state(optimizer, p, key, size, dtype, value, default):
+    # Returns the state ``key`` of ``p``, a tensor of ``size`` and ``dtype`` filled with ``value``. A
+    # parameter can allocate its own state with a ``state_allocator(optimizer, key, size, dtype, value)``
+    # attribute, e.g. ``MmapEmbedding`` maps it from a file; ``default()`` allocates it when the parameter
+    # has none or its allocator returns None.
+    allocator = getattr(p, 'state_allocator', None)
+    tensor = allocator(optimizer, key, size, dtype, value) if allocator is not None else None
+    return default() if tensor is None else tensor
+
+
+def _scatter_state(flat, tensors):
+    # copies the values of a flat buffer from _flat_state back into ``tensors``
+    offset = 0
+    for tensor in tensors:
+        tensor.copy_(flat[offset:offset + tensor.numel()].view_as(tensor))
+        offset += tensor.numel()
+
+
+def _state_tensors(state):
+    # {(parameter, key): tensor} of the state, see _copy_into
+    return {(p, key): value for p, values in state.items() for key, value in values.items() if torch.is_tensor(value)}
+
+
+def _copy_into(tensors, state):
+    # Copies the tensors of ``state`` (e.g. loaded by ``Optimizer.load_state_dict``) into the
+    # ``tensors`` of _state_tensors of the same shape, and puts those back in the state, so that
+    # it keeps its storage: flat buffers, shared or pinned memory, mapped files.
+    for p, values in state.items():
+        for key, value in values.items():
+            tensor = tensors.get((p, key))
+            if tensor is not None and torch.is_tensor(value) and tensor.size() == value.size():
+                tensor.copy_(value)
+                values[key] = tensor
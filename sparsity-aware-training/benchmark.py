@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Microbenchmark for the optimizers installed to `torch.optim`. Optimizer steps are timed in isolation:
+# sparse steps on synthetic embedding tables, dense steps on the dense parameters of Criteo-shaped models.
+# `--mode suite` sweeps table sizes for every optimizer `BaseModel._get_optim` can build and writes the
+# results to a JSON file, to compare optimizer changes across commits. `--mode quantized` times predict with
+# fp32, fp16 and int8 embedding tables.
+
+import sys
+
+sys.path.append("DeepCTR-Torch")
+
+import argparse
+import copy
+import json
+import multiprocessing
+import resource
+import subprocess
+import time
+from queue import Empty
+
+import numpy as np
+import torch
+
+from deepctr_torch.inputs import SparseFeat, DenseFeat, FeatureBatch
+from deepctr_torch.models import DeepFM, DCN, NFM
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--mode", choices=('sparse', 'dense', 'suite', 'model', 'quantized'), default='sparse')
+parser.add_argument("--vocab", type=int, default=1000000)
+parser.add_argument("--dim", type=int, default=4)
+parser.add_argument("--batch-size", type=int, default=256)
+parser.add_argument("--fields", type=int, default=22)
+parser.add_argument("--steps", type=int, default=200)
+parser.add_argument("--warmup", type=int, default=10)
+parser.add_argument("--device", default='cpu')
+parser.add_argument("--seed", type=int, default=1024)
+parser.add_argument("--vocabs", default="1e4,1e6,1e8", help="suite: comma separated vocabulary sizes")
+parser.add_argument("--dims", default="4,16,64", help="suite: comma separated embedding dims")
+parser.add_argument("--zipf", type=float, default=1.2, help="suite: exponent of the Zipfian id distribution")
+parser.add_argument("--max-bytes", type=float, default=8e9,
+                    help="suite: skip cases whose table, gradient and state would exceed this many bytes")
+parser.add_argument("--output", default="benchmark.json", help="suite: file the results are written to")
+
+
+def sparse_batches(vocab, dim, batch_size, fields, steps, seed):
+    # Lookups and output gradients of one embedding table, fixed up front so every optimizer sees the same gradients.
+    generator = torch.Generator().manual_seed(seed)
+    return [(torch.randint(0, vocab, (batch_size, fields), generator=generator),
+             torch.randn(batch_size, fields, dim, generator=generator)) for _ in range(steps)]
+
+
+def run_sparse(optim_cls, optim_kwargs, weight, batches, warmup, device):
+    embedding = torch.nn.Embedding.from_pretrained(weight.clone(), freeze=False, sparse=True).to(device)
+    optim = optim_cls(embedding.parameters(), **optim_kwargs)
+    elapsed = 0
+    for i, (ids, grad_out) in enumerate(batches):
+        optim.zero_grad()
+        embedding(ids.to(device)).backward(grad_out.to(device))
+        if device != 'cpu':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        optim.step()
+        if device != 'cpu':
+            torch.cuda.synchronize()
+        if i >= warmup:
+            elapsed += time.time() - start_time
+    if hasattr(optim, 'flush'):
+        optim.flush()
+    return embedding.weight.data, (len(batches) - warmup) / elapsed
+
+
+# (optimizer, default arguments, arguments of the variant compared against the default path)
+SPARSE_CASES = [
+    ('adagrad', torch.optim.Adagrad, dict(lr=0.01), dict(fused_sparse=True)),
+    ('adagrad', torch.optim.Adagrad, dict(lr=0.01), dict(state_placement='pinned')),
+    ('radagrad', torch.optim.RAdagrad, dict(lr=0.01, momentum=0.9), dict(lazy_decay=True)),
+]
+
+
+def bench_sparse(args):
+    torch.manual_seed(args.seed)
+    weight = torch.randn(args.vocab, args.dim) * 0.0001
+    batches = sparse_batches(args.vocab, args.dim, args.batch_size, args.fields, args.steps + args.warmup, args.seed)
+
+    for name, optim_cls, optim_kwargs, variant_kwargs in SPARSE_CASES:
+        base_weight, base_speed = run_sparse(optim_cls, optim_kwargs, weight, batches, args.warmup, args.device)
+        variant_weight, variant_speed = run_sparse(optim_cls, dict(optim_kwargs, **variant_kwargs), weight, batches,
+                                                   args.warmup, args.device)
+
+        print("===== {0} sparse step, vocab {1}, dim {2}, {3} rows per step =====".format(
+            name, args.vocab, args.dim, args.batch_size * args.fields))
+        print("default: {0:.1f} steps/sec".format(base_speed))
+        print("{0}: {1:.1f} steps/sec ({2:.2f}x)".format(variant_kwargs, variant_speed, variant_speed / base_speed))
+        print("max abs diff of weights: {0:.3e}".format((base_weight - variant_weight).abs().max().item()))
+
+
+DENSE_CASES = [
+    ('adagrad', torch.optim.Adagrad, dict(lr=0.01), dict(multi_tensor=True)),
+    ('radagrad', torch.optim.RAdagrad, dict(lr=0.01, momentum=0.9), dict(multi_tensor=True)),
+]
+
+
+def criteo_like_model(model_cls, args):
+    feature_columns = [SparseFeat('C' + str(i), 1000, embedding_dim=args.dim) for i in range(1, 27)] + \
+                      [DenseFeat('I' + str(i), 1) for i in range(1, 14)]
+    x = {fc.name: np.random.randint(0, 1000, args.batch_size) if isinstance(fc, SparseFeat) else
+         np.random.random(args.batch_size) for fc in feature_columns}
+    model = model_cls(feature_columns, feature_columns, device=args.device)
+    return model, x
+
+
+def run_dense(optim_cls, optim_kwargs, model, steps, warmup, device):
+    # same split as BaseModel._get_optim, copied so every optimizer starts from the same weights and gradients
+    params = []
+    for name, p in model.named_parameters():
+        if 'embed' not in name and p.grad is not None:
+            param = p.detach().clone().requires_grad_()
+            param.grad = p.grad.clone()
+            params.append(param)
+    optim = optim_cls(params, **optim_kwargs)
+    for i in range(steps + warmup):
+        if i == warmup:
+            if device != 'cpu':
+                torch.cuda.synchronize()
+            start_time = time.time()
+        optim.step()
+    if device != 'cpu':
+        torch.cuda.synchronize()
+    return params, (time.time() - start_time) * 1000 / steps
+
+
+def bench_dense(args):
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    for model_cls in (DeepFM, DCN, NFM):
+        model, x = criteo_like_model(model_cls, args)
+        x = FeatureBatch.from_arrays([x[name].reshape(-1, 1) for name in model.feature_index],
+                                     model.num_id_columns).to(args.device)
+        # gradients are computed once and reused, only the optimizer step is timed
+        model(x).sum().backward()
+        num_params = len([name for name, _ in model.named_parameters() if 'embed' not in name])
+        for name, optim_cls, optim_kwargs, variant_kwargs in DENSE_CASES:
+            base_params, base_ms = run_dense(optim_cls, optim_kwargs, model, args.steps, args.warmup, args.device)
+            variant_params, variant_ms = run_dense(optim_cls, dict(optim_kwargs, **variant_kwargs), model, args.steps,
+                                                   args.warmup, args.device)
+
+            print("===== {0} dense step, {1}, {2} dense parameters =====".format(
+                name, model_cls.__name__, num_params))
+            print("default: {0:.3f} ms/step".format(base_ms))
+            print("{0}: {1:.3f} ms/step ({2:.2f}x)".format(variant_kwargs, variant_ms, base_ms / variant_ms))
+            print("max abs diff of weights: {0:.3e}".format(
+                max((p - q).abs().max().item() for p, q in zip(base_params, variant_params))))
+
+
+# Every optimizer BaseModel._get_optim can build, with its default arguments there, plus the options of
+# Adagrad/RAdagrad that change the sparse step.
+SUITE_CASES = [
+    ('sgd', torch.optim.SGD, dict(lr=0.01)),
+    ('adam', torch.optim.Adam, dict(lr=0.001)),
+    ('rmsprop', torch.optim.RMSprop, dict(lr=0.001)),
+    ('adagrad', torch.optim.Adagrad, dict(lr=0.01)),
+    ('adagrad', torch.optim.Adagrad, dict(lr=0.01, fused_sparse=True)),
+    ('adagrad', torch.optim.Adagrad, dict(lr=0.01, rowwise=True)),
+    ('radagrad', torch.optim.RAdagrad, dict(lr=0.001, alpha=0.9999)),
+    ('radagrad', torch.optim.RAdagrad, dict(lr=0.001, alpha=0.9999, momentum=0.9, lazy_decay=True)),
+    ('radagrad', torch.optim.RAdagrad, dict(lr=0.001, alpha=0.9999, rowwise=True)),
+    ('ftrl', torch.optim.Ftrl, dict(lr=0.01, l1=1.0)),
+]
+
+
+def zipf_batches(vocab, dim, batch_size, fields, steps, exponent, seed):
+    # Ids follow a Zipfian distribution, the most frequent ids being the smallest ones.
+    rng = np.random.RandomState(seed)
+    generator = torch.Generator().manual_seed(seed)
+    return [(torch.from_numpy((rng.zipf(exponent, (batch_size, fields)) - 1) % vocab),
+             torch.randn(batch_size, fields, dim, generator=generator)) for _ in range(steps)]
+
+
+def current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def reset_peak_rss():
+    # Resets the peak resident set size of this process (VmHWM) to its current one. A forked process
+    # starts with the peak of its parent, which ru_maxrss would report for any case that stays below it.
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def peak_rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("no VmHWM in /proc/self/status")
+
+
+def row_bytes(tensors, num_rows):
+    # bytes of one row over the tensors indexed by row, e.g. the weight and element- or row-wise state
+    return sum(t[0].numel() * t.element_size() for t in tensors if t.dim() > 0 and t.size(0) == num_rows)
+
+
+def run_suite_case(name, optim_cls, optim_kwargs, path, vocab, dim, args, queue):
+    # Runs in its own process so that the peak memory is the one of this case only.
+    record = dict(optimizer=name, options=optim_kwargs, path=path, vocab=vocab, dim=dim,
+                  rows_per_step=args.batch_size * args.fields, zipf=args.zipf)
+    try:
+        torch.manual_seed(args.seed)
+        if args.device != 'cpu':
+            torch.cuda.reset_max_memory_allocated(args.device)
+        if args.device == 'cpu':
+            reset_peak_rss()
+            start_rss = current_rss()
+        batches = zipf_batches(vocab, dim, args.batch_size, args.fields, args.steps + args.warmup, args.zipf,
+                               args.seed)
+        embedding = torch.nn.Embedding(vocab, dim, sparse=path == 'sparse').to(args.device)
+        torch.nn.init.normal_(embedding.weight, mean=0, std=0.0001)
+        optim = optim_cls(embedding.parameters(), **optim_kwargs)
+
+        elapsed = 0
+        touched_rows = 0
+        for i, (ids, grad_out) in enumerate(batches):
+            optim.zero_grad()
+            embedding(ids.to(args.device)).backward(grad_out.to(args.device))
+            if args.device != 'cpu':
+                torch.cuda.synchronize()
+            start_time = time.time()
+            optim.step()
+            if args.device != 'cpu':
+                torch.cuda.synchronize()
+            if i >= args.warmup:
+                elapsed += time.time() - start_time
+                touched_rows += ids.unique().numel() if path == 'sparse' else vocab
+        if hasattr(optim, 'flush'):
+            optim.flush()
+
+        state = [t for t in optim.state[embedding.weight].values() if torch.is_tensor(t)]
+        if args.device != 'cpu':
+            peak_memory = torch.cuda.max_memory_allocated(args.device)
+        else:
+            peak_memory = peak_rss() - start_rss
+        record.update(
+            status='ok',
+            steps_per_sec=args.steps / elapsed,
+            peak_memory_bytes=peak_memory,
+            state_bytes=sum(t.numel() * t.element_size() for t in state),
+            # lower bound of the memory traffic of a step: the gradient is read once, every touched row
+            # of the weight and of the row-indexed state is read and written once
+            bytes_moved_per_step=touched_rows / args.steps * (
+                dim * embedding.weight.element_size() + 2 * row_bytes([embedding.weight.data] + state, vocab)))
+    except Exception as e:
+        # e.g. Adam and RMSprop do not support sparse gradients
+        record.update(status='error', error=str(e).split('\n')[0])
+    queue.put(record)
+
+
+def wait_suite_case(process, queue, record):
+    # Returns the record the case puts in ``queue``, or ``record`` with status 'crashed' if its process
+    # dies without one, e.g. killed for running out of memory.
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if process.is_alive():
+                continue
+        # the record may have been put just before the process exited
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            process.join()
+            record.update(status='crashed', error="process exited with code {0}".format(process.exitcode))
+            return record
+
+
+def bench_suite(args):
+    vocabs = [int(float(v)) for v in args.vocabs.split(',')]
+    dims = [int(d) for d in args.dims.split(',')]
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    results = []
+    context = multiprocessing.get_context('fork')
+    for vocab in vocabs:
+        for dim in dims:
+            for path in ('sparse', 'dense'):
+                for name, optim_cls, optim_kwargs in SUITE_CASES:
+                    # weight, gradient and up to two element-wise state tensors
+                    if vocab * dim * 4 * (4 if path == 'dense' else 3) > args.max_bytes:
+                        results.append(dict(optimizer=name, options=optim_kwargs, path=path, vocab=vocab, dim=dim,
+                                            status='skipped'))
+                        continue
+                    queue = context.Queue()
+                    process = context.Process(target=run_suite_case,
+                                              args=(name, optim_cls, optim_kwargs, path, vocab, dim, args, queue))
+                    process.start()
+                    record = wait_suite_case(process, queue, dict(optimizer=name, options=optim_kwargs, path=path,
+                                                                  vocab=vocab, dim=dim))
+                    process.join()
+                    results.append(record)
+                    if record['status'] == 'ok':
+                        print("{0} {1} {2} step, vocab {3}, dim {4}: {5:.1f} steps/sec, peak {6:.1f} MB, "
+                              "{7:.1f} MB moved/step".format(name, record['options'], path, vocab, dim,
+                                                             record['steps_per_sec'],
+                                                             record['peak_memory_bytes'] / 2 ** 20,
+                                                             record['bytes_moved_per_step'] / 2 ** 20))
+                    else:
+                        print("{0} {1} {2} step, vocab {3}, dim {4}: {5}".format(
+                            name, record['options'], path, vocab, dim, record.get('error', record['status'])))
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(commit=commit, torch=torch.__version__, device=args.device, batch_size=args.batch_size,
+                       fields=args.fields, steps=args.steps, warmup=args.warmup, results=results), f, indent=2)
+    print("results written to", args.output)
+
+
+def run_model(args, sparse_embedding, batches):
+    # Full training steps of DeepFM on Criteo-shaped data: 26 sparse fields of args.vocab ids each and 13 dense.
+    feature_columns = [SparseFeat('C' + str(i), args.vocab, embedding_dim=args.dim) for i in range(1, 27)] + \
+                      [DenseFeat('I' + str(i), 1) for i in range(1, 14)]
+    torch.manual_seed(args.seed)
+    model = DeepFM(feature_columns, feature_columns, device=args.device, sparse_embedding=sparse_embedding)
+    model.compile('adagrad', 'binary_crossentropy', optimizer_sparse='adagrad', optimizer_dense_lr=0.01,
+                  optimizer_sparse_lr=0.01)
+    model.train()
+    elapsed = 0
+    for i, (x, y) in enumerate(batches):
+        x = x.to(args.device)
+        y = y.to(args.device)
+        if args.device != 'cpu':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for optim in (model.optim, model.optim_s):
+            model._zero_grad(optim)
+        model._record_lookups()
+        loss = model.loss_func(model(x).squeeze(), y, reduction='sum')
+        (loss + model.get_regularization_loss()).backward()
+        model.optim.step()
+        model.optim_s.step()
+        if args.device != 'cpu':
+            torch.cuda.synchronize()
+        if i >= args.warmup:
+            elapsed += time.time() - start_time
+    return args.steps * args.batch_size / elapsed
+
+
+def bench_model(args):
+    rng = np.random.RandomState(args.seed)
+    batches = [(FeatureBatch(torch.from_numpy((rng.zipf(args.zipf, (args.batch_size, 26)) - 1) % args.vocab),
+                             torch.rand(args.batch_size, 13)),
+                torch.randint(0, 2, (args.batch_size,)).float()) for _ in range(args.steps + args.warmup)]
+    dense_speed = run_model(args, False, batches)
+    sparse_speed = run_model(args, True, batches)
+    print("===== DeepFM training step, 26 fields of vocab {0}, dim {1}, batch {2} =====".format(
+        args.vocab, args.dim, args.batch_size))
+    print("dense gradients: {0:.1f} samples/sec".format(dense_speed))
+    print("sparse_embedding=True: {0:.1f} samples/sec ({1:.2f}x)".format(sparse_speed, sparse_speed / dense_speed))
+
+
+def embedding_bytes(model):
+    tensors = list(model.named_parameters()) + list(model.named_buffers())
+    return sum(t.numel() * t.element_size() for name, t in tensors if 'embedding_dict' in name)
+
+
+def bench_quantized(args):
+    # DeepFM predict on Criteo-shaped data with the embedding tables in fp32 and quantized by quantize_embeddings.
+    feature_columns = [SparseFeat('C' + str(i), args.vocab, embedding_dim=args.dim) for i in range(1, 27)] + \
+                      [DenseFeat('I' + str(i), 1) for i in range(1, 14)]
+    torch.manual_seed(args.seed)
+    model = DeepFM(feature_columns, feature_columns, device=args.device, init_std=0.1)
+    rng = np.random.RandomState(args.seed)
+    num_samples = args.batch_size * (args.steps + args.warmup)
+    x = {fc.name: (rng.zipf(args.zipf, num_samples) - 1) % args.vocab if isinstance(fc, SparseFeat) else
+         rng.random_sample(num_samples) for fc in feature_columns}
+
+    print("===== DeepFM predict, 26 fields of vocab {0}, dim {1}, batch {2} =====".format(
+        args.vocab, args.dim, args.batch_size))
+    expected = None
+    for dtype in ('fp32', 'fp16', 'int8'):
+        quantized = model if dtype == 'fp32' else copy.deepcopy(model).quantize_embeddings(dtype)
+        quantized.predict({name: value[:args.batch_size * args.warmup] for name, value in x.items()},
+                          batch_size=args.batch_size)
+        start_time = time.time()
+        pred = quantized.predict({name: value[args.batch_size * args.warmup:] for name, value in x.items()},
+                                 batch_size=args.batch_size)
+        latency = (time.time() - start_time) * 1000 / args.steps
+        if expected is None:
+            expected = pred
+        print("{0}: {1:.3f} ms/batch, embeddings {2:.1f} MB, max prediction change {3:.2e}".format(
+            dtype, latency, embedding_bytes(quantized) / 2 ** 20, np.abs(pred - expected).max()))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.mode == 'sparse':
+        bench_sparse(args)
+    elif args.mode == 'dense':
+        bench_dense(args)
+    elif args.mode == 'model':
+        bench_model(args)
+    elif args.mode == 'quantized':
+        bench_quantized(args)
+    else:
+        bench_suite(args)
@@ -0,0 +1,170 @@
+import torch
+from .optimizer import Optimizer
+from .adagrad import _allocate_state
+
+
+class Ftrl(Optimizer):
+    """Implements the FTRL-Proximal algorithm.
+
+    It has been proposed in `Ad Click Prediction`_ (a View from the Trenches).
+    Every coordinate keeps the accumulated gradient ``z`` and the sum of
+    squared gradients ``n``; its weight is then given in closed form by
+
+        w = 0                                               if |z| <= l1
+        w = -(z - sign(z) * l1) / ((beta + sqrt(n)) / lr + l2)   otherwise
+
+    so the L1 term sets the weights of rarely seen or uninformative ids
+    exactly to zero. It is meant for the 1-dim embeddings of the linear part,
+    see ``BaseModel.compile(optimizer_linear='ftrl')`` and
+    ``Linear.compact()``.
+
+    Arguments:
+        params (iterable): iterable of parameters to optimize or dicts defining
+            parameter groups
+        lr (float, optional): learning rate, ``alpha`` in the paper
+            (default: 1e-2)
+        beta (float, optional): learning rate smoothing term, ``beta`` in the
+            paper (default: 1.0)
+        l1 (float, optional): L1 regularization strength (default: 0)
+        l2 (float, optional): L2 regularization strength (default: 0)
+        initial_accumulator_value (float, optional): starting value of ``n``
+            (default: 0)
+
+    Sparse gradients only gather and scatter the rows they touch, and
+    ``sparse_step`` makes the optimizer usable with
+    ``optimizer_sparse_in_backward``.
+
+    .. _Ad Click Prediction:
+        https://research.google.com/pubs/archive/41159.pdf
+    """
+
+    def __init__(self, params, lr=1e-2, beta=1.0, l1=0, l2=0, initial_accumulator_value=0):
+        if not 0.0 < lr:
+            raise ValueError("Invalid learning rate: {}".format(lr))
+        if not 0.0 <= beta:
+            raise ValueError("Invalid beta value: {}".format(beta))
+        if not 0.0 <= l1:
+            raise ValueError("Invalid l1 value: {}".format(l1))
+        if not 0.0 <= l2:
+            raise ValueError("Invalid l2 value: {}".format(l2))
+        if not 0.0 <= initial_accumulator_value:
+            raise ValueError("Invalid initial_accumulator_value value: {}".format(initial_accumulator_value))
+
+        defaults = dict(lr=lr, beta=beta, l1=l1, l2=l2, initial_accumulator_value=initial_accumulator_value)
+        super(Ftrl, self).__init__(params, defaults)
+
+        for group in self.param_groups:
+            for p in group['params']:
+                state = self.state[p]
+                state['step'] = 0
+                value = group['initial_accumulator_value']
+                state['z'] = _allocate_state(
+                    self, p, 'z', p.size(), p.dtype, 0,
+                    lambda: torch.zeros_like(p.data, memory_format=torch.preserve_format))
+                state['n'] = _allocate_state(
+                    self, p, 'n', p.size(), p.dtype, value,
+                    lambda: torch.full_like(p.data, value, memory_format=torch.preserve_format))
+
+    def share_memory(self):
+        for group in self.param_groups:
+            for p in group['params']:
+                state = self.state[p]
+                state['z'].share_memory_()
+                state['n'].share_memory_()
+
+    def step(self, closure=None):
+        """Performs a single optimization step.
+
+        Arguments:
+            closure (callable, optional): A closure that reevaluates the model
+                and returns the loss.
+        """
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                self._update(p, p.grad.data, group)
+
+        return loss
+
+    def sparse_step(self, p, indices, values):
+        """Applies a row-sparse gradient to a single parameter right away.
+
+        Arguments:
+            p (Tensor): a parameter of this optimizer, e.g. an embedding table
+            indices (LongTensor): 1-D indices of the rows the gradient refers
+                to, may contain repeated rows
+            values (Tensor): gradient rows, ``values[i]`` belongs to
+                ``p[indices[i]]``
+        """
+        grad = torch.sparse_coo_tensor(indices.unsqueeze(0), values, p.size())
+        self._update(p, grad, self._param_group(p))
+
+    def reset_state(self, p, rows):
+        """Resets the state of some rows of a parameter to its initial value.
+
+        Used when embedding rows are given to new ids, see ``DynamicEmbedding``.
+
+        Arguments:
+            p (Tensor): a parameter of this optimizer, e.g. an embedding table
+            rows (LongTensor): 1-D indices of the rows to reset
+        """
+        state = self.state[p]
+        if 'z' not in state:
+            return
+        group = self._param_group(p)
+        rows = rows.to(state['z'].device)
+        state['z'].index_fill_(0, rows, 0)
+        state['n'].index_fill_(0, rows, group['initial_accumulator_value'])
+
+    def _param_group(self, p):
+        for group in self.param_groups:
+            for param in group['params']:
+                if param is p:
+                    return group
+        raise ValueError("parameter is not optimized by this optimizer")
+
+    def _update(self, p, grad, group):
+        state = self.state[p]
+        state['step'] += 1
+
+        if not grad.is_sparse:
+            weight, z, n = self._proximal(p.data, state['z'], state['n'], grad, group)
+            state['z'].copy_(z)
+            state['n'].copy_(n)
+            p.data.copy_(weight)
+            return
+
+        if grad.sparse_dim() != 1:
+            raise RuntimeError("Ftrl requires row-sparse gradients")
+        rows = grad._indices()[0]
+        values = grad._values()
+        if not grad.is_coalesced():
+            # the update is non-linear so gradients of repeated rows must be summed first
+            rows, inverse = torch.unique(rows, return_inverse=True)
+            values = values.new_zeros((rows.size(0),) + values.size()[1:]).index_add_(0, inverse, values)
+        if rows.numel() == 0:
+            return
+
+        weight, z, n = self._proximal(p.data.index_select(0, rows), state['z'].index_select(0, rows),
+                                      state['n'].index_select(0, rows), values, group)
+        state['z'].index_copy_(0, rows, z)
+        state['n'].index_copy_(0, rows, n)
+        p.data.index_copy_(0, rows, weight)
+
+    @staticmethod
+    def _proximal(weight, z, n, grad, group):
+        # One FTRL-Proximal step on matching slices of the weights, ``z`` and ``n``.
+        # Returns the new weights, ``z`` and ``n``.
+        lr, l1 = group['lr'], group['l1']
+        n_new = n.addcmul(1, grad, grad)
+        sqrt_n_new = n_new.sqrt()
+        sigma = sqrt_n_new.sub(n.sqrt()).div_(lr)
+        z = z.add(grad).addcmul_(-1, sigma, weight)
+        weight = z.sign().mul_(l1).sub_(z).div_(sqrt_n_new.add_(group['beta']).div_(lr).add_(group['l2']))
+        weight.masked_fill_(z.abs() <= l1, 0)
+        return weight, z, n_new
@@ -13,19 +13,20 @@ import pandas as pd
 import torch
 from sklearn.metrics import log_loss, roc_auc_score,accuracy_score
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder, MinMaxScaler
+from sklearn.preprocessing import MinMaxScaler
 
-from deepctr_torch.inputs import SparseFeat, DenseFeat, get_feature_names, VarLenSparseFeat
+from deepctr_torch.inputs import SparseFeat, DenseFeat, get_feature_names, VarLenSparseFeat, JaggedArray
 from deepctr_torch.models import *
+from deepctr_torch.layers import CategoryEncoder
 
 import numpy as np
-from tensorflow.python.keras.preprocessing.sequence import pad_sequences
 
 
 # In[2]:
 
 
 import argparse
+import os
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--model", choices=('deepfm',
@@ -37,8 +38,64 @@ parser.add_argument("--dense-opt", choices=('adam',
 parser.add_argument("--sparse-opt", choices=('adam',
                                              'sgd', 'adagrad', 'radagrad', 'None'), default='sgd')
 
+parser.add_argument("--sparse-rowwise", action='store_true', default=False,
+                    help="keep one adagrad/radagrad state value per embedding row")
+parser.add_argument("--sparse-lazy-decay", action='store_true', default=False,
+                    help="decay radagrad state only for the embedding rows seen in a batch")
+parser.add_argument("--sparse-in-backward", action='store_true', default=False,
+                    help="apply the sparse optimizer update inside the embedding backward")
+parser.add_argument("--sparse-state-placement", choices=('device', 'pinned', 'mmap'), default='device',
+                    help="where the adagrad accumulators of the embeddings are stored")
+parser.add_argument("--sparse-state-dir", default=None,
+                    help="directory of the accumulator files of --sparse-state-placement mmap")
+parser.add_argument("--workers", type=int, default=1,
+                    help="number of cpu processes for hogwild training, which requires --sparse-grad or "
+                         "--sparse-in-backward")
+parser.add_argument("--dense-sync", choices=('hogwild', 'periodic'), default='hogwild',
+                    help="how hogwild workers share the dense parameters")
+parser.add_argument("--batch-reg", action='store_true', default=False,
+                    help="regularize only the embedding rows looked up in the current batch")
+parser.add_argument("--sparse-grad", action='store_true', default=False,
+                    help="give the embedding tables sparse gradients")
+parser.add_argument("--embedding-arena", action='store_true', default=False,
+                    help="store all embedding tables of one dimension in a single tensor")
+parser.add_argument("--fuse-linear", action='store_true', default=False,
+                    help="store the linear weight of a feature as an extra column of its deep embedding table")
+parser.add_argument("--linear-opt", choices=('ftrl', 'adagrad', 'sgd', 'None'), default='None',
+                    help="separate optimizer for the embeddings of the linear part")
+parser.add_argument("--linear-l1", type=float, default=0.0,
+                    help="L1 strength of the ftrl linear optimizer")
+parser.add_argument("--hash-buckets", type=int, default=0,
+                    help="hash the raw sparse features into this many buckets while batching instead of "
+                         "label encoding them first (avazu and criteo)")
+parser.add_argument("--qr-collisions", type=int, default=0,
+                    help="build the sparse features with more ids than this from a quotient and a remainder "
+                         "table of about vocabulary_size / qr-collisions + qr-collisions rows")
+parser.add_argument("--quantize", choices=('None', 'int8', 'fp16'), default='None',
+                    help="quantize the embedding tables row-wise before predicting on the test set")
+parser.add_argument("--qr-operation", choices=('mult', 'add', 'concat'), default='mult',
+                    help="how the quotient and remainder rows are combined")
+parser.add_argument("--cache-rows", type=int, default=0,
+                    help="keep only this many rows of the sparse features with more ids on the device, the "
+                         "others in host memory or a memory-mapped file")
+parser.add_argument("--cache-storage", choices=('pinned', 'memory', 'mmap'), default='pinned',
+                    help="where the rows beyond --cache-rows are kept")
+parser.add_argument("--cache-dir", default='./embedding_cache',
+                    help="directory of the tables of --cache-storage mmap")
+parser.add_argument("--mmap-dir", default=None,
+                    help="store the sparse embedding tables and their optimizer state in memory-mapped files "
+                         "under this directory; existing files are opened and trained further")
+
+parser.add_argument("--vocabulary-dir", default=None,
+                    help="save the vocabularies of the sparse features under this directory, and load them from it "
+                         "instead of fitting them again when they exist; they are only keyed by the dataset, so "
+                         "remove them when its files change, or every new value gets the unseen id")
+parser.add_argument("--encode-workers", type=int, default=1,
+                    help="number of processes encoding the sparse features")
+
 parser.add_argument("--dense-lr", type=float, default=0.01)
 parser.add_argument("--sparse-lr", type=float, default=0.001)
+parser.add_argument("--linear-lr", type=float, default=0.01)
 parser.add_argument("--dataset", choices=('criteo','avazu', 'movielen'), default='avazu')
 parser.add_argument("--debug", action = 'store_true', default=False)
 args = parser.parse_args()
@@ -47,6 +104,9 @@ args = parser.parse_args()
 
 
 data_prefix = "/data/project/deep-ctr-torch/"
+vocabulary_path = os.path.join(args.vocabulary_dir, args.dataset + ("-debug" if args.debug else "")) \
+    if args.vocabulary_dir else None
+encoder = CategoryEncoder(vocabulary_path, workers=args.encode_workers)
 
 if args.dataset == "avazu":
     data_prefix = data_prefix + "avazu-ctr-prediction/"
@@ -69,15 +129,19 @@ if args.dataset == "avazu":
     if dense_features != []:
         data[dense_features] = mms.fit_transform(data[dense_features])
 
-    for feat in sparse_features:
-        lbe = LabelEncoder()
-        data[feat] = lbe.fit_transform(data[feat])
+    if not args.hash_buckets:
+        for feat, ids in encoder.fit_transform(data, sparse_features).items():
+            data[feat] = ids
 
     # 2.count #unique features for each sparse field,and record dense feature field name
 
-    fixlen_feature_columns = [SparseFeat(feat, vocabulary_size=data[feat].nunique() + 10, embedding_dim=4)
-                              for i, feat in enumerate(sparse_features)] + [DenseFeat(feat, 1,)
-                                                                            for feat in dense_features]
+    if args.hash_buckets:
+        fixlen_feature_columns = [SparseFeat(feat, vocabulary_size=args.hash_buckets, embedding_dim=4, use_hash=True)
+                                  for feat in sparse_features]
+    else:
+        fixlen_feature_columns = [SparseFeat(feat, vocabulary_size=encoder.vocabulary_size(feat), embedding_dim=4)
+                                  for i, feat in enumerate(sparse_features)]
+    fixlen_feature_columns += [DenseFeat(feat, 1,) for feat in dense_features]
 
     dnn_feature_columns = fixlen_feature_columns
     linear_feature_columns = fixlen_feature_columns
@@ -94,7 +158,6 @@ elif args.dataset == "criteo":
     # Data processing code adapted from https://github.com/facebookresearch/dlrm
     # Follow steps in https://github.com/ylongqi/dlrm/blob/master/data_utils.py to generate kaggle_processed.npz
     # Or using `./download_dataset.sh criteo` command to download the processed data.
-    import os
     datapath = data_prefix + "criteo/"
     if args.debug:
         datapath = datapath + 'kaggle_processed_tiny.npz'
@@ -122,21 +185,26 @@ elif args.dataset == "criteo":
     sparse_features = ['C' + str(i) for i in range(1, 27)]
     dense_features = ['I' + str(i) for i in range(1, 14)]
 
-    data[sparse_features] = data[sparse_features].fillna('-1', )
+    # X_cat holds ids already, the encoder keeps the columns holding every id up to their largest and only saves
+    # their vocabulary size
     data[dense_features] = data[dense_features].fillna(0, )
     target = ['label']
 
     # 1.Label Encoding for sparse features,and do simple Transformation for dense features
-    for feat in sparse_features:
-        lbe = LabelEncoder()
-        data[feat] = lbe.fit_transform(data[feat])
+    if not args.hash_buckets:
+        for feat, ids in encoder.fit_transform(data, sparse_features).items():
+            data[feat] = ids
     mms = MinMaxScaler(feature_range=(0, 1))
     data[dense_features] = mms.fit_transform(data[dense_features])
     # 2.count #unique features for each sparse field,and record dense feature field name
 
-    fixlen_feature_columns = [SparseFeat(feat, data[feat].nunique())
-                              for feat in sparse_features] + [DenseFeat(feat, 1, )
-                                                              for feat in dense_features]
+    if args.hash_buckets:
+        fixlen_feature_columns = [SparseFeat(feat, args.hash_buckets, use_hash=True)
+                                  for feat in sparse_features]
+    else:
+        fixlen_feature_columns = [SparseFeat(feat, encoder.vocabulary_size(feat))
+                                  for feat in sparse_features]
+    fixlen_feature_columns += [DenseFeat(feat, 1, ) for feat in dense_features]
 
     dnn_feature_columns = fixlen_feature_columns
     linear_feature_columns = fixlen_feature_columns
@@ -153,14 +221,6 @@ elif args.dataset == "criteo":
 
 elif args.dataset == "movielen":
 
-    def split(x):
-        key_ans = x.split('|')
-        for key in key_ans:
-            if key not in key2index:
-                # Notice : input value 0 is a special "padding",so we do not use 0 to encode valid feature for sequence input
-                key2index[key] = len(key2index) + 1
-        return list(map(lambda x: key2index[x], key_ans))
-
     data_prefix = data_prefix + "ml_25m/"
     if args.debug:
         datapath = data_prefix + "ml_25m_test-mini.csv"
@@ -171,26 +231,28 @@ elif args.dataset == "movielen":
     target = ['rating']
 
     # 1.Label Encoding for sparse features,and process sequence features
-    for feat in sparse_features:
-        lbe = LabelEncoder()
-        data[feat] = lbe.fit_transform(data[feat])
+    for feat, ids in encoder.fit_transform(data, sparse_features).items():
+        data[feat] = ids
     # preprocess the sequence feature
 
-    key2index = {}
-    genres_list = list(map(split, data['genres'].values))
-    genres_length = np.array(list(map(len, genres_list)))
-    max_len = max(genres_length)
-    # Notice : padding=`post`
-    genres_list = pad_sequences(genres_list, maxlen=max_len, padding='post', )
+    # the genres of a movie are kept as one jagged row of ids, without padding them to the longest list
+    genres_tokens = data['genres'].str.split('|')
+    genres_length = genres_tokens.str.len().values
+    max_len = int(genres_length.max())
+    genres_offsets = np.zeros(len(genres_length) + 1, dtype=np.int64)
+    np.cumsum(genres_length, out=genres_offsets[1:])
+    # Notice : 0 stays the padding id of sequence inputs, so the genres are encoded from 1
+    genres_codes, genres_vocabulary = pd.factorize(np.concatenate(genres_tokens.values))
+    genres_list = JaggedArray(genres_codes + 1, genres_offsets)
 
     # 2.count #unique features for each sparse field and generate feature config for sequence feature
 
-    fixlen_feature_columns = [SparseFeat(feat, data[feat].nunique(), embedding_dim=4)
+    fixlen_feature_columns = [SparseFeat(feat, encoder.vocabulary_size(feat), embedding_dim=4)
                               for feat in sparse_features]
 
     varlen_feature_columns = [VarLenSparseFeat(SparseFeat('genres', vocabulary_size=len(
-        key2index) + 1, embedding_dim=4), maxlen=max_len, combiner='mean',
-                                               length_name=None)]  # Notice : value 0 is for padding for sequence input feature
+        genres_vocabulary) + 1, embedding_dim=4), maxlen=max_len, combiner='mean',
+                                               length_name=None, jagged=True)]
 
     linear_feature_columns = fixlen_feature_columns + varlen_feature_columns
     dnn_feature_columns = fixlen_feature_columns + varlen_feature_columns
@@ -201,11 +263,13 @@ elif args.dataset == "movielen":
 #     model_input = {name: data[name] for name in sparse_features}  #
 #     model_input["genres"] = genres_list
 
-    data['genres'] = genres_list
-    train, test = train_test_split(data, test_size=0.1)
-    feature_names = ["movieId", "userId",'imdbId','tmdbId', 'genres']
+    train_index, test_index = train_test_split(np.arange(len(data)), test_size=0.1)
+    train, test = data.iloc[train_index], data.iloc[test_index]
+    feature_names = ["movieId", "userId",'imdbId','tmdbId']
     train_model_input = {name: train[name] for name in feature_names}
     test_model_input = {name: test[name] for name in feature_names}
+    train_model_input['genres'] = genres_list[train_index]
+    test_model_input['genres'] = genres_list[test_index]
 
 
 #     history = model.fit(model_input, data[target].values,
@@ -218,6 +282,29 @@ elif args.dataset == "movielen":
 
 
 # 4.Define Model,train,predict and evaluate
+if args.qr_collisions:
+    def compositional(fc):
+        if isinstance(fc, SparseFeat) and fc.vocabulary_size > args.qr_collisions:
+            return fc._replace(compositional={'num_collisions': args.qr_collisions, 'operation': args.qr_operation})
+        return fc
+    linear_feature_columns = [compositional(fc) for fc in linear_feature_columns]
+    dnn_feature_columns = [compositional(fc) for fc in dnn_feature_columns]
+
+if args.cache_rows:
+    def cached(fc):
+        if isinstance(fc, SparseFeat) and fc.vocabulary_size > args.cache_rows:
+            return fc._replace(cache={'cache_size': args.cache_rows, 'storage': args.cache_storage,
+                                      'storage_dir': args.cache_dir})
+        return fc
+    linear_feature_columns = [cached(fc) for fc in linear_feature_columns]
+    dnn_feature_columns = [cached(fc) for fc in dnn_feature_columns]
+
+if args.mmap_dir is not None:
+    linear_feature_columns = [fc._replace(mmap=args.mmap_dir) if isinstance(fc, SparseFeat) else fc
+                              for fc in linear_feature_columns]
+    dnn_feature_columns = [fc._replace(mmap=args.mmap_dir) if isinstance(fc, SparseFeat) else fc
+                           for fc in dnn_feature_columns]
+
 model_name = args.model
 optimizer_dense = args.dense_opt
 optimizer_sparse = args.sparse_opt
@@ -227,10 +314,22 @@ optimizer_sparse_lr = args.sparse_lr
 if optimizer_sparse == 'None':
     optimizer_sparse = None
 
+optimizer_sparse_params = {}
+if args.sparse_rowwise:
+    optimizer_sparse_params['rowwise'] = True
+if args.sparse_lazy_decay:
+    optimizer_sparse_params['lazy_decay'] = True
+if args.sparse_state_placement != 'device':
+    optimizer_sparse_params['state_placement'] = args.sparse_state_placement
+    optimizer_sparse_params['state_dir'] = args.sparse_state_dir
+
+optimizer_linear = None if args.linear_opt == 'None' else args.linear_opt
+optimizer_linear_params = {'l1': args.linear_l1} if optimizer_linear == 'ftrl' else {}
+
 
 print("=====", model_name,optimizer_dense,optimizer_dense_lr,optimizer_sparse,optimizer_sparse_lr, "=====")
 device = 'cpu'
-use_cuda = True
+use_cuda = args.workers == 1
 if use_cuda and torch.cuda.is_available():
     print('cuda ready...')
     device = 'cuda:0'
@@ -238,19 +337,24 @@ if use_cuda and torch.cuda.is_available():
 model = None
 if model_name == "deepfm":
     model = DeepFM(linear_feature_columns, dnn_feature_columns,
-                   task='binary', device=device)
+                   task='binary', device=device, embedding_arena=args.embedding_arena,
+                   sparse_embedding=args.sparse_grad, fuse_linear_embedding=args.fuse_linear)
 elif model_name == "din":
     model = DIN(linear_feature_columns, dnn_feature_columns,
-                task='binary', device=device)
+                task='binary', device=device, embedding_arena=args.embedding_arena,
+                sparse_embedding=args.sparse_grad)
 elif model_name == "wdl":
     model = WDL(linear_feature_columns, dnn_feature_columns,
-                task='binary', device=device)
+                task='binary', device=device, embedding_arena=args.embedding_arena,
+                sparse_embedding=args.sparse_grad, fuse_linear_embedding=args.fuse_linear)
 elif model_name == "dcn":
     model = DCN(linear_feature_columns, dnn_feature_columns,
-                task='binary', device=device)
+                task='binary', device=device, embedding_arena=args.embedding_arena,
+                sparse_embedding=args.sparse_grad, fuse_linear_embedding=args.fuse_linear)
 elif model_name == "nfm":
     model = NFM(linear_feature_columns, dnn_feature_columns,
-                task='binary', device=device)
+                task='binary', device=device, embedding_arena=args.embedding_arena,
+                sparse_embedding=args.sparse_grad, fuse_linear_embedding=args.fuse_linear)
 
 import datetime
 xmh_model_dir = "xmh_logs/" + args.dataset + "-" + model_name + "-" + optimizer_dense +str(optimizer_dense_lr) + str(optimizer_sparse) + str(optimizer_sparse_lr)
@@ -259,19 +363,37 @@ model.compile(optimizer=optimizer_dense, loss="binary_crossentropy",
               metrics=['binary_crossentropy', 'acc', 'AUC'],
               optimizer_sparse=optimizer_sparse,
               optimizer_dense_lr=optimizer_dense_lr,
-              optimizer_sparse_lr=optimizer_sparse_lr, )
+              optimizer_sparse_lr=optimizer_sparse_lr,
+              optimizer_sparse_params=optimizer_sparse_params,
+              optimizer_sparse_in_backward=args.sparse_in_backward,
+              optimizer_linear=optimizer_linear,
+              optimizer_linear_lr=args.linear_lr,
+              optimizer_linear_params=optimizer_linear_params,
+              regularization='batch' if args.batch_reg else None, )
 if args.debug:
     verbose_steps = 10
 else:
     verbose_steps = 20000
 history = model.fit(train_model_input, train[target].values,
                     batch_size=256, epochs=1, verbose=1, validation_split=0.1, model_name=model_name,
-                   verbose_steps= verbose_steps, xmh_model_dir = xmh_model_dir)
+                   verbose_steps= verbose_steps, xmh_model_dir = xmh_model_dir,
+                    workers=args.workers, dense_sync=args.dense_sync)
+if optimizer_linear == 'ftrl':
+    # keep only the linear weights that the L1 term left non-zero
+    num_linear = sum(p.numel() for p in model.linear_model.embedding_dict.parameters())
+    model.compact_linear()
+    print("linear embeddings compacted from {0} to {1} rows".format(
+        num_linear, sum(table.ids.numel() for table in model.linear_model.embedding_dict.values())))
+if args.quantize != 'None':
+    model.quantize_embeddings(args.quantize)
 pred_ans = model.predict(test_model_input, batch_size=256)
 print("test LogLoss", round(log_loss(test[target].values, pred_ans), 4))
 print("test Accuracy", round(accuracy_score(
     test[target].values, pred_ans > 0.5), 4))
 print("test AUC", round(roc_auc_score(test[target].values, pred_ans), 4))
+embedding_bytes = sum(t.numel() * t.element_size() for name, t in list(model.named_parameters()) +
+                      list(model.named_buffers()) if 'embedding_dict' in name)
+print("embedding memory", round(embedding_bytes / 2 ** 20, 2), "MB")
 
 
 # In[ ]:
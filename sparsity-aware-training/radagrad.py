@@ -1,5 +1,8 @@
+from collections import defaultdict
+
 import torch
 from .optimizer import Optimizer
+from .adagrad import _allocate_state, _flatten_state, _flat_state, _scatter_state, _state_tensors, _copy_into
 
 
 class RAdagrad(Optimizer):
@@ -28,10 +31,31 @@ class RAdagrad(Optimizer):
         centered (bool, optional) : if ``True``, compute the centered RMSProp,
             the gradient is normalized by an estimation of its variance
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
+        rowwise (bool, optional): if ``True``, parameters with more than one
+            dimension (embedding tables) keep a single ``square_avg`` value per
+            row, updated with the mean of the squared gradient of that row.
+            The sparse path already writes one value to every touched row, so
+            there it only changes the storage. ``momentum_buffer`` stays
+            element-wise, and ``centered`` is not supported (default: False)
+        lazy_decay (bool, optional): if ``True``, sparse gradients only touch
+            the rows present in the batch. Each row records the step it was
+            last updated at, and the decay of ``square_avg`` and
+            ``momentum_buffer`` it missed meanwhile is applied when the row
+            is touched again. Call :meth:`flush` to bring every row up to
+            date before checkpointing or evaluation. ``centered`` is not
+            supported (default: False)
+        multi_tensor (bool, optional): if ``True``, parameters with dense
+            gradients and element-wise, eagerly decayed state are bucketed by
+            dtype and device, and each bucket is updated with a few ops over
+            one flat buffer instead of several small kernels per parameter.
+            The state created by the first step of a bucket is made of views
+            of that buffer, that of other buckets is gathered and written back
+            (default: False)
 
     """
 
-    def __init__(self, params, lr=1e-2, alpha=0.9999, eps=1e-8, weight_decay=0, momentum=0, centered=False):
+    def __init__(self, params, lr=1e-2, alpha=0.9999, eps=1e-8, weight_decay=0, momentum=0, centered=False,
+                 rowwise=False, lazy_decay=False, multi_tensor=False):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -42,8 +66,13 @@ class RAdagrad(Optimizer):
             raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
         if not 0.0 <= alpha:
             raise ValueError("Invalid alpha value: {}".format(alpha))
+        if rowwise and centered:
+            raise ValueError("rowwise option is not compatible with centered")
+        if lazy_decay and centered:
+            raise ValueError("lazy_decay option is not compatible with centered")
 
-        defaults = dict(lr=lr, momentum=momentum, alpha=alpha, eps=eps, centered=centered, weight_decay=weight_decay)
+        defaults = dict(lr=lr, momentum=momentum, alpha=alpha, eps=eps, centered=centered, weight_decay=weight_decay,
+                        rowwise=rowwise, lazy_decay=lazy_decay, multi_tensor=multi_tensor)
         super(RAdagrad, self).__init__(params, defaults)
 
     def __setstate__(self, state):
@@ -51,6 +80,45 @@ class RAdagrad(Optimizer):
         for group in self.param_groups:
             group.setdefault('momentum', 0)
             group.setdefault('centered', False)
+            group.setdefault('rowwise', False)
+            group.setdefault('lazy_decay', False)
+            group.setdefault('multi_tensor', False)
+
+    def load_state_dict(self, state_dict):
+        # the loaded values are copied into the current state tensors, which may be shared or flat buffers
+        current = _state_tensors(self.state)
+        super(RAdagrad, self).load_state_dict(state_dict)
+        _copy_into(current, self.state)
+
+    def share_memory(self):
+        """Moves the state of every parameter to shared memory, e.g. for Hogwild training.
+
+        The state is initialized here rather than on the first step so that
+        processes forked afterwards update the same tensors.
+        """
+        for group in self.param_groups:
+            if group['lazy_decay']:
+                raise RuntimeError("lazy_decay option is not compatible with shared state, "
+                                   "the step count of each process would differ")
+            for p in group['params']:
+                state = self.state[p]
+                if len(state) == 0:
+                    self._init_state(p, group, state)
+                for value in state.values():
+                    if torch.is_tensor(value):
+                        value.share_memory_()
+
+    def flush(self):
+        """Applies the decay every lazily decayed row has missed since its last update.
+
+        After this call the state and the weights are the same as if every step
+        had been applied eagerly.
+        """
+        for group in self.param_groups:
+            for p in group['params']:
+                state = self.state[p]
+                if 'last_step' in state:
+                    self._flush_lazy(p, group, state, state['step'])
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -64,88 +132,292 @@ class RAdagrad(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            updated = self._multi_tensor_update(group) if group['multi_tensor'] else set()
             for p in group['params']:
-                if p.grad is None:
+                if p.grad is None or id(p) in updated:
                     continue
-                grad = p.grad.data
-                # if grad.is_sparse:
-                #     print(grad.coalesce())
-                #     print(p.data)
-                #     raise RuntimeError('RMSprop does not support sparse gradients')
-                state = self.state[p]
+                self._update(p, p.grad.data, group)
 
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    state['square_avg'] = torch.zeros_like(p.data, memory_format=torch.preserve_format)
-                    if group['momentum'] > 0:
-                        state['momentum_buffer'] = torch.zeros_like(p.data, memory_format=torch.preserve_format)
-                    if group['centered']:
-                        state['grad_avg'] = torch.zeros_like(p.data, memory_format=torch.preserve_format)
-
-                square_avg = state['square_avg']
-                alpha = group['alpha']
-
-                state['step'] += 1
-
-                if group['weight_decay'] != 0:
-                    if grad.is_sparse:
-                        raise RuntimeError('weight_decay option is not compatible with sparse gradients in RMSprop')
-                    grad = grad.add(group['weight_decay'], p.data)
-
-                if grad.is_sparse:
-                    grad = grad.coalesce()
-                    grad_indices = grad._indices()
-                    grad_values = grad._values()
-                    size = grad.size()
-                    def make_sparse(values):
-                        constructor = grad.new
-                        if grad_indices.dim() == 0 or values.dim() == 0:
-                            return constructor().resize_as_(grad)
-                        return constructor(grad_indices, values, size)
-                    length = 1
-                    for i in grad_values.size():
-                        if i == 0:
-                            raise RuntimeError()
-                        length *= i
-                    grad_v = grad_values.clone().detach().pow_(2)
-                    grad_v = grad_v.sum() / length
-                    grad_v = torch.full(grad_values.size(), grad_v).to(grad.device)
-                    grad_2 = make_sparse(grad_v)
-                    square_avg.mul_(alpha).add_((1 - alpha), grad_2)
-                    square_avg = square_avg.sparse_mask(grad)
-                    if group['centered']:
-                        grad_avg = state['grad_avg']
-                        grad_avg.mul_(alpha).add_(1 - alpha, grad_values)
-                        grad_avg_2 = make_sparse(grad_avg.pow(2))
-                        avg = square_avg.add(-1 * grad_avg_2).sqrt_().add_(group['eps'])
-                    else:
-                        avg = square_avg._values().sqrt_().add_(group['eps'])
-
-                    if group['momentum'] > 0:
-                        buf = state['momentum_buffer']
-                        temp = make_sparse(grad_values / avg)
-                        buf.mul_(group['momentum']).add_(temp)
-                        p.data.add_(-group['lr'], buf)
-                    else:
-                        temp = make_sparse(grad_values / avg)
-                        p.data.add_(-group['lr'], temp)
+        return loss
+
+    def sparse_step(self, p, indices, values):
+        """Applies a row-sparse gradient to a single parameter right away.
+
+        Used to update embedding tables from their backward pass, without a
+        gradient ever being stored in ``p.grad``.
+
+        Arguments:
+            p (Tensor): a parameter of this optimizer, e.g. an embedding table
+            indices (LongTensor): 1-D indices of the rows the gradient refers
+                to, may contain repeated rows
+            values (Tensor): gradient rows, ``values[i]`` belongs to
+                ``p[indices[i]]``
+        """
+        grad = torch.sparse_coo_tensor(indices.unsqueeze(0), values, p.size())
+        self._update(p, grad, self._param_group(p))
+
+    def reset_state(self, p, rows):
+        """Resets the state of some rows of a parameter to its initial value.
+
+        Used when embedding rows are given to new ids, see ``DynamicEmbedding``.
+
+        Arguments:
+            p (Tensor): a parameter of this optimizer, e.g. an embedding table
+            rows (LongTensor): 1-D indices of the rows to reset
+        """
+        state = self.state[p]
+        if len(state) == 0:
+            return
+        rows = rows.to(state['square_avg'].device)
+        for key in ('square_avg', 'momentum_buffer', 'grad_avg'):
+            if key in state:
+                state[key].index_fill_(0, rows, 0)
+        if 'last_step' in state:
+            state['last_step'].index_fill_(0, rows, state['step'])
+
+    def _param_group(self, p):
+        for group in self.param_groups:
+            for param in group['params']:
+                if param is p:
+                    return group
+        raise ValueError("parameter is not optimized by this optimizer")
+
+    def _init_state(self, p, group, state):
+        zeros_like = lambda: torch.zeros_like(p.data, memory_format=torch.preserve_format)
+        state['step'] = 0
+        if group['rowwise'] and p.dim() > 1:
+            state['square_avg'] = _allocate_state(self, p, 'square_avg', (p.size(0),), p.dtype, 0,
+                                                  lambda: p.data.new_zeros(p.size(0)))
+        else:
+            state['square_avg'] = _allocate_state(self, p, 'square_avg', p.size(), p.dtype, 0, zeros_like)
+        if group['momentum'] > 0:
+            state['momentum_buffer'] = _allocate_state(self, p, 'momentum_buffer', p.size(), p.dtype, 0, zeros_like)
+        if group['centered']:
+            state['grad_avg'] = _allocate_state(self, p, 'grad_avg', p.size(), p.dtype, 0, zeros_like)
+        if group['lazy_decay'] and p.dim() > 1:
+            state['last_step'] = _allocate_state(
+                self, p, 'last_step', (p.size(0),), torch.long, 0,
+                lambda: torch.zeros(p.size(0), dtype=torch.long, device=p.device))
+
+    def _multi_tensor_update(self, group):
+        # Updates the dense parameters of ``group`` with element-wise, eagerly decayed state
+        # bucket by bucket and returns the ids of the parameters it has updated.
+        buckets = defaultdict(list)
+        created = set()
+        for p in group['params']:
+            if p.grad is None or p.grad.is_sparse:
+                continue
+            state = self.state[p]
+            if len(state) == 0:
+                self._init_state(p, group, state)
+                if getattr(p, 'state_allocator', None) is None:
+                    created.add(id(p))
+            if state['square_avg'].dim() < p.dim() or 'last_step' in state:
+                continue
+            buckets[(p.dtype, p.device)].append(p)
+
+        updated = set()
+        flat_buffers = self.__dict__.setdefault('_flat_buffers', {})
+        alpha = group['alpha']
+        for params in buckets.values():
+            if len(params) < 2:
+                continue
+            ids = tuple(id(p) for p in params)
+            names = [name for name in ('square_avg', 'momentum_buffer', 'grad_avg') if name in self.state[params[0]]]
+            if all(id(p) in created for p in params):
+                # state created by this step becomes views of one flat buffer per name, updated in place
+                for name in names:
+                    views = _flatten_state(flat_buffers, (name,) + ids, [self.state[p][name] for p in params])
+                    for p, view in zip(params, views):
+                        self.state[p][name] = view
+            flat, gathered = {}, []
+            for name in names:
+                tensors = [self.state[p][name] for p in params]
+                flat[name], copy = _flat_state(flat_buffers, (name,) + ids, tensors)
+                if copy:
+                    gathered.append((flat[name], tensors))
+            flat_grad = torch.cat([p.grad.data.reshape(-1) for p in params])
+            if group['weight_decay'] != 0:
+                flat_grad.add_(group['weight_decay'], torch.cat([p.data.reshape(-1) for p in params]))
+
+            square_avg = flat['square_avg']
+            square_avg.mul_(alpha).addcmul_(1 - alpha, flat_grad, flat_grad)
+            if group['centered']:
+                grad_avg = flat['grad_avg']
+                grad_avg.mul_(alpha).add_(1 - alpha, flat_grad)
+                avg = square_avg.addcmul(-1, grad_avg, grad_avg).sqrt_().add_(group['eps'])
+            else:
+                avg = square_avg.sqrt().add_(group['eps'])
+
+            if group['momentum'] > 0:
+                buf = flat['momentum_buffer']
+                buf.mul_(group['momentum']).addcdiv_(flat_grad, avg)
+                flat_update = buf.mul(-group['lr'])
+            else:
+                flat_update = flat_grad.div_(avg).mul_(-group['lr'])
+            for flat_state, tensors in gathered:
+                _scatter_state(flat_state, tensors)
+
+            offset = 0
+            for p in params:
+                self.state[p]['step'] += 1
+                p.data.add_(flat_update[offset:offset + p.numel()].view_as(p))
+                offset += p.numel()
+                updated.add(id(p))
+        return updated
+
+    def _update(self, p, grad, group):
+        # if grad.is_sparse:
+        #     print(grad.coalesce())
+        #     print(p.data)
+        #     raise RuntimeError('RMSprop does not support sparse gradients')
+        state = self.state[p]
+
+        # State initialization
+        if len(state) == 0:
+            self._init_state(p, group, state)
+
+        square_avg = state['square_avg']
+        alpha = group['alpha']
+        rowwise = square_avg.dim() < p.dim()
+
+        state['step'] += 1
+
+        if group['weight_decay'] != 0:
+            if grad.is_sparse:
+                raise RuntimeError('weight_decay option is not compatible with sparse gradients in RMSprop')
+            grad = grad.add(group['weight_decay'], p.data)
+
+        if 'last_step' in state:
+            if grad.is_sparse:
+                self._lazy_sparse_update(p, grad, group, state)
+                return
+            # a dense gradient touches every row: catch up the whole table and
+            # fall through to the eager update
+            self._flush_lazy(p, group, state, state['step'] - 1)
+            state['last_step'].fill_(state['step'])
+
+        if grad.is_sparse:
+            grad = grad.coalesce()
+            grad_indices = grad._indices()
+            grad_values = grad._values()
+            size = grad.size()
+            def make_sparse(values):
+                constructor = grad.new
+                if grad_indices.dim() == 0 or values.dim() == 0:
+                    return constructor().resize_as_(grad)
+                return constructor(grad_indices, values, size)
+            length = 1
+            for i in grad_values.size():
+                if i == 0:
+                    raise RuntimeError()
+                length *= i
+            grad_v = grad_values.clone().detach().pow_(2)
+            grad_v = grad_v.sum() / length
+            if rowwise:
+                rows = grad_indices[0]
+                grad_v = torch.full((rows.size(0),), grad_v).to(grad.device)
+                square_avg.mul_(alpha).index_add_(0, rows, grad_v.mul_(1 - alpha))
+                avg = square_avg.index_select(0, rows).sqrt_().add_(group['eps'])
+                avg = avg.view((-1,) + (1,) * (grad_values.dim() - 1))
+            else:
+                grad_v = torch.full(grad_values.size(), grad_v).to(grad.device)
+                grad_2 = make_sparse(grad_v)
+                square_avg.mul_(alpha).add_((1 - alpha), grad_2)
+                square_avg = square_avg.sparse_mask(grad)
+                if group['centered']:
+                    grad_avg = state['grad_avg']
+                    grad_avg.mul_(alpha).add_(1 - alpha, grad_values)
+                    grad_avg_2 = make_sparse(grad_avg.pow(2))
+                    avg = square_avg.add(-1 * grad_avg_2).sqrt_().add_(group['eps'])
                 else:
-                    square_avg.mul_(alpha).addcmul_(1 - alpha, grad, grad)
-
-                    if group['centered']:
-                        grad_avg = state['grad_avg']
-                        grad_avg.mul_(alpha).add_(1 - alpha, grad)
-                        avg = square_avg.addcmul(-1, grad_avg, grad_avg).sqrt_().add_(group['eps'])
-                    else:
-                        avg = square_avg.sqrt().add_(group['eps'])
-
-                    if group['momentum'] > 0:
-                        buf = state['momentum_buffer']
-                        buf.mul_(group['momentum']).addcdiv_(grad, avg)
-                        p.data.add_(-group['lr'], buf)
-                    else:
-                        p.data.addcdiv_(-group['lr'], grad, avg)
+                    avg = square_avg._values().sqrt_().add_(group['eps'])
 
-        return loss
+            if group['momentum'] > 0:
+                buf = state['momentum_buffer']
+                temp = make_sparse(grad_values / avg)
+                buf.mul_(group['momentum']).add_(temp)
+                p.data.add_(-group['lr'], buf)
+            else:
+                temp = make_sparse(grad_values / avg)
+                p.data.add_(-group['lr'], temp)
+        elif rowwise:
+            square_avg.mul_(alpha).add_(1 - alpha, grad.pow(2).view(grad.size(0), -1).mean(1))
+            avg = square_avg.sqrt().add_(group['eps']).view((-1,) + (1,) * (p.dim() - 1))
+
+            if group['momentum'] > 0:
+                buf = state['momentum_buffer']
+                buf.mul_(group['momentum']).addcdiv_(grad, avg)
+                p.data.add_(-group['lr'], buf)
+            else:
+                p.data.addcdiv_(-group['lr'], grad, avg)
+        else:
+            square_avg.mul_(alpha).addcmul_(1 - alpha, grad, grad)
+
+            if group['centered']:
+                grad_avg = state['grad_avg']
+                grad_avg.mul_(alpha).add_(1 - alpha, grad)
+                avg = square_avg.addcmul(-1, grad_avg, grad_avg).sqrt_().add_(group['eps'])
+            else:
+                avg = square_avg.sqrt().add_(group['eps'])
+
+            if group['momentum'] > 0:
+                buf = state['momentum_buffer']
+                buf.mul_(group['momentum']).addcdiv_(grad, avg)
+                p.data.add_(-group['lr'], buf)
+            else:
+                p.data.addcdiv_(-group['lr'], grad, avg)
+
+    @staticmethod
+    def _geometric_sum(ratio, n):
+        # sum of ratio ** j for j in 1..n, element-wise over the tensor n
+        if ratio == 1:
+            return n
+        return (ratio - torch.pow(ratio, n + 1)) / (1 - ratio)
+
+    def _lazy_sparse_update(self, p, grad, group, state):
+        grad = grad.coalesce()
+        rows = grad._indices()[0]
+        grad_values = grad._values()
+        if grad_values.numel() == 0:
+            return
+        alpha = group['alpha']
+        momentum = group['momentum']
+        square_avg = state['square_avg']
+        shape = (-1,) + (1,) * (grad_values.dim() - 1)
+
+        # number of steps since each row was last brought up to date, this one included
+        skipped = (state['step'] - state['last_step'].index_select(0, rows)).to(grad_values.dtype)
+
+        square_values = square_avg.index_select(0, rows)
+        square_values.mul_(torch.pow(alpha, skipped).view(shape if square_avg.dim() == p.dim() else -1))
+        square_values.add_(grad_values.pow(2).mean().mul_(1 - alpha))
+        square_avg.index_copy_(0, rows, square_values)
+        avg = square_values.sqrt_().add_(group['eps'])
+        if square_avg.dim() < p.dim():
+            avg = avg.view(shape)
+        delta = grad_values / avg
+
+        if momentum > 0:
+            buf = state['momentum_buffer']
+            buf_values = buf.index_select(0, rows)
+            # the skipped steps moved the weights along the decaying momentum as well
+            catch_up = buf_values * self._geometric_sum(momentum, skipped - 1).view(shape)
+            buf_values.mul_(torch.pow(momentum, skipped).view(shape)).add_(delta)
+            buf.index_copy_(0, rows, buf_values)
+            delta = catch_up.add_(buf_values)
+
+        p.data.index_add_(0, rows, delta.mul_(-group['lr']))
+        state['last_step'].index_fill_(0, rows, state['step'])
 
+    def _flush_lazy(self, p, group, state, step):
+        last_step = state['last_step']
+        skipped = (step - last_step).to(p.dtype)
+        shape = (-1,) + (1,) * (p.dim() - 1)
+        square_avg = state['square_avg']
+        square_avg.mul_(torch.pow(group['alpha'], skipped).view(shape if square_avg.dim() == p.dim() else -1))
+        if group['momentum'] > 0:
+            buf = state['momentum_buffer']
+            p.data.add_(-group['lr'], buf * self._geometric_sum(group['momentum'], skipped).view(shape))
+            buf.mul_(torch.pow(group['momentum'], skipped).view(shape))
+        last_step.fill_(step)